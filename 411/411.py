@@ -5,49 +5,29 @@ import boto3
 import botocore
 import consul
 import datetime
+import hashlib
 import inspect
+import itertools
+import json
 import os
 import re
+import shutil
+import signal
 import sys
+import tempfile
+import time
+import zlib
 
 from docopt import docopt
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from multiprocessing.pool import ThreadPool
 from threading import Thread, Lock
-from Queue import Queue
 from time import sleep
 
-
-class AntiFlapping(object):
-    """
-    AntiFlapping class to process event in a timely maneer
-    """
-    def __init__(self, window):
-        self.window = int(window)
-        self.tasks = Queue(maxsize=1)
-        self._window_ended = True
-        self._thread = Thread(name="AntiFlapping", target=self._run)
-        self._thread.start()
-
-    def newEvent(self, func, kwargs={}):
-        """
-        newEvent Triggered.
-        """
-        if not self.tasks.full() and self._window_ended:
-            self.tasks.put({'func': func, 'args':kwargs})
-
-    def _run(self):
-        """
-        internal runloop that will fire tasks in order.
-        """
-        while True:
-            task = self.tasks.get()
-            self._window_ended = False
-            sleep(self.window)
-            self._window_ended = True
-            if task['args']:
-                task['func'](**task['args'])
-            else:
-                task['func']()
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from debounce import Debouncer
+from rate_limit import TokenBucket
+from service_tags import parse_service
 
 
 class Logger(object):
@@ -81,12 +61,464 @@ class Logger(object):
         ))
 
 
+IPV4 = re.compile(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$')
+
+# Route53 limits of a single ChangeBatch
+MAX_BATCH_RECORDS = 1000
+MAX_BATCH_CHARS = 32000
+# rejected batches are not split on these errors, they are not caused by a change
+UNSPLITTABLE_ERRORS = ("Throttling", "PriorRequestNotComplete", "NoSuchHostedZone")
+
+
+def rr_set_change(action, name, _type, values, ttl=30):
+    """ Return the change of a resource record set as expected in a ChangeBatch"""
+    return {"Action": action,
+            "ResourceRecordSet": {"Name": name,
+                                  "Type": _type,
+                                  "TTL": ttl,
+                                  "ResourceRecords": [{"Value": "{}".format(value)} for value in values],
+                                  }
+            }
+
+
+def change_batches(changes, max_records=MAX_BATCH_RECORDS, max_chars=MAX_BATCH_CHARS):
+    """ Pack changes in as few ChangeBatches as Route53 accepts (values of an UPSERT count twice)"""
+    batches = []
+    batch, records, chars = [], 0, 0
+    for change in changes:
+        values = change['ResourceRecordSet']['ResourceRecords']
+        weight = 2 if change['Action'] == "UPSERT" else 1
+        change_records = weight * len(values)
+        change_chars = weight * sum(len(value['Value']) for value in values)
+        if batch and (records + change_records > max_records or chars + change_chars > max_chars):
+            batches.append(batch)
+            batch, records, chars = [], 0, 0
+        batch.append(change)
+        records += change_records
+        chars += change_chars
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _error_code(ex):
+    """ Return the AWS error code of a botocore exception if any"""
+    return getattr(ex, 'response', {}).get('Error', {}).get('Code')
+
+
+def _index_by_name(records):
+    """ Return {name: [ip, ...]} keeping the iteration order of the records"""
+    index = {}
+    for ip, name in records:
+        index.setdefault(name, []).append(ip)
+    return index
+
+
+def compute_actions(wanted_records, current_records, domains):
+    """
+    Return the {domain: {name: {'action': ..., 'values': [...]}}} changes turning the
+    current records into the wanted ones, for the given domains only.
+
+    Records are indexed by name once so each domain is diffed in linear time.
+    """
+    actions = {}
+    domains = set(domains)
+    for domain in set(wanted_records.keys()) | set(current_records.keys()):
+        if domain not in domains:
+            continue
+        wanted = wanted_records.get(domain, set())
+        current = current_records.get(domain, set())
+        current_by_name = _index_by_name(current)
+        wanted_by_name = _index_by_name(wanted)
+        domain_actions = {}
+
+        for ip, name in wanted - current:
+            if name not in domain_actions:
+                domain_actions[name] = {'action': 'CREATE', 'values': []}
+            domain_actions[name]['values'].append(ip)
+            # check if we keep curent records (adding another ip to name)
+            for ex_ip in current_by_name.get(name, ()):
+                domain_actions[name]['action'] = "UPSERT"
+                if (ex_ip, name) in wanted:
+                    domain_actions[name]['values'].append(ex_ip)
+
+        for ip, name in current - wanted:
+            if domain_actions.get(name, {}).get('action') in ["CREATE", "UPSERT"]:
+                continue
+            if name not in domain_actions:
+                domain_actions[name] = {'action': 'DELETE', 'values': []}
+            domain_actions[name]['values'].append(ip)
+            if any((ex_ip, name) in current for ex_ip in wanted_by_name.get(name, ())):
+                domain_actions[name]['action'] = "UPSERT"
+
+        if domain_actions:
+            actions[domain] = domain_actions
+    return actions
+
+
+def dnsmasq_lines(records, domains=()):
+    """ Yield (domain, is_a_record, line) for the dnsmasq hosts / cname lines of the records, sorted"""
+    for domain in sorted(records):
+        if domains and domain not in domains:
+            continue
+        for ip, fqdn in sorted(records[domain]):
+            if IPV4.match(ip):
+                yield domain, True, "%s %s %s\n" % (ip, fqdn, fqdn.split(".")[0])
+            else:
+                yield domain, False, "cname=%s,%s\n" % (fqdn, ip)
+
+
+def find_dnsmasq_pid(pid_file=None, name="dnsmasq"):
+    """ Return the pid of the running dnsmasq from its pid file, or by looking up its process name"""
+    if pid_file and os.path.isfile(pid_file):
+        try:
+            with open(pid_file) as f:
+                pid = int(f.read().strip())
+            os.kill(pid, 0)
+            return pid
+        except (ValueError, OSError):
+            pass
+    for entry in os.listdir("/proc") if os.path.isdir("/proc") else []:
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/%s/comm" % entry) as f:
+                if f.read().strip() == name:
+                    return int(entry)
+        except IOError:
+            continue
+    return None
+
+
+def _file_digest(path):
+    """ Return the sha1 of a file, read by chunks"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _temp_file(path):
+    """ Return (file, path) of a new temporary file next to path, so it can be renamed over it"""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".%s." % os.path.basename(path))
+    return os.fdopen(fd, 'w'), tmp
+
+
+class HostsFileParser(object):
+    """
+    Parse external hosts files (or dnsmasq conf files for their cname lines).
+
+    Files are read line by line in a single pass, so they are never copied in memory at once.
+    Results are cached by (path, mtime, size) so unchanged files are not parsed again.
+    """
+    def __init__(self):
+        self._cache = {}
+
+    def parse(self, path):
+        """ Return the list of (ip, fqdn, host) records of a file"""
+        stat = os.stat(path)
+        key = (stat.st_mtime, stat.st_size)
+        cached = self._cache.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+        with open(path, 'rb') as f:
+            records = self._parse_lines(f, path.endswith(".conf"))
+        self._cache[path] = (key, records)
+        return records
+
+    @staticmethod
+    def _parse_lines(lines, is_conf):
+        records = []
+        for entry in lines:
+            entry = entry.rstrip("\n")
+            if not entry or entry.startswith("#"):
+                continue
+            if is_conf:
+                # only cname lines are used from dnsmasq conf files
+                if not entry.startswith("cname="):
+                    continue
+                fields = entry.replace("cname=", "").split(",")
+                if len(fields) != 2:
+                    continue
+                fqdn, ip = fields
+                host = fqdn.split('.', 1)[0]
+            else:
+                fields = entry.split()
+                if len(fields) != 3:
+                    continue
+                ip, fqdn, host = fields
+            records.append((ip, fqdn, host))
+        return records
+
+
+class ZoneTrie(object):
+    """ Trie of domains by reversed labels, to find the shortest domain a name belongs to"""
+    def __init__(self, domains=()):
+        self.root = {}
+        for domain in domains:
+            self.add(domain)
+
+    def add(self, domain):
+        node = self.root
+        for label in reversed(domain.split(".")):
+            node = node.setdefault(label, {})
+        # labels can't be None, use it to mark the end of a domain
+        node[None] = domain
+
+    def find(self, name):
+        node = self.root
+        for label in reversed(name.split(".")):
+            node = node.get(label)
+            if node is None:
+                return None
+            if None in node:
+                return node[None]
+        return None
+
+
+class RecordsMirror(object):
+    """
+    Local copy of the A / CNAME records of the Route53 zones.
+
+    It is updated from the changes we successfully commit, so most refreshes don't list
+    the zones again. The zones are listed again (full resync) when the copy is older than
+    resync_interval seconds, when a change was rejected (someone else changed the zone)
+    or when a new zone is managed. If path is set the copy is kept between runs.
+    """
+    def __init__(self, path=None, resync_interval=3600):
+        self.path = path
+        self.resync_interval = resync_interval
+        self.records = {}
+        self.synced_at = None
+        self.stale = True
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            self.records = dict((domain, set(tuple(record) for record in records)) for domain, records in state['records'].iteritems())
+            self.synced_at = state['synced_at']
+            self.stale = state['stale']
+        except (ValueError, KeyError, TypeError, IOError):
+            self.records, self.synced_at, self.stale = {}, None, True
+
+    def save(self):
+        if not self.path:
+            return
+        state = {'synced_at': self.synced_at,
+                 'stale': self.stale,
+                 'records': dict((domain, sorted(records)) for domain, records in self.records.iteritems())}
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix=".%s." % os.path.basename(self.path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, self.path)
+
+    def needs_resync(self, domains):
+        if self.stale or self.synced_at is None or set(domains) - set(self.records):
+            return True
+        return time.time() - self.synced_at >= self.resync_interval
+
+    def reset(self, domains, records):
+        """ Replace the copy with the records just listed from Route53"""
+        self.records = dict((domain, set(records.get(domain, set()))) for domain in domains)
+        self.synced_at = time.time()
+        self.stale = False
+        self.save()
+
+    def apply(self, domain, changes):
+        """ Update the copy with changes committed to the zone of domain"""
+        if not changes:
+            return
+        records = self.records.setdefault(domain, set())
+        for change in changes:
+            name = change['ResourceRecordSet']['Name']
+            # a resource record set holds all the values of a name: CREATE, UPSERT and DELETE replace them all
+            records.difference_update([record for record in records if record[1] == name])
+            if change['Action'] != "DELETE":
+                records.update((value['Value'], name) for value in change['ResourceRecordSet']['ResourceRecords'])
+        self.save()
+
+    def invalidate(self):
+        self.stale = True
+        self.save()
+
+    def copy(self):
+        return dict((domain, set(records)) for domain, records in self.records.iteritems())
+
+
+class ChangeFeed(object):
+    """
+    Versioned feed of the AWS records published by the master in the consul KV datastore.
+
+    <prefix>/version                   the last version
+    <prefix>/deltas/<version>          records added and removed by a version (compressed json)
+    <prefix>/snapshot                  version and number of chunks of the last full snapshot
+    <prefix>/snapshots/<version>/<n>   the compressed snapshot, by chunks (consul values are limited to 512KB)
+
+    Slaves apply the deltas following their version, the snapshot is only read on a gap
+    (start, missed versions, restart of the master) and the deltas since it are replayed.
+    A snapshot is written when the master starts then every `snapshot_every` versions, the
+    last `history` deltas are kept (at least the ones since the snapshot).
+    """
+    CHUNK_SIZE = 500 * 1024
+
+    def __init__(self, prefix, history=100, snapshot_every=10):
+        self.prefix = prefix.rstrip("/")
+        self.history = history
+        self.snapshot_every = max(1, min(snapshot_every, history))
+        self.version = None
+        self.records = None
+        self.snapshot_version = None
+
+    @property
+    def version_key(self):
+        return "%s/version" % self.prefix
+
+    def _delta_key(self, version):
+        return "%s/deltas/%010d" % (self.prefix, version)
+
+    def _snapshot_key(self, version):
+        return "%s/snapshots/%010d/" % (self.prefix, version)
+
+    @staticmethod
+    def _dump(data):
+        return zlib.compress(json.dumps(data, sort_keys=True))
+
+    @staticmethod
+    def _load(value):
+        return json.loads(zlib.decompress(value))
+
+    @staticmethod
+    def _records(data):
+        return dict((domain, set(tuple(record) for record in records)) for domain, records in data.iteritems())
+
+    def publish(self, consul_client, records):
+        """ Publish the changes since the last published records (master), return True if a version was published"""
+        records = dict((domain, set(domain_records)) for domain, domain_records in records.iteritems())
+        # (re)start of the master: continue the versions from a snapshot, slaves will load it
+        restart = self.records is None
+        if restart:
+            _, data = consul_client.kv.get(self.version_key)
+            self.version = int(data['Value']) if data else 0
+            _, data = consul_client.kv.get("%s/snapshot" % self.prefix)
+            self.snapshot_version = json.loads(data['Value'])['version'] if data else None
+        else:
+            delta = {'add': {}, 'remove': {}}
+            for domain in set(records) | set(self.records):
+                added = records.get(domain, set()) - self.records.get(domain, set())
+                removed = self.records.get(domain, set()) - records.get(domain, set())
+                if added:
+                    delta['add'][domain] = sorted(added)
+                if removed:
+                    delta['remove'][domain] = sorted(removed)
+            if not delta['add'] and not delta['remove']:
+                return False
+            delta['version'] = self.version + 1
+            consul_client.kv.put(self._delta_key(self.version + 1), self._dump(delta))
+        self.version += 1
+
+        snapshot = restart or self.snapshot_version is None or self.version - self.snapshot_version >= self.snapshot_every
+        if snapshot:
+            data = self._dump({'version': self.version, 'records': dict((domain, sorted(domain_records)) for domain, domain_records in records.iteritems())})
+            chunks = [data[i:i + self.CHUNK_SIZE] for i in range(0, len(data), self.CHUNK_SIZE)]
+            for n, chunk in enumerate(chunks):
+                consul_client.kv.put("%s%04d" % (self._snapshot_key(self.version), n), chunk)
+            consul_client.kv.put("%s/snapshot" % self.prefix, json.dumps({'version': self.version, 'chunks': len(chunks)}))
+        # slaves are watching the version, update it last
+        consul_client.kv.put(self.version_key, str(self.version))
+
+        if snapshot:
+            if self.snapshot_version is not None:
+                consul_client.kv.delete(self._snapshot_key(self.snapshot_version), recurse=True)
+            self.snapshot_version = self.version
+        if self.version > self.history:
+            consul_client.kv.delete(self._delta_key(self.version - self.history))
+        self.records = records
+        return True
+
+    def fetch(self, consul_client):
+        """
+        Return the last published records (slave), applying the new deltas or loading the snapshot.
+        Return None if the feed can't provide them (nothing published yet, no snapshot).
+        """
+        _, data = consul_client.kv.get(self.version_key)
+        if not data:
+            return None
+        version = int(data['Value'])
+        if self.records is not None and version == self.version:
+            return self._copy()
+        if self.records is not None and version > self.version and self._apply_deltas(consul_client, version):
+            return self._copy()
+        if not self._load_snapshot(consul_client):
+            return None
+        if self.version < version:
+            self._apply_deltas(consul_client, version)
+        return self._copy()
+
+    def _apply_deltas(self, consul_client, version):
+        """ Apply the deltas following our version up to version, return False if some are missing"""
+        # older deltas are gone, don't read the ones still there
+        if version - self.version > self.history:
+            return False
+        deltas = []
+        for _version in range(self.version + 1, version + 1):
+            _, data = consul_client.kv.get(self._delta_key(_version))
+            if not data:
+                return False
+            deltas.append(data['Value'])
+        for value in deltas:
+            delta = self._load(value)
+            for domain, records in self._records(delta['remove']).iteritems():
+                self.records.get(domain, set()).difference_update(records)
+            for domain, records in self._records(delta['add']).iteritems():
+                self.records.setdefault(domain, set()).update(records)
+        self.version = version
+        return True
+
+    def _load_snapshot(self, consul_client, retries=3):
+        """ Load the last snapshot, return False if there is none or if it can't be read"""
+        for _ in range(retries):
+            _, data = consul_client.kv.get("%s/snapshot" % self.prefix)
+            if not data:
+                return False
+            meta = json.loads(data['Value'])
+            _, data = consul_client.kv.get(self._snapshot_key(meta['version']), recurse=True)
+            chunks = sorted((item['Key'], item['Value']) for item in data or [])
+            # the snapshot may have been replaced while we were reading it
+            if len(chunks) == meta['chunks']:
+                snapshot = self._load("".join(value for _, value in chunks))
+                self.version = snapshot['version']
+                self.records = self._records(snapshot['records'])
+                return True
+        return False
+
+    def _copy(self):
+        return dict((domain, set(records)) for domain, records in (self.records or {}).iteritems())
+
+
 class Unify411(object):
     """Class to generate dns records"""
-    def __init__(self, consul_address, datacenter=None, external_hosts=[], zones=None, output=[], domains=[]):
+    def __init__(self, consul_address, datacenter=None, external_hosts=[], zones=None, output=[], domains=[], state_file=None, resync_interval=3600, aws_workers=8, aws_rate=5):
         super(Unify411, self).__init__()
         self.lock = Lock()
         self.log = Logger()
+        self.records_mirror = RecordsMirror(state_file, resync_interval)
+        # zones are listed / updated concurrently, within the Route53 requests rate shared by all of them
+        self.__pool = ThreadPool(aws_workers)
+        self.__zone_locks = defaultdict(Lock)
+        self.rate_limiter = TokenBucket(aws_rate)
+        self.__route53_clients = {}
+        self.__zone_ids = {}
+        self.__zones = ZoneTrie()
+        # digests of the files written by generate_output_file
+        self.__output_digests = {}
+        self.__dnsmasq_loaded = False
+        self.hosts_parser = HostsFileParser()
+        self.feed = None
         self._consul_host = consul_address
         self.consul = consul.Consul(host=self._consul_host)
         self.external_hosts = external_hosts if external_hosts else []
@@ -108,78 +540,246 @@ class Unify411(object):
 
     def __get_wanted_records(self):
         self.wanted_dns_records = {}
+        self.__zones = ZoneTrie()
         self.__retrieve_consul_records()
         self.__retrieve_external_records(self.external_hosts)
 
     def __get_current_records(self):
-        self.current_dns_records = {}
-        self.__retrieve_aws_records()
+        self.__get_aws_profiles()
+        if self.records_mirror.needs_resync(self.__aws_profiles.keys()):
+            self.log.info("Listing AWS records", zones=sorted(self.__aws_profiles.keys()))
+            self.current_dns_records = {}
+            self.__retrieve_aws_records()
+            self.records_mirror.reset(self.__aws_profiles.keys(), self.current_dns_records)
+        else:
+            self.current_dns_records = self.records_mirror.copy()
 
     def generate_output_file(self, file_path=None, slave=False, domains=[]):
-        out_a = ""
-        out_cname = ""
+        """
+        Return the (hosts, cname) outputs, or write them for dnsmasq.
+
+        CNAME records go to <file_path>.conf and A records to one <file_path>.<domain>.hosts
+        file per domain (referenced from the conf with addn-hosts), so dnsmasq can reload
+        them with a SIGHUP. Only the files whose content changed are replaced.
+        Return (conf_changed, changed_hosts_files).
+        """
         records = self.wanted_dns_records if not slave else self.current_dns_records
-        for domain, entry in records.iteritems():
-            if domains and domain not in domains:
-                continue
-            for host in sorted(entry):
-                if re.match(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$', host[0]):
-                    out_a += "%s %s %s\n" % (host[0], host[1], host[1].split(".")[0])
-                else:
-                    out_cname += "cname=%s,%s\n" % (host[1], host[0])
         if not file_path:
-            return (out_a, out_cname)
+            out_a, out_cname = [], []
+            for domain, is_a, line in dnsmasq_lines(records, domains):
+                (out_a if is_a else out_cname).append(line)
+            return ("".join(out_a), "".join(out_cname))
+
+        conf_path = "%s.conf" % file_path
+        shards = []
+        changed_shards = []
+        shard, shard_tmp, shard_digest, shard_path = None, None, None, None
+        cnames, cname_tmp = _temp_file(conf_path)
+        conf_tmp = None
+        try:
+            # stream the lines to temporary files, the digests tell if they differ from the previous output
+            with cnames:
+                for domain, is_a, line in dnsmasq_lines(records, domains):
+                    if not is_a:
+                        cnames.write(line)
+                        continue
+                    if shard_path != "%s.%s.hosts" % (file_path, domain):
+                        if shard:
+                            shard.close()
+                            if self.__replace_output(shard_path, shard_tmp, shard_digest.hexdigest()):
+                                changed_shards.append(shard_path)
+                        shard_path = "%s.%s.hosts" % (file_path, domain)
+                        shard, shard_tmp = _temp_file(shard_path)
+                        shard_digest = hashlib.sha1()
+                        shards.append(shard_path)
+                    shard.write(line)
+                    shard_digest.update(line)
+            if shard:
+                shard.close()
+                if self.__replace_output(shard_path, shard_tmp, shard_digest.hexdigest()):
+                    changed_shards.append(shard_path)
+
+            conf, conf_tmp = _temp_file(conf_path)
+            conf_digest = hashlib.sha1()
+            with conf, open(cname_tmp) as cnames:
+                for line in itertools.chain(("addn-hosts=%s\n" % path for path in shards), cnames):
+                    conf.write(line)
+                    conf_digest.update(line)
+            conf_changed = self.__replace_output(conf_path, conf_tmp, conf_digest.hexdigest())
+
+            # hosts files of the domains without A records anymore
+            directory, base = os.path.split(file_path)
+            for name in os.listdir(directory or "."):
+                path = os.path.join(directory, name)
+                if name.startswith(base + ".") and name.endswith(".hosts") and len(name) > len(base) + 7 and path not in shards:
+                    os.remove(path)
+                    self.__output_digests.pop(path, None)
+            # single hosts file written before the per domain ones, dnsmasq must stop serving it
+            if os.path.exists("%s.hosts" % file_path):
+                os.remove("%s.hosts" % file_path)
+                self.__output_digests.pop("%s.hosts" % file_path, None)
+                conf_changed = True
+            return conf_changed, changed_shards
+        finally:
+            if shard and not shard.closed:
+                shard.close()
+            for tmp in (shard_tmp, cname_tmp, conf_tmp):
+                if tmp and os.path.exists(tmp):
+                    os.remove(tmp)
+
+    def reload_dnsmasq(self, conf_changed, changed_hosts, run_cmd=None, pid_file=None):
+        """
+        Make dnsmasq use the new files.
+
+        dnsmasq re-reads its hosts files on SIGHUP but not its conf: when only hosts files
+        changed and pid_file is set the running dnsmasq is signaled, otherwise run_cmd is
+        run (always on the first call, it may not be running yet).
+        """
+        if self.__dnsmasq_loaded and not conf_changed and not changed_hosts:
+            return
+        if self.__dnsmasq_loaded and not conf_changed and pid_file:
+            pid = find_dnsmasq_pid(pid_file)
+            if pid:
+                self.log.info("Reloading dnsmasq hosts files", pid=pid, files=changed_hosts)
+                try:
+                    os.kill(pid, signal.SIGHUP)
+                    return
+                except OSError as ex:
+                    self.log.warn("Failed to signal dnsmasq", pid=pid, ex=ex)
+            else:
+                self.log.warn("dnsmasq process not found", pid_file=pid_file)
+        if run_cmd:
+            self.log.info("Running command", cmd=run_cmd)
+            os.system(run_cmd)
+        self.__dnsmasq_loaded = True
+
+    def __replace_output(self, path, tmp, digest):
+        """ Rename tmp over path if its digest differs from the one of the last output, return True if replaced"""
+        if path not in self.__output_digests and os.path.isfile(path):
+            self.__output_digests[path] = _file_digest(path)
+        if os.path.isfile(path) and self.__output_digests.get(path) == digest:
+            os.remove(tmp)
+            return False
+        # mkstemp files are only readable by us, dnsmasq may read them under another user
+        if os.path.isfile(path):
+            shutil.copymode(path, tmp)
         else:
-            if not os.path.isfile("%s.conf" % file_path) or out_cname != file.read(open("%s.conf" % file_path)):
-                with open("%s.conf" % file_path,'w') as output:
-                    if out_a:
-                        out_cname = "addn-hosts=%s.hosts\n" % file_path + out_cname
-                    print(out_cname, end='', file=output)
-            if not os.path.isfile("%s.hosts" % file_path) or out_a != file.read(open("%s.hosts" % file_path)):
-                with open("%s.hosts" % file_path,'w') as output:
-                    print(out_a, end='', file=output)
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+        os.rename(tmp, path)
+        self.__output_digests[path] = digest
+        return True
 
     def update_route53(self, commit=True):
+        self.apply_plan(self.plan_route53(), commit)
+
+    def plan_route53(self):
+        """
+        Return the plan of the changes to send to Route53: the ChangeBatches and the records
+        touched in each zone, the number of API calls and their estimated duration under the
+        rate limit. The plan is json serializable and can be given to apply_plan later.
+        """
+        zones = {}
         for profile, actions in self.__compute_aws_actions().iteritems():
-            for name, action in actions.iteritems():
-                if len(action['values']) == 1 and not re.match(r'^\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}$', action['values'][0]):
+            changes = []
+            records = {}
+            for name, action in sorted(actions.iteritems()):
+                if len(action['values']) == 1 and not IPV4.match(action['values'][0]):
                     c_type = "CNAME"
                 else:
                     c_type = "A"
-                self.log.info("Changing Record Set",  action=action['action'], type=c_type, name=name, values=action['values'])
-                self._change_rr_sets(self.__aws_profiles[profile]['connection'], action['action'], self.__aws_profiles[profile]['zoneID'], name, c_type, action['values'], commit)
-
-    def _change_rr_sets(self, route53_client, action, zone_id, name, _type, values, commit, ttl=30):
-        change = {"Changes": [{"Action": action,
-                               "ResourceRecordSet": {"Name": name,
-                                                     "Type": _type,
-                                                     "TTL": ttl,
-                                                     "ResourceRecords": [{"Value": "{}".format(value)} for value in values],
-                                                     }
-                               }
-                              ]
-                  }
-
-        if commit:
-            try:
-                route53_client.change_resource_record_sets(HostedZoneId=zone_id, ChangeBatch=change)
-            except Exception as ex:
-                self.log.error("Failed to commit the action for the resource record sets", action=action, name=name, type=_type, values=values, change=change, ex=ex)
-                if ttl == 30 and action == "DELETE":
-                    self.log.info("Trying the same with default boto TTL...")
-                    self._change_rr_sets(route53_client, action, zone_id, name, _type, values, commit, ttl=600)
+                changes.append(rr_set_change(action['action'], name, c_type, action['values']))
+                records.setdefault(action['action'], []).append(name)
+            zones[profile] = {'zone_id': self.__aws_profiles[profile]['zoneID'],
+                              'batches': change_batches(changes),
+                              'records': records}
+        api_calls = sum(len(zone['batches']) for zone in zones.itervalues())
+        return {'created': datetime.datetime.utcnow().replace(microsecond=0).isoformat(),
+                'zones': zones,
+                'api_calls': api_calls,
+                'estimated_seconds': self.rate_limiter.estimate(api_calls)}
+
+    def apply_plan(self, plan, commit=True):
+        """ Send the ChangeBatches of a plan, zones are updated concurrently"""
+        zones = sorted(plan['zones'].items())
+        results = self.__pool.map(lambda zone: self.__apply_zone(zone[0], zone[1], commit), zones)
+        if not commit:
+            return
+        for (profile, _), (applied, complete) in zip(zones, results):
+            self.records_mirror.apply(profile, applied)
+            if not complete:
+                # the zone doesn't look like our copy, list it again on the next refresh
+                self.records_mirror.invalidate()
+
+    def __apply_zone(self, profile, zone, commit):
+        """ Send the batches of a zone, return the changes applied and whether they all were"""
+        applied = []
+        changes = 0
+        with self.__zone_locks[profile]:
+            for batch in zone['batches']:
+                for change in batch:
+                    record = change['ResourceRecordSet']
+                    self.log.info("Changing Record Set",  action=change['Action'], type=record['Type'], name=record['Name'], values=[value['Value'] for value in record['ResourceRecords']])
+                changes += len(batch)
+                applied += self._change_rr_sets(self.__route53_client(profile), zone['zone_id'], batch, commit)
+        return applied, len(applied) == changes
+
+    def _change_rr_sets(self, route53_client, zone_id, changes, commit):
+        """
+        Send a ChangeBatch, a rejected batch is split in two until the failing change(s) are isolated.
+
+        Return the list of the changes applied.
+        """
+        if not commit or not changes:
+            return []
+        try:
+            self.log.debug("Sending Change Batch", zone=zone_id, changes=len(changes))
+            self.rate_limiter.acquire()
+            route53_client.change_resource_record_sets(HostedZoneId=zone_id, ChangeBatch={"Changes": changes})
+            return changes
+        except Exception as ex:
+            if _error_code(ex) == "NoSuchHostedZone":
+                self._forget_zone(zone_id)
+            # a whole batch is applied or rejected: bisect to apply every change but the bad one(s)
+            if len(changes) > 1 and _error_code(ex) not in UNSPLITTABLE_ERRORS:
+                self.log.warn("Change batch rejected, splitting it", zone=zone_id, changes=len(changes), ex=ex)
+                half = len(changes) // 2
+                return self._change_rr_sets(route53_client, zone_id, changes[:half], commit) + self._change_rr_sets(route53_client, zone_id, changes[half:], commit)
+            for change in changes:
+                record = change['ResourceRecordSet']
+                self.log.error("Failed to commit the action for the resource record sets", action=change['Action'], name=record['Name'], type=record['Type'], values=[value['Value'] for value in record['ResourceRecords']], ex=ex)
+            if len(changes) == 1 and changes[0]['Action'] == "DELETE" and changes[0]['ResourceRecordSet']['TTL'] == 30:
+                self.log.info("Trying the same with default boto TTL...")
+                record = changes[0]['ResourceRecordSet']
+                return self._change_rr_sets(route53_client, zone_id, [rr_set_change("DELETE", record['Name'], record['Type'], [value['Value'] for value in record['ResourceRecords']], ttl=600)], commit)
+            return []
 
     def __find_parent_zone_for(self, zone):
         """ Helper to find if we have parent zone we can use"""
-        parent_zones = []
-        for domain in self.wanted_dns_records.keys():
-            if domain in zone:
-                parent_zones.append(domain)
-        if parent_zones:
-            parent_zones = sorted(parent_zones, key=lambda entry: len(entry))
-            return parent_zones[0]
-        else:
-            return zone
+        return self.__zones.find(zone) or zone
+
+    def __route53_client(self, profile):
+        """ Return the route53 client of a profile, clients are kept for the life of the process"""
+        if profile not in self.__route53_clients:
+            self.__route53_clients[profile] = boto3.Session(profile_name=profile).client('route53')
+        return self.__route53_clients[profile]
+
+    def __zone_id(self, profile):
+        """ Return the id of the hosted zone of a profile (None if not found), found ids are cached"""
+        if profile not in self.__zone_ids:
+            self.rate_limiter.acquire()
+            for zone in self.__route53_client(profile).list_hosted_zones()['HostedZones']:
+                if zone['Name'] == profile + '.':
+                    self.__zone_ids[profile] = zone['Id']
+        return self.__zone_ids.get(profile)
+
+    def _forget_zone(self, zone_id):
+        """ Drop a hosted zone id that doesn't exist anymore, it will be looked up again"""
+        for profile, _zone_id in self.__zone_ids.items():
+            if _zone_id == zone_id:
+                self.log.warn("Hosted zone not found, it will be looked up again", profile=profile, zone=zone_id)
+                del self.__zone_ids[profile]
 
     def __get_aws_profiles(self):
         """ This function will iterate over the potential profiles and try to create a connection. If it fails it will remove it."""
@@ -188,91 +788,80 @@ class Unify411(object):
             domains = self.domains
         else:
             domains = self.wanted_dns_records.keys()
+        available_profiles = botocore.session.get_session().available_profiles
         for domain in domains:
             # if the current domain is a sub zone of an existing domain try the parent domain instead.
             parent_zone = self.__find_parent_zone_for(domain)
             if self.domains and parent_zone not in self.domains:
                 continue
-            if parent_zone in botocore.session.get_session().available_profiles:
-                aws_client = boto3.Session(profile_name=parent_zone)
-                route53_client = aws_client.client('route53')
-                for zone in route53_client.list_hosted_zones()['HostedZones']:
-                    if zone['Name'] == parent_zone + '.':
-                        self.__aws_profiles[parent_zone] = {"connection":route53_client, "zoneID":zone['Id']}
+            if parent_zone in available_profiles:
+                zone_id = self.__zone_id(parent_zone)
+                if zone_id:
+                    self.__aws_profiles[parent_zone] = {"connection": self.__route53_client(parent_zone), "zoneID": zone_id}
             else:
                 self.log.warn("No AWS profile found for %s as profile name." % (domain))
 
     def __retrieve_aws_records(self):
         """ This function will compare the list of records we have on aws and do the required changes """
-        self.__get_aws_profiles()
-        for domain, aws_profile in self.__aws_profiles.iteritems():
-            record_set = aws_profile['connection'].list_resource_record_sets(HostedZoneId=aws_profile['zoneID'])
+        zones = self.__aws_profiles.items()
+        for (domain, aws_profile), records in zip(zones, self.__pool.map(lambda zone: self.__list_zone(*zone), zones)):
+            if records is None:
+                self._forget_zone(aws_profile['zoneID'])
+                del self.__aws_profiles[domain]
+                continue
+            for ip, fqdn in records:
+                self.__set_record(self.current_dns_records, domain, ip, fqdn)
+
+    def __list_zone(self, domain, aws_profile):
+        """ Return the A and CNAME records of a zone, None if the zone doesn't exist anymore"""
+        records = []
+        with self.__zone_locks[domain]:
+            try:
+                self.rate_limiter.acquire()
+                record_set = aws_profile['connection'].list_resource_record_sets(HostedZoneId=aws_profile['zoneID'])
+            except botocore.exceptions.ClientError as ex:
+                if _error_code(ex) != "NoSuchHostedZone":
+                    raise
+                return None
             while True:
                 for record in record_set['ResourceRecordSets']:
                     if record['Type'] in ["A", "CNAME"]:
                         for resource in record['ResourceRecords']:
-                            self.__set_record(self.current_dns_records, domain, resource['Value'], record['Name'][:-1])
+                            records.append((resource['Value'], record['Name'][:-1]))
                 if record_set['IsTruncated']:
+                    self.rate_limiter.acquire()
                     record_set = aws_profile['connection'].list_resource_record_sets(HostedZoneId=aws_profile['zoneID'], StartRecordName=record_set['NextRecordName'])
                 else:
                     break
+        return records
 
     def __retrieve_external_records(self, path):
         for host_file in path:
             if os.path.isfile(host_file):
-                raw_host = file.read(open(host_file)).split("\n")
-                for entry in raw_host:
-                    if entry.startswith("#"):
-                        continue
-                    try:
-                        if host_file.endswith(".conf"):
-                            if entry.startswith("cname="):
-                                fqdn, ip = entry.replace("cname=","").split(",")
-                                host = fqdn.split('.', 1)[0]
-                        else:
-                            ip, fqdn, host = entry.split()
-                    except:
-                        continue
+                for ip, fqdn, host in self.hosts_parser.parse(host_file):
                     if host_file in self.external_hosts:
                         self.__set_record(self.wanted_dns_records, self.__find_parent_zone_for(fqdn.replace("%s." % host, '')), ip, fqdn)
                     else:
                         self.__set_record(self.current_dns_records, self.__find_parent_zone_for(fqdn.replace("%s." % host, '')), ip, fqdn)
 
-    def __parse_tags(self, tags):
-        """ Return a dict of tags from array"""
-        _tags = {}
-        if tags:
-            for tag in tags:
-                if len(tag.split("=", 1)) != 2:
-                    continue
-                k,v = tag.split("=", 1)
-                if k not in _tags.keys():
-                    _tags[k] = v
-                else:
-                    if not isinstance(_tags[k], list):
-                        _tags[k] = [_tags[k]]
-                    _tags[k].append(v)
-        return _tags
-
     def __retrieve_consul_records(self):
         """ Retrive services from consul """
         index, services = self.consul.catalog.services(dc=self.datacenter)
         for service in services:
             index, instances = self.consul.catalog.service(service=service)
             for instance in instances:
-                tags = self.__parse_tags(instance['ServiceTags'])
+                record = parse_service(instance['ServiceName'], instance['ServiceAddress'], instance['ServicePort'],
+                                       instance['ServiceID'], instance['ServiceTags'])
                 # if tags contain dns and vhost then the entry will be for haproxy LB
-                if "dns" in tags.keys():
-                    if isinstance(tags['dns'], list):
-                        for domain in tags['dns']:
-                            ip = "haproxy.%s" % (domain) if "vhost" in tags.keys() else instance['ServiceAddress']
-                            self.__set_record(self.wanted_dns_records, domain, ip, "%s.%s" % (tags.get('vhost', instance['ServiceName']), domain))
-                    else:
-                        ip = "haproxy.%s" % (tags.get("dns")) if "vhost" in tags.keys() else instance['ServiceAddress']
-                        self.__set_record(self.wanted_dns_records, tags.get("dns"), ip, "%s.%s" % (tags.get('vhost', instance['ServiceName']), tags.get("dns")))
+                if "dns" in record.tags:
+                    for domain in record.domains:
+                        ip = "haproxy.%s" % (domain) if "vhost" in record.tags else record.ip
+                        self.__set_record(self.wanted_dns_records, domain, ip, "%s.%s" % (record.tags.get('vhost', record.name), domain))
 
     def __set_record(self, dct, domain, ip, fqdn):
         """ Update our internal state"""
+        if dct is self.wanted_dns_records and domain not in dct:
+            self.__zones.add(domain)
         if not dct.get(domain):
             dct[domain] = set()
         if not set((ip, fqdn)).issubset(dct.get(domain)):
@@ -280,41 +869,16 @@ class Unify411(object):
 
     def __compute_aws_actions(self):
         """ This function will compute the current and wanted records and return a list of actions"""
-        actions = {}
-        for domain in set(self.wanted_dns_records.keys()) | set(self.current_dns_records.keys()):
-            if domain not in self.__aws_profiles.keys():
-                continue
-            for ip, name in self.wanted_dns_records.get(domain, set()) - self.current_dns_records.get(domain, set()):
-                if not actions.get(domain):
-                    actions[domain] = {}
-                if not actions[domain].get(name):
-                    actions[domain][name] = {'action': 'CREATE', 'values': []}
-                actions[domain][name]['values'].append(ip)
-                # check if we keep curent records (adding another ip to name)
-                for ex_ip, ex_name in self.current_dns_records.get(domain, set()):
-                    if ex_name == name:
-                        actions[domain][name]['action'] = "UPSERT"
-                        if (ex_ip, ex_name) in self.wanted_dns_records.get(domain, set()):
-                            actions[domain][name]['values'].append(ex_ip)
-
-            for ip, name in self.current_dns_records.get(domain, set()) - self.wanted_dns_records.get(domain, set()):
-                if actions.get(domain, {}).get(name, {}).get('action', None) in ["CREATE", "UPSERT"]:
-                    continue
-                if not actions.get(domain):
-                    actions[domain] = {}
-                if not actions[domain].get(name):
-                    actions[domain][name] = {'action': 'DELETE', 'values': []}
-                actions[domain][name]['values'].append(ip)
-                for ex_ip, ex_name in self.wanted_dns_records.get(domain, set()):
-                    if ex_name == name and (ex_ip, ex_name) in self.current_dns_records.get(domain, set()):
-                        actions[domain][name]['action'] = "UPSERT"
-        return actions
-
+        return compute_actions(self.wanted_dns_records, self.current_dns_records, self.__aws_profiles.keys())
 
 def create_records(unify411, options):
     """This function will do what we need to do :)"""
     with unify411.lock:
-        unify411.refresh()
+        records = unify411.feed.fetch(unify411.consul) if options.get('slave', False) and unify411.feed else None
+        if records is not None:
+            unify411.current_dns_records = records
+        else:
+            unify411.refresh()
         if not options['output-prefix'] or options.get('dryrun', False):
             print("> AWS records")
             if not options.get('slave', False):
@@ -327,10 +891,10 @@ def create_records(unify411, options):
         elif options['output-prefix']:
             if not options.get('slave', False):
                 unify411.update_route53()
-            unify411.generate_output_file(options['output-prefix'], options.get('slave', False), options['domain'])
-            if options.get('run-cmd'):
-                unify411.log.info("Running command", cmd=options.get('run-cmd'))
-                os.system(options.get('run-cmd'))
+                if unify411.feed:
+                    unify411.feed.publish(unify411.consul, unify411.records_mirror.copy())
+            conf_changed, changed_hosts = unify411.generate_output_file(options['output-prefix'], options.get('slave', False), options['domain'])
+            unify411.reload_dnsmasq(conf_changed, changed_hosts, options.get('run-cmd'), options.get('sighup') and options.get('dnsmasq-pid'))
             if options.get('notify'):
                 unify411.log.info("Sending Notification Event", path=options.get('notify'))
                 unify411.consul.kv.put(options.get('notify'), "ping")
@@ -340,7 +904,7 @@ def services_listen(unify411, options):
     """ Services listen runloop"""
     unify411.log.info("Listening for services...")
     index = None
-    anti_flapping = AntiFlapping(options['event-threshold'])
+    debouncer = Debouncer(options['event-threshold'], options['event-max-wait'])
     while True:
         old_index = index
         try:
@@ -351,7 +915,7 @@ def services_listen(unify411, options):
             continue
 
         if old_index != index:
-            anti_flapping.newEvent(create_records, kwargs={"unify411": unify411, "options": options})
+            debouncer.newEvent(create_records, kwargs={"unify411": unify411, "options": options})
 
 
 def kv_listen(unify411, options, key):
@@ -452,10 +1016,24 @@ def listen(options):
         -n, --notify path               KV Path in consul datastore of the key to update when done. Can be used to trigger slaves updates.
         -k, --listen-key path           KV Path(s) in consul datastore to listen to, in order to trigger a DNS update. (Used when the external file is updated for example).
         --event-threshold second        Process events by batch with a threshold window (in second) [default: 10].
+        --event-max-wait second         Max delay (in second) before processing the pending events of a batch [default: 60].
+        --state-file path               File where the local copy of the AWS records is kept between runs.
+        --resync-interval second        Max age of the local copy of the AWS records before listing them again [default: 3600].
+        --aws-workers n                 Max number of AWS zones listed or updated concurrently [default: 8].
+        --aws-rate n                    Max AWS API requests per second, shared by all the zones [default: 5].
+        --sighup                        Send SIGHUP to dnsmasq instead of running the command when only hosts files changed.
+        --dnsmasq-pid path              Pid file of dnsmasq, if not found the process is looked up by name [default: /var/run/dnsmasq.pid].
+        --feed prefix                   KV prefix in consul datastore where the changes of the AWS records are published for the slaves.
+        --feed-history n                Number of versions of changes kept in the feed [default: 100].
+        --feed-snapshot-every n         Number of versions between two full snapshots of the feed [default: 10].
         --dryrun                        Don't do anything but print what it will do.
 
     """
-    unify411 = Unify411(consul_address=options["consul"], external_hosts=options["external-file"], datacenter=options["datacenter"], output=options["output-prefix"], domains=options['domain'])
+    unify411 = Unify411(consul_address=options["consul"], external_hosts=options["external-file"], datacenter=options["datacenter"], output=options["output-prefix"], domains=options['domain'],
+                        state_file=options['state-file'], resync_interval=float(options['resync-interval']),
+                        aws_workers=int(options['aws-workers']), aws_rate=float(options['aws-rate']))
+    if options['feed']:
+        unify411.feed = ChangeFeed(options['feed'], int(options['feed-history']), int(options['feed-snapshot-every']))
 
     threads = []
     threads.append(Thread(name="Service Listen", target=services_listen, kwargs={'unify411':unify411, 'options':options}))
@@ -475,6 +1053,54 @@ def listen(options):
         print("\nBye.")
 
 
+@command("Compute the changes to do in AWS and print them as a json plan.")
+def plan(options):
+    """Compute the changes to do in AWS from consul and the external files, and print them as a json plan that can be applied later with apply-plan.
+
+    Usage: plan [options] [-e file...] [-d domain...]
+
+    Options:
+        -c, --consul host               Consul host or ip [default: consul].
+        --datacenter datacenter         Datacenter filter. If not provided will use the default datacenter from the agent.
+        -e, --external-file path        Path to an external hosts file(s) to merge.
+        -d, --domain domain             Restrict to domain(s) only.
+        -o, --output file               Write the plan to a file instead of stdout.
+        --aws-rate n                    Max AWS API requests per second, used to estimate the duration [default: 5].
+
+    """
+    unify411 = Unify411(consul_address=options["consul"], external_hosts=options["external-file"], datacenter=options["datacenter"], domains=options['domain'],
+                        resync_interval=0, aws_rate=float(options['aws-rate']))
+    unify411.refresh()
+    plan = json.dumps(unify411.plan_route53(), indent=2, sort_keys=True)
+    if options['output']:
+        with open(options['output'], 'w') as output:
+            print(plan, file=output)
+    else:
+        print(plan)
+
+
+@command("Send the changes of a plan to AWS.")
+def apply_plan(options):
+    """Send the changes of a json plan computed by the plan command to AWS. Changes conflicting with the current records (changed since the plan) are rejected.
+
+    Usage: apply-plan [options] <plan_file>
+
+    Options:
+        -c, --consul host               Consul host or ip [default: consul].
+        --datacenter datacenter         Datacenter filter. If not provided will use the default datacenter from the agent.
+        --state-file path               File where the local copy of the AWS records is kept (see listen).
+        --aws-workers n                 Max number of AWS zones updated concurrently [default: 8].
+        --aws-rate n                    Max AWS API requests per second, shared by all the zones [default: 5].
+
+    """
+    unify411 = Unify411(consul_address=options["consul"], datacenter=options["datacenter"], state_file=options['state-file'],
+                        aws_workers=int(options['aws-workers']), aws_rate=float(options['aws-rate']))
+    with open(options['<plan_file>']) as plan_file:
+        plan = json.load(plan_file)
+    unify411.log.info("Applying plan", created=plan['created'], api_calls=plan['api_calls'], estimated_seconds=plan['estimated_seconds'])
+    unify411.apply_plan(plan)
+
+
 @command("Slave mode, will only generate dnsmasq files from AWS.")
 def slave(options):
     """Will act as a slave and will update local dnsmasq files from what we have in AWS. This is meant to be used on remote sites to populate a local dnsmasq.
@@ -489,11 +1115,21 @@ def slave(options):
         -o, --output-prefix prefix      The prefix for output files that will be generated for dnsmasq. If not provided will print the output to stdout.
         -r, --run-cmd cmd               The command to run when new dns records are done. Will be executed in a shell.
         --event-threshold second        Process events by batch with a threshold window (in second) [default: 10].
+        --aws-workers n                 Max number of AWS zones listed concurrently [default: 8].
+        --aws-rate n                    Max AWS API requests per second, shared by all the zones [default: 5].
+        --sighup                        Send SIGHUP to dnsmasq instead of running the command when only hosts files changed.
+        --dnsmasq-pid path              Pid file of dnsmasq, if not found the process is looked up by name [default: /var/run/dnsmasq.pid].
+        --feed prefix                   KV prefix in consul datastore of the changes published by the master, read instead of listing AWS.
 
     """
-    unify411 = Unify411(consul_address=options["consul"], datacenter=options["datacenter"], output=options["output-prefix"], domains=options['domain'])
+    # the records are only changed by the master: always list them
+    unify411 = Unify411(consul_address=options["consul"], datacenter=options["datacenter"], output=options["output-prefix"], domains=options['domain'], resync_interval=0,
+                        aws_workers=int(options['aws-workers']), aws_rate=float(options['aws-rate']))
 
     threads = []
+    if options['feed']:
+        unify411.feed = ChangeFeed(options['feed'])
+        threads.append(Thread(target=kv_listen, kwargs={'unify411':unify411, 'options':options, 'key': unify411.feed.version_key}))
     for path in options['listen-key']:
         threads.append(Thread(target=kv_listen, kwargs={'unify411':unify411, 'options':options, 'key': path}))
 
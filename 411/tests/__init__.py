@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import imp
+import os
+import sys
+
+# 411.py is not an importable module name
+u411 = imp.load_source('u411', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '411.py'))
+
+
+class FakeCatalog(object):
+
+    def __init__(self, services):
+        self._services = services
+
+    def datacenters(self):
+        return ['dc1']
+
+    def services(self, index=None, dc=None):
+        return 1, dict((name, []) for name in self._services)
+
+    def service(self, service, dc=None):
+        return 1, self._services[service]
+
+
+class FakeAgent(object):
+
+    def self(self):
+        return {'Config': {'Datacenter': 'dc1'}}
+
+
+class FakeKV(object):
+    """ In process consul KV store"""
+
+    def __init__(self):
+        self.data = {}
+        self.index = 0
+        self.gets = 0
+
+    def get(self, key, index=None, recurse=False, dc=None):
+        self.gets += 1
+        if recurse:
+            items = [{'Key': _key, 'Value': value} for _key, value in sorted(self.data.items()) if _key.startswith(key)]
+            return self.index, items or None
+        if key not in self.data:
+            return self.index, None
+        return self.index, {'Key': key, 'Value': self.data[key]}
+
+    def put(self, key, value):
+        self.index += 1
+        self.data[key] = value
+        return True
+
+    def delete(self, key, recurse=False):
+        self.index += 1
+        for _key in list(self.data):
+            if _key == key or (recurse and _key.startswith(key)):
+                del self.data[_key]
+        return True
+
+
+class FakeConsul(object):
+
+    def __init__(self, host=None, services=None):
+        self.catalog = FakeCatalog(services or {})
+        self.agent = FakeAgent()
+        self.kv = FakeKV()
+
+
+def make_unify411(services=None, **kwargs):
+    """ Return a Unify411 connected to a fake consul, without AWS rate limit unless given"""
+    kwargs.setdefault('aws_rate', 0)
+    consul, stdout = u411.consul.Consul, sys.stdout
+    u411.consul.Consul = lambda host: FakeConsul(host, services)
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return u411.Unify411(consul_address='consul', **kwargs)
+    finally:
+        u411.consul.Consul, sys.stdout = consul, stdout
+
+
+def use_route53(unify411, clients):
+    """ Make unify411 manage the zones of {domain: route53 client}, the zone ids being the domains"""
+    profiles = dict((domain, {'connection': client, 'zoneID': domain}) for domain, client in clients.items())
+    unify411._Unify411__route53_clients.update(clients)
+    unify411._Unify411__get_aws_profiles = lambda: setattr(unify411, '_Unify411__aws_profiles', dict(profiles))
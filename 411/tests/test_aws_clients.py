@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import botocore.exceptions
+from tests import make_unify411, u411
+from tests.test_records_mirror import ListingRoute53, instance
+
+
+class FakeSession(object):
+    """ boto3.Session stand-in counting the sessions and listings of hosted zones"""
+    created = []
+    zones = {}
+
+    def __init__(self, profile_name=None):
+        self.profile_name = profile_name
+        FakeSession.created.append(profile_name)
+
+    def client(self, service):
+        client = ListingRoute53([])
+        client.list_hosted_zones = self.list_hosted_zones
+        return client
+
+    def list_hosted_zones(self):
+        FakeSession.listings += 1
+        return {'HostedZones': [{'Name': name + '.', 'Id': zone_id} for name, zone_id in FakeSession.zones.items()]}
+
+
+class FakeBotocoreSession(object):
+    available_profiles = ['domain.tld', 'other.tld']
+
+
+class TestAwsClients(TestCase):
+
+    def setUp(self):
+        self.session, self.get_session = u411.boto3.Session, u411.botocore.session.get_session
+        u411.boto3.Session = FakeSession
+        u411.botocore.session.get_session = FakeBotocoreSession
+        FakeSession.created = []
+        FakeSession.listings = 0
+        FakeSession.zones = {'domain.tld': '/hostedzone/A', 'other.tld': '/hostedzone/B'}
+        self.unify411 = make_unify411({
+            'web': [instance('web', '10.0.0.1', ['dns=domain.tld', 'dns=sub.domain.tld', 'dns=other.tld'])],
+        })
+
+    def tearDown(self):
+        u411.boto3.Session, u411.botocore.session.get_session = self.session, self.get_session
+
+    def test_clients_and_zones_are_cached(self):
+        for _ in range(3):
+            self.unify411.refresh()
+        self.assertEquals(sorted(FakeSession.created), ['domain.tld', 'other.tld'])
+        self.assertEquals(FakeSession.listings, 2)
+        self.assertEquals(sorted(self.unify411._Unify411__aws_profiles), ['domain.tld', 'other.tld'])
+
+    def test_missing_zone_is_looked_up_again(self):
+        self.unify411.refresh()
+        error = botocore.exceptions.ClientError({'Error': {'Code': 'NoSuchHostedZone'}}, 'ChangeResourceRecordSets')
+        client = self.unify411._Unify411__aws_profiles['domain.tld']['connection']
+
+        def change_resource_record_sets(HostedZoneId, ChangeBatch):
+            raise error
+        client.change_resource_record_sets = change_resource_record_sets
+        self.unify411.update_route53()
+        FakeSession.zones['domain.tld'] = '/hostedzone/C'
+        self.unify411.refresh()
+        self.assertEquals(FakeSession.listings, 3)
+        self.assertEquals(self.unify411._Unify411__aws_profiles['domain.tld']['zoneID'], '/hostedzone/C')
+
+
+class TestZoneTrie(TestCase):
+
+    def test_shortest_parent_domain(self):
+        trie = u411.ZoneTrie(['domain.tld', 'sub.domain.tld', 'other.tld'])
+        self.assertEquals(trie.find('a.sub.domain.tld'), 'domain.tld')
+        self.assertEquals(trie.find('domain.tld'), 'domain.tld')
+        self.assertEquals(trie.find('other.tld'), 'other.tld')
+        self.assertIsNone(trie.find('tld'))
+        self.assertIsNone(trie.find('mydomain.tld'))
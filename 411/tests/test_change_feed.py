@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from tests import FakeConsul, u411
+
+
+def records(*names, **kwargs):
+    domain = kwargs.get('domain', 'domain.tld')
+    return {domain: set(("10.0.0.%d" % i, "%s.%s" % (name, domain)) for i, name in enumerate(names))}
+
+
+class TestChangeFeed(TestCase):
+
+    def setUp(self):
+        self.consul = FakeConsul()
+        self.master = u411.ChangeFeed('411/feed', history=3)
+        self.slave = u411.ChangeFeed('411/feed')
+
+    def test_nothing_published(self):
+        self.assertIsNone(self.slave.fetch(self.consul))
+
+    def test_slave_follows_the_deltas(self):
+        self.assertTrue(self.master.publish(self.consul, records('a', 'b')))
+        self.assertEquals(self.slave.fetch(self.consul), records('a', 'b'))
+        self.assertEquals(self.slave.version, 1)
+
+        self.assertTrue(self.master.publish(self.consul, records('a', 'c')))
+        self.assertTrue(self.master.publish(self.consul, dict(records('a', 'c'), **records('x', domain='other.tld'))))
+        gets = self.consul.kv.gets
+        self.assertEquals(self.slave.fetch(self.consul), dict(records('a', 'c'), **records('x', domain='other.tld')))
+        # version and one read per delta, no snapshot
+        self.assertEquals(self.consul.kv.gets - gets, 3)
+        self.assertEquals(self.slave.version, 3)
+
+    def test_one_version_reads_one_delta(self):
+        self.master = u411.ChangeFeed('411/feed')
+        for names in (['a'], ['b'], ['c'], ['d']):
+            self.master.publish(self.consul, records(*names))
+        self.slave.fetch(self.consul)
+        self.master.publish(self.consul, records('e'))
+        reads = []
+        get = self.consul.kv.get
+        self.consul.kv.get = lambda key, **kwargs: reads.append((key, kwargs)) or get(key, **kwargs)
+        self.assertEquals(self.slave.fetch(self.consul), records('e'))
+        self.assertEquals(reads, [('411/feed/version', {}), ('411/feed/deltas/%010d' % 5, {})])
+
+    def test_unchanged_records_are_not_published(self):
+        self.master.publish(self.consul, records('a'))
+        self.assertFalse(self.master.publish(self.consul, records('a')))
+        self.assertEquals(self.master.version, 1)
+
+    def test_gap_loads_the_snapshot(self):
+        self.master.publish(self.consul, records('a'))
+        self.slave.fetch(self.consul)
+        for names in (['b'], ['c'], ['d'], ['e']):
+            self.master.publish(self.consul, records(*names))
+        # history of 3: delta 2 is gone
+        self.assertNotIn('411/feed/deltas/%010d' % 2, self.consul.kv.data)
+        # snapshot of version 4 (every 3 versions with a history of 3), then delta 5
+        self.assertEquals(self.slave.fetch(self.consul), records('e'))
+        self.assertEquals(self.slave.version, 5)
+        # only the last snapshot is kept
+        self.assertEquals(sorted(key for key in self.consul.kv.data if '/snapshots/' in key), ['411/feed/snapshots/%010d/0000' % 4])
+
+    def test_snapshot_every_n_versions(self):
+        master = u411.ChangeFeed('411/feed', snapshot_every=5)
+        for i in range(1, 8):
+            master.publish(self.consul, records(*["host%d" % n for n in range(i)]))
+            self.assertEquals(master.snapshot_version, 1 if i < 6 else 6)
+        self.assertEquals(sorted(key for key in self.consul.kv.data if '/snapshots/' in key), ['411/feed/snapshots/%010d/0000' % 6])
+        # a new slave loads the snapshot and replays the deltas since it
+        self.assertEquals(self.slave.fetch(self.consul), records(*["host%d" % n for n in range(7)]))
+        self.assertEquals(self.slave.version, 7)
+
+    def test_missing_snapshot(self):
+        self.master.publish(self.consul, records('a'))
+        self.consul.kv.delete('411/feed/snapshot')
+        self.assertIsNone(self.slave.fetch(self.consul))
+
+    def test_unreadable_snapshot(self):
+        self.master.publish(self.consul, records('a'))
+        # the snapshot is being replaced on each read
+        self.consul.kv.delete('411/feed/snapshots/', recurse=True)
+        self.assertIsNone(self.slave.fetch(self.consul))
+
+    def test_master_restart(self):
+        self.master.publish(self.consul, records('a'))
+        self.master.publish(self.consul, records('b'))
+        self.slave.fetch(self.consul)
+        restarted = u411.ChangeFeed('411/feed')
+        self.assertTrue(restarted.publish(self.consul, records('c')))
+        self.assertEquals(restarted.version, 3)
+        self.assertEquals(self.slave.fetch(self.consul), records('c'))
+        self.assertEquals(sorted(key for key in self.consul.kv.data if '/snapshots/' in key), ['411/feed/snapshots/%010d/0000' % 3])
+
+    def test_big_snapshot_is_chunked(self):
+        self.master.CHUNK_SIZE = 1000
+        big = records(*["host%d" % i for i in range(2000)])
+        self.master.publish(self.consul, big)
+        self.assertGreater(len([key for key in self.consul.kv.data if '/snapshots/' in key]), 1)
+        self.assertEquals(self.slave.fetch(self.consul), big)
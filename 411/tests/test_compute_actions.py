@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from hypothesis import given, settings, strategies as st
+from tests import u411
+
+
+def reference_actions(wanted_dns_records, current_dns_records, aws_profiles):
+    """The original quadratic implementation"""
+    actions = {}
+    for domain in set(wanted_dns_records.keys()) | set(current_dns_records.keys()):
+        if domain not in aws_profiles:
+            continue
+        for ip, name in wanted_dns_records.get(domain, set()) - current_dns_records.get(domain, set()):
+            if not actions.get(domain):
+                actions[domain] = {}
+            if not actions[domain].get(name):
+                actions[domain][name] = {'action': 'CREATE', 'values': []}
+            actions[domain][name]['values'].append(ip)
+            for ex_ip, ex_name in current_dns_records.get(domain, set()):
+                if ex_name == name:
+                    actions[domain][name]['action'] = "UPSERT"
+                    if (ex_ip, ex_name) in wanted_dns_records.get(domain, set()):
+                        actions[domain][name]['values'].append(ex_ip)
+
+        for ip, name in current_dns_records.get(domain, set()) - wanted_dns_records.get(domain, set()):
+            if actions.get(domain, {}).get(name, {}).get('action', None) in ["CREATE", "UPSERT"]:
+                continue
+            if not actions.get(domain):
+                actions[domain] = {}
+            if not actions[domain].get(name):
+                actions[domain][name] = {'action': 'DELETE', 'values': []}
+            actions[domain][name]['values'].append(ip)
+            for ex_ip, ex_name in wanted_dns_records.get(domain, set()):
+                if ex_name == name and (ex_ip, ex_name) in current_dns_records.get(domain, set()):
+                    actions[domain][name]['action'] = "UPSERT"
+    return actions
+
+
+DOMAINS = ["a.tld", "b.tld", "c.tld"]
+# few names and values so records often share a name
+records = st.sets(st.tuples(st.sampled_from(["10.0.0.1", "10.0.0.2", "10.0.0.3", "haproxy.a.tld"]),
+                            st.sampled_from(["web.a.tld", "api.a.tld", "db.b.tld", "x.c.tld"])), max_size=10)
+states = st.dictionaries(st.sampled_from(DOMAINS), records, max_size=3)
+
+
+class TestComputeActions(TestCase):
+
+    @settings(max_examples=500)
+    @given(states, states, st.sets(st.sampled_from(DOMAINS)))
+    def test_same_as_reference(self, wanted, current, profiles):
+        self.assertEquals(u411.compute_actions(wanted, current, profiles),
+                          reference_actions(wanted, current, profiles))
+
+    def test_new_ip_for_existing_name_is_an_upsert(self):
+        wanted = {'a.tld': set([('10.0.0.1', 'web.a.tld'), ('10.0.0.2', 'web.a.tld')])}
+        current = {'a.tld': set([('10.0.0.1', 'web.a.tld'), ('10.0.0.3', 'old.a.tld')])}
+        actions = u411.compute_actions(wanted, current, ['a.tld'])
+        self.assertEquals(actions, {'a.tld': {'web.a.tld': {'action': 'UPSERT', 'values': ['10.0.0.2', '10.0.0.1']},
+                                              'old.a.tld': {'action': 'DELETE', 'values': ['10.0.0.3']}}})
+
+    def test_large_zone(self):
+        wanted = {'a.tld': set(("10.0.%d.%d" % (i // 256, i % 256), "host%d.a.tld" % i) for i in range(20000))}
+        current = {'a.tld': set(("10.1.%d.%d" % (i // 256, i % 256), "host%d.a.tld" % i) for i in range(10000, 30000))}
+        actions = u411.compute_actions(wanted, current, ['a.tld'])['a.tld']
+        self.assertEquals(len(actions), 30000)
+        self.assertEquals(actions['host15000.a.tld']['action'], 'UPSERT')
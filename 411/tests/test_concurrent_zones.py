@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from threading import Lock
+from time import sleep, time
+from tests import make_unify411, use_route53
+from tests.test_records_mirror import ListingRoute53, instance
+
+
+class SlowRoute53(ListingRoute53):
+    """ Route53 stub taking 0.2s per call and tracking how many calls run at once"""
+    lock = Lock()
+    running = 0
+    max_running = 0
+
+    def _call(self):
+        with SlowRoute53.lock:
+            SlowRoute53.running += 1
+            SlowRoute53.max_running = max(SlowRoute53.max_running, SlowRoute53.running)
+        sleep(0.2)
+        with SlowRoute53.lock:
+            SlowRoute53.running -= 1
+
+    def list_resource_record_sets(self, HostedZoneId, StartRecordName=None):
+        self._call()
+        return super(SlowRoute53, self).list_resource_record_sets(HostedZoneId, StartRecordName)
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        self._call()
+        return super(SlowRoute53, self).change_resource_record_sets(HostedZoneId, ChangeBatch)
+
+
+class TestConcurrentZones(TestCase):
+
+    def setUp(self):
+        SlowRoute53.running = SlowRoute53.max_running = 0
+        self.domains = ["domain%d.tld" % i for i in range(8)]
+        self.clients = dict((domain, SlowRoute53([])) for domain in self.domains)
+
+    def unify411(self, **kwargs):
+        unify411 = make_unify411({'web': [instance('web', '10.0.0.1', ['dns=%s' % domain for domain in self.domains])]}, **kwargs)
+        use_route53(unify411, self.clients)
+        return unify411
+
+    def test_zones_run_concurrently(self):
+        unify411 = self.unify411(aws_workers=8)
+        start = time()
+        unify411.refresh()
+        unify411.update_route53()
+        self.assertLess(time() - start, 1.2)
+        self.assertGreater(SlowRoute53.max_running, 1)
+        for domain, client in self.clients.items():
+            self.assertEquals(client.calls, [["web.%s" % domain]])
+        self.assertEquals(unify411.records_mirror.copy(),
+                          dict((domain, set([('10.0.0.1', 'web.%s' % domain)])) for domain in self.domains))
+
+    def test_requests_are_rate_limited(self):
+        unify411 = self.unify411(aws_workers=8, aws_rate=10)
+        start = time()
+        unify411.refresh()
+        unify411.update_route53()
+        # 16 requests at 10 per second, with a burst of 10
+        self.assertGreater(time() - start, 0.55)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from tests import make_unify411, u411
+
+
+RECORDS = {
+    'b.tld': set([('10.0.0.2', 'web.b.tld'), ('haproxy.b.tld', 'app.b.tld')]),
+    'a.tld': set([('10.0.0.1', 'web.a.tld'), ('10.0.0.1', 'api.a.tld')]),
+}
+
+# records the signals it receives, named dnsmasq-test so it can be found by name
+DUMMY_DNSMASQ = """
+import signal, sys, time
+open('/proc/self/comm', 'w').write('dnsmasq-test')
+def record(signum, frame):
+    with open(sys.argv[1], 'a') as f:
+        f.write('%d\\n' % signum)
+signal.signal(signal.SIGHUP, record)
+open(sys.argv[1] + '.ready', 'w').close()
+while True:
+    time.sleep(0.01)
+"""
+
+
+class TestDnsmasqOutput(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.tmp, 'autogenerated')
+        self.unify411 = make_unify411()
+        self.unify411.wanted_dns_records = dict((domain, set(records)) for domain, records in RECORDS.items())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def read(self, extension):
+        with open(self.prefix + extension) as f:
+            return f.read()
+
+    def inodes(self):
+        return dict((name, os.stat(os.path.join(self.tmp, name)).st_ino) for name in os.listdir(self.tmp))
+
+    def test_sorted_output(self):
+        hosts, cname = self.unify411.generate_output_file()
+        self.assertEquals(hosts, "10.0.0.1 api.a.tld api\n10.0.0.1 web.a.tld web\n10.0.0.2 web.b.tld web\n")
+        self.assertEquals(cname, "cname=app.b.tld,haproxy.b.tld\n")
+
+    def test_files(self):
+        self.assertEquals(self.unify411.generate_output_file(self.prefix),
+                          (True, [self.prefix + '.a.tld.hosts', self.prefix + '.b.tld.hosts']))
+        self.assertEquals(self.read('.a.tld.hosts'), "10.0.0.1 api.a.tld api\n10.0.0.1 web.a.tld web\n")
+        self.assertEquals(self.read('.b.tld.hosts'), "10.0.0.2 web.b.tld web\n")
+        self.assertEquals(self.read('.conf'), "addn-hosts=%s.a.tld.hosts\naddn-hosts=%s.b.tld.hosts\ncname=app.b.tld,haproxy.b.tld\n"
+                          % (self.prefix, self.prefix))
+        self.assertEquals(sorted(os.listdir(self.tmp)), ['autogenerated.a.tld.hosts', 'autogenerated.b.tld.hosts', 'autogenerated.conf'])
+
+    def test_unchanged_files_are_not_replaced(self):
+        self.unify411.generate_output_file(self.prefix)
+        inodes = self.inodes()
+        self.assertEquals(self.unify411.generate_output_file(self.prefix), (False, []))
+        # a new process hashes the existing files once
+        other = make_unify411()
+        other.wanted_dns_records = self.unify411.wanted_dns_records
+        self.assertEquals(other.generate_output_file(self.prefix), (False, []))
+        self.assertEquals(self.inodes(), inodes)
+
+    def test_only_changed_shard_is_replaced(self):
+        self.unify411.generate_output_file(self.prefix)
+        inodes = self.inodes()
+        self.unify411.wanted_dns_records['a.tld'].add(('10.0.0.3', 'db.a.tld'))
+        self.assertEquals(self.unify411.generate_output_file(self.prefix), (False, [self.prefix + '.a.tld.hosts']))
+        changed = [name for name, inode in self.inodes().items() if inodes[name] != inode]
+        self.assertEquals(changed, ['autogenerated.a.tld.hosts'])
+        self.assertIn("10.0.0.3 db.a.tld db\n", self.read('.a.tld.hosts'))
+        self.assertEquals(oct(os.stat(self.prefix + '.a.tld.hosts').st_mode & 0o777), oct(os.stat(self.prefix + '.conf').st_mode & 0o777))
+
+    def test_legacy_hosts_file_is_deleted(self):
+        with open(self.prefix + '.hosts', 'w') as f:
+            f.write("10.0.0.9 old.a.tld old\n")
+        self.unify411.generate_output_file(self.prefix)
+        self.assertEquals(sorted(os.listdir(self.tmp)),
+                          ['autogenerated.a.tld.hosts', 'autogenerated.b.tld.hosts', 'autogenerated.conf'])
+        self.assertEquals(self.unify411.generate_output_file(self.prefix), (False, []))
+
+    def test_shard_of_removed_domain_is_deleted(self):
+        self.unify411.generate_output_file(self.prefix)
+        self.unify411.wanted_dns_records['b.tld'] = set([('haproxy.b.tld', 'app.b.tld')])
+        self.assertEquals(self.unify411.generate_output_file(self.prefix), (True, []))
+        self.assertEquals(sorted(os.listdir(self.tmp)), ['autogenerated.a.tld.hosts', 'autogenerated.conf'])
+        self.assertNotIn('b.tld.hosts', self.read('.conf'))
+
+
+class TestReloadDnsmasq(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.signals = os.path.join(self.tmp, 'signals')
+        self.command = os.path.join(self.tmp, 'command')
+        self.run_cmd = 'echo run >> %s' % self.command
+        self.dnsmasq = subprocess.Popen([sys.executable, '-c', DUMMY_DNSMASQ, self.signals])
+        while not os.path.exists(self.signals + '.ready'):
+            time.sleep(0.01)
+        self.pid_file = os.path.join(self.tmp, 'dnsmasq.pid')
+        with open(self.pid_file, 'w') as f:
+            f.write("%d\n" % self.dnsmasq.pid)
+        self.unify411 = make_unify411()
+
+    def tearDown(self):
+        self.dnsmasq.kill()
+        self.dnsmasq.wait()
+        shutil.rmtree(self.tmp)
+
+    def received(self):
+        time.sleep(0.1)
+        if not os.path.exists(self.signals):
+            return []
+        with open(self.signals) as f:
+            return [int(line) for line in f]
+
+    def commands(self):
+        if not os.path.exists(self.command):
+            return 0
+        with open(self.command) as f:
+            return len(f.readlines())
+
+    def test_hosts_changes_are_signaled(self):
+        # the command always runs first to start dnsmasq
+        self.unify411.reload_dnsmasq(False, [], self.run_cmd, self.pid_file)
+        self.assertEquals(self.commands(), 1)
+        self.unify411.reload_dnsmasq(False, ['a.tld.hosts'], self.run_cmd, self.pid_file)
+        self.assertEquals(self.received(), [signal.SIGHUP])
+        self.assertEquals(self.commands(), 1)
+
+    def test_conf_changes_run_the_command(self):
+        self.unify411.reload_dnsmasq(True, [], self.run_cmd, self.pid_file)
+        self.unify411.reload_dnsmasq(True, ['a.tld.hosts'], self.run_cmd, self.pid_file)
+        self.assertEquals(self.commands(), 2)
+        self.assertEquals(self.received(), [])
+
+    def test_nothing_to_do_without_changes(self):
+        self.unify411.reload_dnsmasq(True, [], self.run_cmd, self.pid_file)
+        self.unify411.reload_dnsmasq(False, [], self.run_cmd, self.pid_file)
+        self.assertEquals(self.commands(), 1)
+        self.assertEquals(self.received(), [])
+
+    def test_process_lookup(self):
+        self.assertEquals(u411.find_dnsmasq_pid(self.pid_file), self.dnsmasq.pid)
+        self.assertEquals(u411.find_dnsmasq_pid(os.path.join(self.tmp, 'missing.pid'), name='dnsmasq-test'), self.dnsmasq.pid)
+        with open(self.pid_file, 'w') as f:
+            f.write("garbage")
+        self.assertEquals(u411.find_dnsmasq_pid(self.pid_file, name='dnsmasq-test'), self.dnsmasq.pid)
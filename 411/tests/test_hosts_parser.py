@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import os
+import random
+import shutil
+import tempfile
+from tests import u411
+
+
+def reference_parse(path):
+    """The original line by line parsing"""
+    records = []
+    for entry in open(path).read().split("\n"):
+        if entry.startswith("#"):
+            continue
+        try:
+            if path.endswith(".conf"):
+                if not entry.startswith("cname="):
+                    continue
+                fqdn, ip = entry.replace("cname=", "").split(",")
+                host = fqdn.split('.', 1)[0]
+            else:
+                ip, fqdn, host = entry.split()
+        except ValueError:
+            continue
+        records.append((ip, fqdn, host))
+    return records
+
+
+def random_lines(rand, count):
+    lines = []
+    for i in range(count):
+        lines.append(rand.choice([
+            "10.0.%d.%d host%d.domain.tld host%d" % (i // 256 % 256, i % 256, i, i),
+            "10.0.0.1\thost%d.domain.tld   host%d" % (i, i),
+            "cname=alias%d.domain.tld,host%d.domain.tld" % (i, i),
+            "# comment %d" % i,
+            "",
+            "10.0.0.1 too many fields here",
+            "addn-hosts=/etc/hosts",
+        ]))
+    return lines
+
+
+class TestHostsFileParser(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, lines):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w') as f:
+            f.write("\n".join(lines))
+        return path
+
+    def test_same_as_reference(self):
+        rand = random.Random(3)
+        for name in ('hosts', 'external.conf'):
+            path = self.write(name, random_lines(rand, 5000))
+            self.assertEquals(u411.HostsFileParser().parse(path), reference_parse(path))
+
+    def test_empty_file(self):
+        self.assertEquals(u411.HostsFileParser().parse(self.write('hosts', [])), [])
+
+    def test_unchanged_files_are_cached(self):
+        path = self.write('hosts', ["10.0.0.1 a.domain.tld a"])
+        parser = u411.HostsFileParser()
+        records = parser.parse(path)
+        self.assertIs(parser.parse(path), records)
+        self.write('hosts', ["10.0.0.1 a.domain.tld a", "10.0.0.2 b.domain.tld b"])
+        self.assertEquals(len(parser.parse(path)), 2)
@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import json
+from tests import make_unify411, use_route53
+from tests.test_records_mirror import ListingRoute53, instance
+
+
+class TestPlan(TestCase):
+
+    def setUp(self):
+        services = {'web%d' % i: [instance('web%d' % i, '10.0.%d.%d' % (i // 256, i % 256), ['dns=a.tld', 'dns=b.tld'])]
+                    for i in range(1200)}
+        self.unify411 = make_unify411(services, aws_rate=5)
+        self.clients = {'a.tld': ListingRoute53([{'Name': 'old.a.tld.', 'Type': 'A', 'ResourceRecords': [{'Value': '10.9.9.9'}]}]),
+                        'b.tld': ListingRoute53([])}
+        use_route53(self.unify411, self.clients)
+        self.unify411.refresh()
+
+    def test_plan(self):
+        plan = json.loads(json.dumps(self.unify411.plan_route53()))
+        self.assertEquals(sorted(plan['zones']), ['a.tld', 'b.tld'])
+        self.assertEquals(plan['api_calls'], 4)
+        self.assertEquals(plan['estimated_seconds'], 0)
+        zone = plan['zones']['a.tld']
+        self.assertEquals(zone['zone_id'], 'a.tld')
+        self.assertEquals([len(batch) for batch in zone['batches']], [1000, 201])
+        self.assertEquals(zone['records']['DELETE'], ['old.a.tld'])
+        self.assertEquals(len(zone['records']['CREATE']), 1200)
+        # nothing is sent while planning
+        self.assertEquals([client.calls for client in self.clients.values()], [[], []])
+
+    def test_apply_plan(self):
+        plan = json.loads(json.dumps(self.unify411.plan_route53()))
+        self.unify411.apply_plan(plan)
+        self.assertEquals(len(self.clients['a.tld'].calls), 2)
+        self.assertEquals(len(self.clients['b.tld'].calls), 2)
+        self.assertEquals(len(self.unify411.records_mirror.copy()['a.tld']), 1200)
+        self.unify411.refresh()
+        self.assertEquals(self.unify411.plan_route53()['api_calls'], 0)
+
+    def test_estimated_time(self):
+        self.unify411.rate_limiter.rate = 0.5
+        self.unify411.rate_limiter.capacity = 1
+        self.assertEquals(self.unify411.plan_route53()['estimated_seconds'], 6)
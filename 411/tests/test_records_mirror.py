@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import time
+from tests import make_unify411, u411, use_route53
+from tests.test_route53_batches import StubRoute53
+
+
+class ListingRoute53(StubRoute53):
+    """ Route53 stub serving record sets by pages of 2"""
+
+    def __init__(self, record_sets, **kwargs):
+        super(ListingRoute53, self).__init__(**kwargs)
+        self.record_sets = record_sets
+        self.list_calls = 0
+
+    def list_resource_record_sets(self, HostedZoneId, StartRecordName=None):
+        self.list_calls += 1
+        names = [record['Name'] for record in self.record_sets]
+        start = names.index(StartRecordName) if StartRecordName else 0
+        page = self.record_sets[start:start + 2]
+        truncated = start + 2 < len(self.record_sets)
+        return {'ResourceRecordSets': page, 'IsTruncated': truncated,
+                'NextRecordName': names[start + 2] if truncated else None}
+
+
+def instance(name, ip, tags):
+    return {'ServiceName': name, 'ServiceAddress': ip, 'ServicePort': 80, 'ServiceID': 'node:%s:80' % name, 'ServiceTags': tags}
+
+
+class TestRecordsMirror(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp, 'records.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_apply_changes(self):
+        mirror = u411.RecordsMirror()
+        mirror.reset(['domain.tld'], {'domain.tld': set([('10.0.0.1', 'a.domain.tld'), ('10.0.0.2', 'b.domain.tld')])})
+        mirror.apply('domain.tld', [u411.rr_set_change("UPSERT", "a.domain.tld", "A", ["10.0.0.3", "10.0.0.4"]),
+                                    u411.rr_set_change("DELETE", "b.domain.tld", "A", ["10.0.0.2"]),
+                                    u411.rr_set_change("CREATE", "c.domain.tld", "CNAME", ["a.domain.tld"])])
+        self.assertEquals(mirror.copy(), {'domain.tld': set([('10.0.0.3', 'a.domain.tld'), ('10.0.0.4', 'a.domain.tld'),
+                                                             ('a.domain.tld', 'c.domain.tld')])})
+
+    def test_needs_resync(self):
+        mirror = u411.RecordsMirror(resync_interval=60)
+        self.assertTrue(mirror.needs_resync(['domain.tld']))
+        mirror.reset(['domain.tld'], {})
+        self.assertFalse(mirror.needs_resync(['domain.tld']))
+        self.assertTrue(mirror.needs_resync(['domain.tld', 'other.tld']))
+        mirror.synced_at = time.time() - 61
+        self.assertTrue(mirror.needs_resync(['domain.tld']))
+        mirror.reset(['domain.tld'], {})
+        mirror.invalidate()
+        self.assertTrue(mirror.needs_resync(['domain.tld']))
+
+    def test_kept_between_runs(self):
+        mirror = u411.RecordsMirror(self.path)
+        mirror.reset(['domain.tld'], {'domain.tld': set([('10.0.0.1', 'a.domain.tld')])})
+        loaded = u411.RecordsMirror(self.path)
+        self.assertEquals(loaded.copy(), mirror.copy())
+        self.assertFalse(loaded.needs_resync(['domain.tld']))
+        with open(self.path, 'w') as f:
+            f.write("{broken")
+        self.assertTrue(u411.RecordsMirror(self.path).needs_resync(['domain.tld']))
+
+
+class TestIncrementalRefresh(TestCase):
+
+    def setUp(self):
+        services = {'web': [instance('web', '10.0.0.1', ['dns=domain.tld'])]}
+        self.unify411 = make_unify411(services)
+        self.client = ListingRoute53([
+            {'Name': 'domain.tld.', 'Type': 'NS', 'ResourceRecords': [{'Value': 'ns.aws'}]},
+            {'Name': 'old.domain.tld.', 'Type': 'A', 'ResourceRecords': [{'Value': '10.0.0.9'}]},
+            {'Name': 'web.domain.tld.', 'Type': 'A', 'ResourceRecords': [{'Value': '10.0.0.2'}]},
+        ])
+        use_route53(self.unify411, {'domain.tld': self.client})
+
+    def test_zones_are_listed_once(self):
+        self.unify411.refresh()
+        self.assertEquals(self.client.list_calls, 2)
+        self.unify411.update_route53()
+        self.assertEquals(len(self.client.calls), 1)
+
+        self.unify411.refresh()
+        self.assertEquals(self.client.list_calls, 2)
+        self.assertEquals(self.unify411.current_dns_records, {'domain.tld': set([('10.0.0.1', 'web.domain.tld')])})
+        self.unify411.update_route53()
+        self.assertEquals(len(self.client.calls), 1)
+
+    def test_rejected_change_triggers_a_resync(self):
+        self.client.bad_names = set(['old.domain.tld'])
+        self.unify411.refresh()
+        self.unify411.update_route53()
+        self.unify411.refresh()
+        self.assertEquals(self.client.list_calls, 4)
@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import botocore.exceptions
+from tests import make_unify411, u411
+
+
+class StubRoute53(object):
+    """ Route53 client stub rejecting the whole batch when it holds a bad record name"""
+
+    def __init__(self, bad_names=(), throttle=False):
+        self.bad_names = set(bad_names)
+        self.throttle = throttle
+        self.calls = []
+        self.applied = []
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        changes = ChangeBatch['Changes']
+        self.calls.append([change['ResourceRecordSet']['Name'] for change in changes])
+        if self.throttle:
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'Throttling'}}, 'ChangeResourceRecordSets')
+        if any(change['ResourceRecordSet']['Name'] in self.bad_names for change in changes):
+            raise botocore.exceptions.ClientError({'Error': {'Code': 'InvalidChangeBatch'}}, 'ChangeResourceRecordSets')
+        self.applied += changes
+
+
+def changes(count, action="CREATE", values=("10.0.0.1",)):
+    return [u411.rr_set_change(action, "host%d.domain.tld" % i, "A", values) for i in range(count)]
+
+
+class TestChangeBatches(TestCase):
+
+    def test_small_changes_fit_in_one_batch(self):
+        self.assertEquals(len(u411.change_batches(changes(300))), 1)
+
+    def test_split_on_record_count(self):
+        batches = u411.change_batches(changes(2500))
+        self.assertEquals([len(batch) for batch in batches], [1000, 1000, 500])
+        # upserted values count twice
+        batches = u411.change_batches(changes(600, action="UPSERT"))
+        self.assertEquals([len(batch) for batch in batches], [500, 100])
+
+    def test_split_on_value_chars(self):
+        batches = u411.change_batches(changes(100, values=["a" * 1000]))
+        self.assertEquals([len(batch) for batch in batches], [32, 32, 32, 4])
+
+    def test_order_is_kept(self):
+        _changes = changes(2500)
+        self.assertEquals(sum(u411.change_batches(_changes), []), _changes)
+
+
+class TestChangeRRSets(TestCase):
+
+    def setUp(self):
+        self.unify411 = make_unify411()
+
+    def test_one_call_per_batch(self):
+        client = StubRoute53()
+        self.unify411._change_rr_sets(client, "ZONE", changes(300), True)
+        self.assertEquals(len(client.calls), 1)
+        self.assertEquals(len(client.applied), 300)
+
+    def test_failed_batch_is_bisected(self):
+        client = StubRoute53(bad_names=["host5.domain.tld"])
+        self.unify411._change_rr_sets(client, "ZONE", changes(16), True)
+        self.assertEquals(len(client.applied), 15)
+        self.assertNotIn("host5.domain.tld", [change['ResourceRecordSet']['Name'] for change in client.applied])
+        # 16 -> 8 -> 4 -> 2 -> 1: one failing call per level and their valid halves
+        self.assertEquals(len(client.calls), 9)
+
+    def test_throttled_batch_is_not_bisected(self):
+        client = StubRoute53(throttle=True)
+        self.unify411._change_rr_sets(client, "ZONE", changes(16), True)
+        self.assertEquals(len(client.calls), 1)
+
+    def test_failed_delete_is_retried_with_default_ttl(self):
+        client = StubRoute53(bad_names=["host0.domain.tld"])
+        self.unify411._change_rr_sets(client, "ZONE", changes(1, action="DELETE"), True)
+        self.assertEquals(len(client.calls), 2)
+
+    def test_nothing_is_sent_without_commit(self):
+        client = StubRoute53()
+        self.unify411._change_rr_sets(client, "ZONE", changes(10), False)
+        self.assertEquals(client.calls, [])
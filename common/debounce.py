@@ -0,0 +1,68 @@
+import traceback
+
+from threading import Thread, Condition
+from time import time
+
+
+class Debouncer(object):
+    """
+    Debouncer coalesces bursts of events into as few calls as possible.
+
+    The first event after a quiet period runs right away (leading edge). The events
+    arriving during a burst are coalesced and the latest one always runs once no event
+    came for `window` seconds (trailing edge), or at most `max_wait` seconds after the
+    first coalesced event so that a never ending burst still gets processed.
+    """
+    def __init__(self, window, max_wait=None, leading=True, name="Debouncer"):
+        self.window = float(window)
+        self.max_wait = float(max_wait) if max_wait is not None else None
+        self.leading = leading
+        self._cond = Condition()
+        self._pending = None
+        self._first = None
+        self._last = None
+        self._quiet_at = 0
+        self._thread = Thread(name=name, target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def newEvent(self, func, kwargs={}):
+        """
+        newEvent Triggered, replaces the pending one if any.
+        """
+        with self._cond:
+            now = time()
+            leading = self.leading and self._pending is None and now >= self._quiet_at
+            self._pending = {'func': func, 'args': kwargs, 'leading': leading}
+            if self._first is None:
+                self._first = now
+            self._last = now
+            self._quiet_at = now + self.window
+            self._cond.notify()
+
+    def _deadline(self):
+        deadline = self._last + self.window
+        if self.max_wait is not None:
+            deadline = min(deadline, self._first + self.max_wait)
+        return deadline
+
+    def _run(self):
+        """
+        internal runloop that will fire the pending task at the right time.
+        """
+        while True:
+            with self._cond:
+                while self._pending is None:
+                    self._cond.wait()
+                while not self._pending['leading'] and time() < self._deadline():
+                    self._cond.wait(self._deadline() - time())
+                task = self._pending
+                self._pending = None
+                self._first = None
+            try:
+                if task['args']:
+                    task['func'](**task['args'])
+                else:
+                    task['func']()
+            except Exception:
+                traceback.print_exc()
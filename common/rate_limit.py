@@ -0,0 +1,38 @@
+from threading import Lock
+from time import sleep, time
+
+
+class TokenBucket(object):
+    """
+    Thread safe token bucket limiting the rate of API requests.
+
+    Tokens are added at `rate` per second up to `capacity` (the allowed burst, defaults
+    to one second worth of requests). acquire() blocks until enough tokens are available.
+    A rate of 0 (or None) disables the limit.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate or 0)
+        self.capacity = float(capacity or max(self.rate, 1))
+        self._tokens = self.capacity
+        self._updated = time()
+        self._lock = Lock()
+
+    def estimate(self, tokens):
+        """ Return the seconds needed to acquire tokens from a full bucket"""
+        if self.rate <= 0:
+            return 0
+        return max(0, tokens - self.capacity) / self.rate
+
+    def acquire(self, tokens=1):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait = (tokens - self._tokens) / self.rate
+            sleep(wait)
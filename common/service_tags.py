@@ -0,0 +1,147 @@
+from collections import OrderedDict
+from threading import Lock
+
+
+def convert_tags(tags):
+    """ Return a dict of tags from array, repeated keys are turned into lists"""
+    _tags = {}
+    if tags:
+        for tag in tags:
+            if len(tag.split("=", 1)) != 2:
+                continue
+            k, v = tag.split("=", 1)
+            if k not in _tags:
+                _tags[k] = v
+            else:
+                if not isinstance(_tags[k], list):
+                    _tags[k] = [_tags[k]]
+                _tags[k].append(v)
+    return _tags
+
+
+class Service(object):
+    """
+    Parsed service instance.
+
+    Records are shared between the callers of parse_service() and must not be modified.
+    `tags` is the dict of the raw tags, `domains` the tuple of the dns values. For load
+    balanced services (having a vhost) `proto` and `ssl` are resolved from the tags and
+    the backend port like switchboard expects them. Unknown attributes are looked up in
+    the tags so templates can still use any custom tag.
+    """
+    __slots__ = ('key', 'name', 'ip', 'port', 'id', 'tags', 'proto', 'proto_port', 'vhost', 'domains', 'ssl',
+                 'check', 'balance', 'url_prefix')
+
+    def __init__(self, name, ip, port, id, tags, key=None):
+        self.key = key or (id, name, ip, port, tuple(tags or ()))
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.id = id
+        self.tags = convert_tags(tags)
+        self.vhost = self.tags.get('vhost')
+        dns = self.tags.get('dns')
+        self.domains = tuple(dns) if isinstance(dns, list) else (dns,) if dns else ()
+        self.check = self.tags.get('check')
+        self.balance = self.tags.get('balance')
+        self.url_prefix = self.tags.get('url_prefix')
+        self.ssl = self.tags.get('ssl')
+        self.proto = None
+        self.proto_port = None
+        if self.vhost:
+            self._resolve_proto()
+
+    def _resolve_proto(self):
+        backend_guessed_port = (self.id or "").split(":")[-1]
+        # default values http / 80 or containers port
+        proto = "http"
+        port = self.tags.get(proto, backend_guessed_port)
+
+        # if nothing is provided but the backend port is 443 then bridge
+        if 'http' not in self.tags and 'https' not in self.tags and 'tcp' not in self.tags:
+            if backend_guessed_port == '443':
+                proto = 'https'
+                self.ssl = 'bridge'
+
+        if "https" in self.tags:
+            proto = "https"
+            port = self.tags.get(proto, backend_guessed_port)
+
+        if "tcp" in self.tags:
+            proto = "tcp"
+            port = self.tags.get(proto, backend_guessed_port)
+
+        if 'ssl' not in self.tags and not self.ssl:
+            if proto == 'https':
+                if backend_guessed_port == '443':
+                    self.ssl = 'bridge'
+                else:
+                    self.ssl = 'offloading'
+
+        self.proto = proto
+        self.proto_port = port
+
+    def _proto(self, proto):
+        if self.proto == proto:
+            return self.proto_port
+        return self.tags.get(proto)
+
+    @property
+    def http(self):
+        return self._proto('http')
+
+    @property
+    def https(self):
+        return self._proto('https')
+
+    @property
+    def tcp(self):
+        return self._proto('tcp')
+
+    @property
+    def dns(self):
+        """ The dns tag as it was given: a string, or a list if repeated"""
+        return self.tags.get('dns')
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __getattr__(self, key):
+        if key == 'tags':
+            raise AttributeError(key)
+        try:
+            return self.tags[key]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __repr__(self):
+        return "Service(%r, %r, %r, %r, %r)" % self.key[:5]
+
+
+class ServiceCache(object):
+    """
+    LRU cache of parsed services keyed on (id, name, ip, port, tags).
+    """
+    def __init__(self, size=50000):
+        self.size = size
+        self.lock = Lock()
+        self._services = OrderedDict()
+
+    def get(self, name, ip, port, id, tags):
+        key = (id, name, ip, port, tuple(tags or ()))
+        with self.lock:
+            service = self._services.pop(key, None)
+            if service is None:
+                service = Service(name, ip, port, id, tags, key)
+            self._services[key] = service
+            if len(self._services) > self.size:
+                self._services.popitem(last=False)
+        return service
+
+
+_cache = ServiceCache()
+
+
+def parse_service(name, ip, port, id, tags):
+    """ Return the parsed (and memoized) Service for an instance"""
+    return _cache.get(name, ip, port, id, tags)
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from time import sleep, time
+from debounce import Debouncer
+
+
+class TestDebouncer(TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def record(self, value=None):
+        self.calls.append((value, time()))
+
+    def values(self):
+        return [value for value, _ in self.calls]
+
+    def test_leading_edge_runs_right_away(self):
+        debouncer = Debouncer(0.2)
+        start = time()
+        debouncer.newEvent(self.record, {'value': 1})
+        sleep(0.05)
+        self.assertEquals(self.values(), [1])
+        self.assertLess(self.calls[0][1] - start, 0.05)
+
+    def test_burst_is_coalesced_and_last_event_runs(self):
+        debouncer = Debouncer(0.1)
+        for i in range(10):
+            debouncer.newEvent(self.record, {'value': i})
+            sleep(0.01)
+        sleep(0.3)
+        self.assertEquals(self.values(), [0, 9])
+
+    def test_events_during_a_run_are_not_lost(self):
+        def slow(value):
+            self.record(value)
+            sleep(0.1)
+        debouncer = Debouncer(0.05)
+        debouncer.newEvent(slow, {'value': 1})
+        sleep(0.02)
+        debouncer.newEvent(slow, {'value': 2})
+        sleep(0.4)
+        self.assertEquals(self.values(), [1, 2])
+
+    def test_max_wait_bounds_an_endless_burst(self):
+        debouncer = Debouncer(0.1, max_wait=0.2, leading=False)
+        start = time()
+        while time() - start < 0.5:
+            debouncer.newEvent(self.record, {'value': 'burst'})
+            sleep(0.02)
+        self.assertGreaterEqual(len(self.calls), 2)
+        self.assertLess(self.calls[0][1] - start, 0.3)
+
+    def test_failing_task_does_not_stop_the_loop(self):
+        def fail():
+            raise ValueError("boom")
+        debouncer = Debouncer(0.05)
+        debouncer.newEvent(fail)
+        sleep(0.1)
+        debouncer.newEvent(self.record, {'value': 1})
+        sleep(0.1)
+        self.assertEquals(self.values(), [1])
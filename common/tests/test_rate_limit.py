@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from threading import Thread
+from time import time
+from rate_limit import TokenBucket
+
+
+class TestTokenBucket(TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(20, capacity=5)
+        start = time()
+        for _ in range(5):
+            bucket.acquire()
+        self.assertLess(time() - start, 0.05)
+        for _ in range(10):
+            bucket.acquire()
+        self.assertGreater(time() - start, 0.45)
+
+    def test_shared_between_threads(self):
+        bucket = TokenBucket(50, capacity=1)
+        start = time()
+        threads = [Thread(target=lambda: [bucket.acquire() for _ in range(5)]) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # 20 tokens, 1 available right away
+        self.assertGreater(time() - start, 19 / 50.0 - 0.02)
+
+    def test_no_limit(self):
+        bucket = TokenBucket(0)
+        start = time()
+        for _ in range(1000):
+            bucket.acquire()
+        self.assertLess(time() - start, 0.1)
+
+    def test_estimate(self):
+        self.assertEquals(TokenBucket(5).estimate(3), 0)
+        self.assertEquals(TokenBucket(5).estimate(305), 60)
+        self.assertEquals(TokenBucket(0).estimate(300), 0)
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from service_tags import Service, ServiceCache, convert_tags, parse_service
+
+
+class TestConvertTags(TestCase):
+
+    def test_repeated_keys_become_lists(self):
+        tags = convert_tags(['dns=a.com', 'dns=b.com', 'vhost=www', 'noequal', 'url=/a=b'])
+        self.assertEquals(tags, {'dns': ['a.com', 'b.com'], 'vhost': 'www', 'url': '/a=b'})
+
+    def test_no_tags(self):
+        self.assertEquals(convert_tags(None), {})
+
+
+class TestService(TestCase):
+
+    def test_defaults_to_http_on_backend_port(self):
+        service = Service('web', '10.0.0.1', 8080, 'host:web:8080', ['vhost=www', 'dns=a.com'])
+        self.assertEquals(service.proto, 'http')
+        self.assertEquals(service.http, '8080')
+        self.assertEquals(service.domains, ('a.com',))
+        self.assertIsNone(service.ssl)
+
+    def test_backend_on_443_is_bridged(self):
+        service = Service('web', '10.0.0.1', 443, 'host:web:443', ['vhost=www'])
+        self.assertEquals(service.proto, 'https')
+        self.assertEquals(service.https, '443')
+        self.assertEquals(service.ssl, 'bridge')
+
+    def test_https_is_offloaded_unless_ssl_is_given(self):
+        service = Service('web', '10.0.0.1', 8080, 'host:web:8080', ['vhost=www', 'https=8443'])
+        self.assertEquals(service.https, '8443')
+        self.assertEquals(service.ssl, 'offloading')
+        service = Service('web', '10.0.0.1', 8080, 'host:web:8080', ['vhost=www', 'https=8443', 'ssl=passthrough'])
+        self.assertEquals(service.ssl, 'passthrough')
+
+    def test_proto_is_only_resolved_for_vhosts(self):
+        service = Service('db', '10.0.0.1', 5432, 'host:db:5432', ['dns=a.com', 'dns=b.com', 'ssl=true'])
+        self.assertIsNone(service.proto)
+        self.assertIsNone(service.http)
+        self.assertEquals(service.ssl, 'true')
+        self.assertEquals(service.domains, ('a.com', 'b.com'))
+        self.assertEquals(service.dns, ['a.com', 'b.com'])
+
+    def test_unknown_attributes_come_from_tags(self):
+        service = Service('web', '10.0.0.1', 80, 'host:web:80', ['vhost=www', 'custom=value'])
+        self.assertEquals(service.custom, 'value')
+        self.assertEquals(service.get('custom'), 'value')
+        self.assertEquals(service.get('missing', 'default'), 'default')
+        self.assertRaises(AttributeError, getattr, service, 'missing')
+
+
+class TestServiceCache(TestCase):
+
+    def test_same_instance_is_memoized(self):
+        cache = ServiceCache()
+        first = cache.get('web', '10.0.0.1', 80, 'host:web:80', ['vhost=www'])
+        self.assertIs(cache.get('web', '10.0.0.1', 80, 'host:web:80', ['vhost=www']), first)
+        self.assertIsNot(cache.get('web', '10.0.0.2', 80, 'host:web:80', ['vhost=www']), first)
+        self.assertIsNot(cache.get('web', '10.0.0.1', 80, 'host:web:80', ['vhost=api']), first)
+
+    def test_least_recently_used_is_evicted(self):
+        cache = ServiceCache(size=2)
+        a = cache.get('a', '10.0.0.1', 80, 'a', [])
+        b = cache.get('b', '10.0.0.1', 80, 'b', [])
+        self.assertIs(cache.get('a', '10.0.0.1', 80, 'a', []), a)
+        cache.get('c', '10.0.0.1', 80, 'c', [])
+        self.assertIs(cache.get('a', '10.0.0.1', 80, 'a', []), a)
+        self.assertIsNot(cache.get('b', '10.0.0.1', 80, 'b', []), b)
+
+    def test_parse_service_uses_the_shared_cache(self):
+        self.assertIs(parse_service('web', '10.0.0.1', 80, 'host:web:80', ['vhost=www']),
+                      parse_service('web', '10.0.0.1', 80, 'host:web:80', ['vhost=www']))
@@ -0,0 +1,220 @@
+#! /usr/bin/env python
+
+import docopt
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import timeit
+
+import switchboard
+
+# switchboard adds the shared modules to the path
+import service_tags
+
+
+STAGES = ['filter', 'parse_cold', 'parse_warm', 'render_cold', 'render_warm']
+
+# share of each kind of service in the synthetic catalogs
+_KINDS = [('http', 40), ('http_prefix', 15), ('https', 15), ('bridge', 5), ('passthrough', 5), ('tcp', 10),
+          ('no_vhost', 10)]
+
+
+def _pick_kind(rand):
+    """ Pick a kind of service according to the _KINDS weights"""
+    n = rand.randint(1, sum(weight for _, weight in _KINDS))
+    for kind, weight in _KINDS:
+        n -= weight
+        if n <= 0:
+            return kind
+
+
+def synthetic_catalog(size, seed=42):
+    """ Return a catalog of `size` instances shaped like get_services() ones"""
+    rand = random.Random(seed)
+    services = []
+    number = 0
+    while len(services) < size:
+        number += 1
+        kind = _pick_kind(rand)
+        name = "%s-%d" % (kind, number)
+        port = {'bridge': 443, 'passthrough': 443}.get(kind, rand.choice([80, 3000, 8080, 9000]))
+        tags = ["dns=domain%d.tld" % rand.randint(0, 9)]
+        if rand.random() < 0.2:
+            tags.append("dns=alias%d.tld" % rand.randint(0, 9))
+        tags.append(rand.choice(["production", "production", "production", "staging"]))
+        if kind != 'no_vhost':
+            tags.append("vhost=app%d" % (number // 3))
+        if kind == 'http_prefix':
+            tags.append("url_prefix=/api%d" % number)
+        elif kind == 'https':
+            tags.append("https=443")
+        elif kind == 'passthrough':
+            tags += ["https=443", "ssl=pass-through"]
+        elif kind == 'tcp':
+            tags.append("tcp=%d" % (5000 + number % 50))
+        if rand.random() < 0.1:
+            tags.append("check=disabled")
+        if rand.random() < 0.05:
+            tags.append("maintenance=true")
+        for instance in range(min(rand.randint(1, 5), size - len(services))):
+            host = "node%d" % rand.randint(0, 255)
+            ip = "10.%d.%d.%d" % (number // 65536 % 256, number // 256 % 256, number % 256)
+            services.append(switchboard._service_record(name, ip, port + instance,
+                                                        "%s:%s:%d" % (host, name, port + instance), list(tags)))
+    return services
+
+
+def _peak_rss():
+    """ Peak resident memory of the process in MB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def _timed(func, repeat):
+    """ Return (best time in second, result of the last run) of `repeat` runs of func"""
+    best, result = None, None
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        result = func()
+        elapsed = timeit.default_timer() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def measure(size, template, repeat=3, seed=42):
+    """
+    Time each stage of the render path on a synthetic catalog of `size` instances.
+
+    Cold stages start from empty service / fragment caches, warm ones render the same
+    catalog again like when an unrelated consul event triggers a new rendering.
+    Memory is the growth of the peak RSS during the stage, so it's only meaningful
+    when each size runs in a fresh process (see main).
+    """
+    services = synthetic_catalog(size, seed)
+    switchboard._args = {'--has': [], '--has-not': ['staging'], '--match': [], '--no-match': ['^maintenance='],
+                         '--bind-ip': '0.0.0.0'}
+    switchboard._filter = None
+    env = switchboard._environment()
+
+    def parse_cold():
+        service_tags._cache = service_tags.ServiceCache(size=max(size, 50000))
+        return switchboard.parse_tags(filtered)
+
+    def render_cold():
+        env.fragment_cache.clear()
+        return switchboard._generate_conf(filtered, template)
+
+    results = {'size': size, 'stages': {}}
+    filtered = None
+    for stage, func in [('filter', lambda: switchboard.filter_services(services)),
+                        ('parse_cold', parse_cold),
+                        ('parse_warm', lambda: switchboard.parse_tags(filtered)),
+                        ('render_cold', render_cold),
+                        ('render_warm', lambda: switchboard._generate_conf(filtered, template))]:
+        rss = _peak_rss()
+        elapsed, result = _timed(func, repeat)
+        if stage == 'filter':
+            filtered = result
+        results['stages'][stage] = {'seconds': elapsed,
+                                    'per_second': size / elapsed if elapsed else None,
+                                    'memory_mb': _peak_rss() - rss}
+    results['peak_memory_mb'] = _peak_rss()
+    results['rendered_bytes'] = len(switchboard._generate_conf(filtered, template))
+    return results
+
+
+def _measure_in_child(args):
+    return measure(*args)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return the stages slower (or using more memory) than the baseline by more than tolerance (%).
+
+    Differences under 5ms or 1MB are never reported.
+    """
+    regressions = []
+    ratio = 1 + tolerance / 100.0
+    for result in results:
+        reference = baseline.get(str(result['size']))
+        if not reference:
+            continue
+        for stage, values in sorted(result['stages'].items()):
+            before = reference['stages'].get(stage)
+            if not before:
+                continue
+            # ignore the timer noise of the small catalogs
+            if values['seconds'] > max(before['seconds'] * ratio, before['seconds'] + 0.005):
+                regressions.append("%d %s: %.4fs (baseline %.4fs)" % (result['size'], stage, values['seconds'],
+                                                                      before['seconds']))
+            if values['memory_mb'] > max(before['memory_mb'] * ratio, before['memory_mb'] + 1):
+                regressions.append("%d %s: %.1fMB (baseline %.1fMB)" % (result['size'], stage, values['memory_mb'],
+                                                                        before['memory_mb']))
+    return regressions
+
+
+def report(results):
+    """ Return the results as a text table"""
+    lines = ["%8s  %-12s %10s %14s %10s" % ("size", "stage", "seconds", "instances/s", "memory MB")]
+    for result in results:
+        for stage in STAGES:
+            values = result['stages'][stage]
+            lines.append("%8d  %-12s %10.4f %14.0f %10.1f" % (result['size'], stage, values['seconds'],
+                                                              values['per_second'] or 0, values['memory_mb']))
+        lines.append("%8d  %-12s %10s %14s %10.1f" % (result['size'], "peak", "", "", result['peak_memory_mb']))
+    return "\n".join(lines)
+
+
+def main():
+    """Switchboard benchmark, time the render path on synthetic catalogs.
+
+    Usage: bench.py [options]
+
+    Options:
+      -h, --help              Show this screen.
+      -s, --sizes n,...       Comma separated catalog sizes (number of instances) [default: 100,1000,10000,50000].
+      -t, --template file     The template to render [default: haproxy.conf.jinja2].
+      -r, --repeat n          Number of runs of each stage, the fastest one is kept [default: 3].
+      --seed n                Seed of the synthetic catalogs [default: 42].
+      -b, --baseline file     Baseline to compare the results to [default: bench_baseline.json].
+      --save-baseline         Save the results as the new baseline instead of comparing them.
+      --tolerance pct         Slowdown (in percent) over the baseline reported as a regression [default: 20].
+      --json                  Print the results as json.
+
+    """
+    args = docopt.docopt(main.__doc__)
+    # templates are loaded relatively to the working directory
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    results = []
+    for size in [int(size) for size in args['--sizes'].split(',')]:
+        # a fresh process per size so peak memory and caches are not shared between sizes
+        pool = multiprocessing.Pool(1)
+        try:
+            results.append(pool.apply(_measure_in_child, [(size, args['--template'], int(args['--repeat']),
+                                                           int(args['--seed']))]))
+        finally:
+            pool.terminate()
+
+    print(json.dumps(results, indent=2, sort_keys=True) if args['--json'] else report(results))
+
+    if args['--save-baseline']:
+        with open(args['--baseline'], 'w') as f:
+            json.dump(dict((str(result['size']), result) for result in results), f, indent=2, sort_keys=True)
+        print("Baseline saved to %s" % args['--baseline'])
+        return 0
+
+    if not os.path.exists(args['--baseline']):
+        print("No baseline found at %s, run with --save-baseline first." % args['--baseline'])
+        return 0
+    with open(args['--baseline']) as f:
+        regressions = compare(results, json.load(f), float(args['--tolerance']))
+    for regression in regressions:
+        print("REGRESSION %s" % regression)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
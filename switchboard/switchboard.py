@@ -3,49 +3,40 @@
 import consul
 import contextlib
 import docopt
+import hashlib
+import itertools
 import jinja2
+import json
+import os
 import re
+import requests.adapters
+import socket
+import shutil
 import subprocess
 import sys
+import tempfile
 
-from threading import Thread
+from collections import OrderedDict
+from jinja2 import nodes
+from jinja2.ext import Extension
+from multiprocessing.pool import ThreadPool
+from threading import Thread, Lock
 from Queue import Queue
 from time import sleep
 
-_args = None
-
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from debounce import Debouncer
+from service_tags import Service, parse_service
 
-class AntiFlapping(object):
-    """
-    AntiFlapping class to process event in a timely maneer
-    """
-    def __init__(self, window):
-        self.window = window
-        self.tasks = Queue(maxsize=1)
-        self._window_ended = True
-        self._thread = Thread(name="AntiFlapping", target=self._run)
-        self._thread.start()
-
-    def newEvent(self, func, kwargs={}):
-        """
-        newEvent Triggered.
-        """
-        if not self.tasks.full() and self._window_ended:
-            self.tasks.put({'func': func, 'args':kwargs})
+_args = None
+_runtime = None
+# the first render of the process always writes and reloads, the config on disk may be from a previous run
+_applied = False
+# renders run from the services and the kv listeners, one at a time
+_apply_lock = Lock()
 
-    def _run(self):
-        """
-        internal runloop that will fire tasks in order.
-        """
-        while True:
-            task = self.tasks.get()
-            self._window_ended = False
-            sleep(self.window)
-            self._window_ended = True
-            if task['args']:
-                task['func'](**task['args'])
-            else:
-                task['func']()
+# how many renders ended up in a reload, were applied at runtime, skipped because nothing changed or invalid
+counters = {'renders': 0, 'reloads': 0, 'reloads_avoided': 0, 'runtime_updates': 0, 'invalid': 0}
 
 
 @contextlib.contextmanager
@@ -62,95 +53,157 @@ def file_or_stdout(filename=None):
             fh.close()
 
 
+def write_config(filename, conf, check_cmd=None):
+    """
+    Atomically replace filename with conf: the configuration is written to a temporary
+    file next to it, validated with check_cmd ({} is replaced by the temporary file path),
+    synced and renamed. Return False if the validation failed.
+    """
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp = tempfile.mkstemp(prefix=".%s." % os.path.basename(filename), dir=directory)
+    try:
+        with os.fdopen(fd, "w") as fh:
+            fh.write(conf.encode('utf-8'))
+            fh.flush()
+            os.fsync(fh.fileno())
+        if os.path.isfile(filename):
+            shutil.copymode(filename, tmp)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(tmp, 0o666 & ~umask)
+        if check_cmd and subprocess.call(check_cmd.replace("{}", tmp), shell=True) != 0:
+            print("> Rendered configuration is invalid, keeping the current one")
+            os.remove(tmp)
+            return False
+        os.rename(tmp, filename)
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    _fsync_directory(directory)
+    return True
+
+
+def keep_last_good(filename, conf):
+    """ Save conf as the last known good configuration of filename"""
+    write_config("%s.last-good" % filename, conf)
+
+
+def rollback_config(filename):
+    """ Restore the last known good configuration, return its content or None if there is none"""
+    if not os.path.isfile("%s.last-good" % filename):
+        return None
+    conf = open("%s.last-good" % filename).read().decode('utf-8')
+    write_config(filename, conf)
+    return conf
+
+
+def _fsync_directory(directory):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class _AnyOf(object):
+    """ Match a tag against a list of compiled regular expressions"""
+    def __init__(self, regexes):
+        self.regexes = regexes
+
+    def match(self, tag):
+        return any(regex.match(tag) for regex in self.regexes)
+
+
+class ServiceFilter(object):
+    """
+    ServiceFilter applies the --has / --match includes and the --has-not / --no-match excludes.
+
+    The regular expressions are compiled once, and only evaluated once per distinct tag
+    (results are memoized). Services are looked up through a tag -> positions index and
+    includes / excludes are computed with set operations.
+    """
+    def __init__(self, has=None, has_not=None, match=None, no_match=None):
+        self.has = set(has or [])
+        self.has_not = set(has_not or [])
+        self.match = self._compile(match)
+        self.no_match = self._compile(no_match)
+        self._matched = {}
+
+    @staticmethod
+    def _compile(regexes):
+        if not regexes:
+            return None
+        compiled = [re.compile(regex) for regex in regexes]
+        # expressions with inline flags or backreferences can't be combined in one alternation
+        if any(regex.flags & ~re.UNICODE or re.search(r'\\\d|\(\?P=', regex.pattern) for regex in compiled):
+            return _AnyOf(compiled)
+        try:
+            return re.compile("|".join("(?:%s)" % regex for regex in regexes))
+        except re.error:
+            # e.g. the same group name used by several expressions
+            return _AnyOf(compiled)
+
+    def _positions(self, index, regex):
+        """ Return the positions of the services having a tag matching regex"""
+        positions = set()
+        for tag, services in index.iteritems():
+            key = (regex, tag)
+            if key not in self._matched:
+                if len(self._matched) > 100000:
+                    self._matched.clear()
+                self._matched[key] = bool(regex.match(tag))
+            if self._matched[key]:
+                positions |= services
+        return positions
+
+    def __call__(self, svcs):
+        index = {}
+        for position, sv in enumerate(svcs):
+            for tag in sv["tags"] or []:
+                index.setdefault(tag, set()).add(position)
+
+        # includes keep the --has matches first, then the --match ones
+        has = set()
+        for tag in self.has:
+            has |= index.get(tag, set())
+        if self.match:
+            matched = sorted(self._positions(index, self.match) - has)
+        else:
+            matched = []
+        if self.has or self.match:
+            positions = sorted(has) + matched
+        else:
+            positions = range(len(svcs))
+
+        excluded = set()
+        for tag in self.has_not:
+            excluded |= index.get(tag, set())
+        if self.no_match:
+            excluded |= self._positions(index, self.no_match)
+
+        return [svcs[position] for position in positions if position not in excluded]
+
+
+_filter = None
+
+
 def filter_services(svcs):
-    filtered = []
-
-    # filter includes
-    if _args['--has']:
-        for sv in svcs:
-            for inc in _args['--has']:
-                if inc in sv["tags"] and sv not in filtered:
-                    filtered.append(sv)
-
-    if _args['--match']:
-        for sv in svcs:
-            for regex in _args['--match']:
-                for tag in sv["tags"]:
-                    if re.match(regex, tag) and sv not in filtered:
-                        filtered.append(sv)
-
-    if not filtered and not _args['--has'] and not _args['--match']:
-        filtered = svcs
-
-    if _args['--has-not']:
-        for sv in list(filtered):  # operate on a copy, otherwise .remove would change the list under our feet
-            for exc in _args['--has-not']:
-                if exc in sv["tags"]:
-                    filtered.remove(sv)
-
-    if _args['--no-match']:
-        for sv in list(filtered):
-            for regex in _args['--no-match']:
-                for tag in sv["tags"]:
-                    if re.match(regex, tag) and sv in list(filtered):
-                        filtered.remove(sv)
-
-    return filtered
-
-
-def __convert_tags(tags):
-    """ Return a dict of tags from array"""
-    _tags = {}
-    if tags:
-        for tag in tags:
-            if len(tag.split("=", 1)) != 2:
-                continue
-            k,v = tag.split("=", 1)
-            if k not in _tags.keys():
-                _tags[k] = v
-            else:
-                if not isinstance(_tags[k], list):
-                    _tags[k] = [_tags[k]]
-                _tags[k].append(v)
-    return _tags
+    global _filter
+    if _filter is None:
+        _filter = ServiceFilter(_args['--has'], _args['--has-not'], _args['--match'], _args['--no-match'])
+    return _filter(svcs)
 
 
 def parse_tags(services):
-    """Parse tags and replace them with dict"""
-    for service in list(services):
-        tags = __convert_tags(service['tags'])
-        if tags and tags.get('vhost'):
-            backend_guessed_port = service['id'].split(":")[-1]
-            # default values http / 80 or containers port
-            proto = "http"
-            port = tags.get(proto, backend_guessed_port)
-
-            # if nothing is provided but the backend port is 443 then bridge
-            if 'http' not in tags and 'https' not in tags and 'tcp' not in tags:
-                if backend_guessed_port == '443':
-                    proto = 'https'
-                    tags['ssl'] = 'bridge'
-
-            if "https" in tags:
-                proto = "https"
-                port = tags.get(proto, backend_guessed_port)
-
-            if "tcp" in tags:
-                proto = "tcp"
-                port = tags.get(proto, backend_guessed_port)
-
-            if 'ssl' not in tags:
-                if proto == 'https':
-                    if backend_guessed_port == '443':
-                        tags['ssl'] = 'bridge'
-                    else:
-                        tags['ssl'] = 'offloading'
-
-            tags[proto] = port
-            del service['tags']
-            service.update(tags)
-        else:
-            services.remove(service)
+    """Parse tags and return the load balanced services (the ones having a vhost)"""
+    records = []
+    for service in services:
+        record = parse_service(service['name'], service['ip'], service['port'], service['id'], service['tags'])
+        if record.vhost:
+            records.append(record)
+    return records
 
 
 def get_uniq_for_key(list, key, values=[]):
@@ -171,72 +224,502 @@ def is_list(value):
     return isinstance(value, list)
 
 
-def _generate_conf(_services, _template):
+class FragmentCacheExtension(Extension):
+    """
+    Add a {% fragment name, inputs... %}...{% endfragment %} block to templates.
+
+    The block body is only rendered when the content hash of its inputs changed since
+    the previous render, otherwise the cached output is reused. The body must only
+    depend on the inputs given to the tag.
+    """
+    tags = set(['fragment'])
+
+    def __init__(self, environment):
+        super(FragmentCacheExtension, self).__init__(environment)
+        environment.extend(fragment_cache={}, fragment_used=set())
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        inputs = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            inputs.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endfragment'], drop_needle=True)
+        args = [nodes.Const(parser.name), nodes.Const(lineno), nodes.List(inputs)]
+        return nodes.CallBlock(self.call_method('_render_fragment', args), [], [], body).set_lineno(lineno)
+
+    def _render_fragment(self, template, lineno, inputs, caller):
+        digest = hashlib.sha1(json.dumps(inputs, sort_keys=True, default=lambda service: service.key)).hexdigest()
+        key = (template, lineno, digest)
+        self.environment.fragment_used.add(key)
+        if key not in self.environment.fragment_cache:
+            self.environment.fragment_cache[key] = caller()
+        return self.environment.fragment_cache[key]
+
+
+_env = None
+_templates = {}
+_render_lock = Lock()
+
+
+class _Environment(jinja2.Environment):
+    """ Environment exposing the missing attributes of services as undefined, like missing tags used to be"""
+    def getattr(self, obj, attribute):
+        value = super(_Environment, self).getattr(obj, attribute)
+        if value is None and isinstance(obj, Service):
+            return self.undefined(obj=obj, name=attribute)
+        return value
+
+
+def _environment():
+    """ Return the shared jinja2 environment (compiled templates and fragments are cached there)"""
+    global _env
+    if _env is None:
+        _env = _Environment(loader=jinja2.FileSystemLoader("."), extensions=[FragmentCacheExtension])
+        _env.filters.update({'get_uniq_for_key': get_uniq_for_key})
+        _env.tests.update({'list': is_list})
+    return _env
+
+
+def _generate_conf(_services, _template, runtime_slots=0):
     """ Generate conf from template """
 
-    parse_tags(_services)
+    _services = parse_tags(_services)
 
+    # group and index services once instead of in every template block
+    ordered = sorted(_services, key=lambda service: service.name)
     context = {
         "services": _services,
+        "groups": [(name, list(group)) for name, group in itertools.groupby(ordered, lambda service: service.name)],
+        "http_ports": get_uniq_for_key(_services, 'http'),
+        "https_ports": get_uniq_for_key(_services, 'https'),
+        "ssl_modes": get_uniq_for_key(_services, 'ssl', values=['bridge', 'offloading']),
+        "passthrough": [service for service in _services if service.ssl == 'pass-through'],
+        "runtime_slots": runtime_slots,
         "bindip": _args['--bind-ip'] if _args else None,
     }
 
-    env = jinja2.Environment(loader=jinja2.FileSystemLoader("."))
-
-    env.filters.update({'get_uniq_for_key': get_uniq_for_key})
-    env.tests.update({'list': is_list})
+    env = _environment()
+    with _render_lock:
+        tpl = env.get_template(_template)
+        if _templates.get(_template) is not tpl:
+            # the template was (re)loaded, its cached fragments are stale
+            _templates[_template] = tpl
+            for key in list(env.fragment_cache):
+                if key[0] == _template:
+                    del env.fragment_cache[key]
+        env.fragment_used = set(key for key in env.fragment_used if key[0] != _template)
+        output = tpl.render(context)
+        # only keep the fragments used by the latest render of each template
+        for key in list(env.fragment_cache):
+            if key not in env.fragment_used:
+                del env.fragment_cache[key]
+    return output
+
+
+def _file_digest(filename):
+    """ Return the digest of a file content or None if it can't be read"""
+    try:
+        with open(filename, "rb") as fh:
+            return hashlib.sha1(fh.read()).hexdigest()
+    except IOError:
+        return None
 
-    tpl = env.get_template(_template)
-    return tpl.render(context)
 
+# replies of the admin socket to the commands it applied, including the no-op ones
+_ADMIN_APPLIED = re.compile(r'changed|no need to change')
+_SERVER_LINE = re.compile(r'^\s+server "(?P<id>[^"]+)" (?P<address>\S+)(?P<options>.*)$')
+_SERVER_TEMPLATE_LINE = re.compile(r'^\s+server-template (?P<prefix>\S+) 1-(?P<count>\d+) \S+ disabled(?P<options>.*)$')
 
-def render(filtered, args):
-    print("> Regenerating haproxy configuration...")
-    with file_or_stdout(args['--output']) as outf:
-        outf.write(_generate_conf(filtered, args['<jinja2_template>']))
 
-    if args['--run-cmd']:
-        subprocess.call(args['--run-cmd'], shell=True)
+def split_servers(conf):
+    """
+    Split a configuration into its skeleton (everything but the server lines of bk_ backends),
+    the servers {backend: {id: (address, options)}} and the reserved slots {backend: [(name, options)]}.
+    """
+    skeleton, servers, slots = [], OrderedDict(), OrderedDict()
+    backend = None
+    for line in conf.splitlines():
+        if line and not line[0].isspace():
+            section = line.split()
+            backend = section[1] if section[0] == "backend" and section[1].startswith("bk_") else None
+            if backend:
+                servers[backend] = OrderedDict()
+                slots[backend] = []
+        elif backend:
+            server = _SERVER_LINE.match(line)
+            if server:
+                servers[backend][server.group('id')] = (server.group('address'), server.group('options'))
+                continue
+            template = _SERVER_TEMPLATE_LINE.match(line)
+            if template:
+                for i in range(1, int(template.group('count')) + 1):
+                    slots[backend].append(("%s%s" % (template.group('prefix'), i), template.group('options')))
+        skeleton.append(line)
+    return "\n".join(skeleton), servers, slots
 
 
-def get_services(_consul):
+class HAProxyRuntime(object):
+    """
+    HAProxyRuntime applies server changes through the HAProxy admin socket so that
+    haproxy does not have to be reloaded when only the servers of bk_ backends moved.
+    New servers take one of the slots reserved with server-template, the removed servers
+    named after their instance are disabled and never reused for another one.
+    """
+    def __init__(self, socket_path, slots=10, timeout=5):
+        self.socket_path = socket_path
+        self.slots = slots
+        self.timeout = timeout
+        self.skeleton = None
+        self.backends = None
+
+    def reset(self, conf):
+        """
+        Track the servers of the configuration haproxy has just been (re)loaded with.
+        backends is {backend: {server name: (id, address, options)}}, free slots have no id.
+        """
+        self.skeleton, servers, slots = split_servers(conf)
+        self.backends = {}
+        for backend in servers:
+            self.backends[backend] = OrderedDict()
+            for id, (address, options) in servers[backend].items():
+                self.backends[backend][id] = (id, address, options)
+            for name, options in slots[backend]:
+                self.backends[backend][name] = (None, None, options)
+
+    def update(self, conf):
+        """
+        Apply the configuration through the admin socket.
+        Return False when it can't be done at runtime and haproxy needs a reload.
+        """
+        if self.backends is None:
+            return False
+        skeleton, servers, slots = split_servers(conf)
+        if skeleton != self.skeleton:
+            return False
+
+        backends = dict((backend, OrderedDict(entries)) for backend, entries in self.backends.items())
+        commands = []
+        for backend, wanted in servers.items():
+            current = backends[backend]
+            names = dict((entry[0], name) for name, entry in current.items() if entry[0])
+            for id in set(names) - set(wanted):
+                name = names.pop(id)
+                commands.append("set server %s/%s state maint" % (backend, name))
+                if name == id:
+                    # the server is named after its instance, it is only disabled until the next reload
+                    del current[name]
+                else:
+                    current[name] = (None, None, current[name][2])
+            for id, (address, options) in wanted.items():
+                if id in names:
+                    name = names[id]
+                    if current[name][2] != options:
+                        return False
+                    if current[name][1] != address:
+                        commands.append("set server %s/%s addr %s port %s" % ((backend, name) + tuple(address.rsplit(":", 1))))
+                else:
+                    free = [name for name, entry in current.items() if not entry[0] and entry[2] == options]
+                    if not free:
+                        return False
+                    name = free[0]
+                    commands.append("set server %s/%s addr %s port %s" % ((backend, name) + tuple(address.rsplit(":", 1))))
+                    commands.append("set server %s/%s state ready" % (backend, name))
+                current[name] = (id, address, options)
+
+        for command in commands:
+            try:
+                response = self._send(command)
+            except socket.error as ex:
+                print("> Admin socket error (%s), falling back to a reload" % ex)
+                return False
+            if response.strip() and not _ADMIN_APPLIED.search(response):
+                print("> Admin socket refused '%s': %s" % (command, response.strip()))
+                return False
+        self.backends = backends
+        return True
+
+    def _send(self, command):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+            sock.sendall(command + "\n")
+            response = ""
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                response += data
+        finally:
+            sock.close()
+        return response
+
+
+def render(filtered, args, force=False):
+    """ Render the configuration, apply it at runtime when possible and reload only if it changed (or if forced)"""
+    global _applied
+    with _apply_lock:
+        force = force or not _applied
+        print("> Regenerating haproxy configuration...")
+        counters['renders'] += 1
+        conf = _generate_conf(filtered, args['<jinja2_template>'], _runtime.slots if _runtime else 0)
+
+        output = args['--output']
+        to_file = output and output != "-"
+        if not force and to_file and _file_digest(output) == hashlib.sha1(conf.encode('utf-8')).hexdigest():
+            counters['reloads_avoided'] += 1
+            print("> Configuration unchanged, skipping write and reload (%s/%s reloads avoided)" % (counters['reloads_avoided'], counters['renders']))
+            if _runtime and _runtime.backends is None:
+                _runtime.reset(conf)
+            return False
+
+        if to_file:
+            if not write_config(output, conf, args.get('--check-cmd')):
+                counters['invalid'] += 1
+                return False
+        else:
+            with file_or_stdout(output) as outf:
+                outf.write(conf)
+
+        if not force and _runtime and _runtime.update(conf):
+            counters['runtime_updates'] += 1
+            print("> Servers updated through the admin socket, no reload needed")
+            if to_file:
+                keep_last_good(output, conf)
+            return True
+
+        reloaded = True
+        if args['--run-cmd']:
+            counters['reloads'] += 1
+            reloaded = subprocess.call(args['--run-cmd'], shell=True) == 0
+        _applied = _applied or reloaded
+        if to_file and reloaded:
+            keep_last_good(output, conf)
+        elif to_file:
+            previous = rollback_config(output)
+            if previous is not None:
+                print("> Reload failed, rolling back to the last known good configuration")
+                conf = previous
+                subprocess.call(args['--run-cmd'], shell=True)
+        if _runtime:
+            _runtime.reset(conf)
+        return True
+
+
+def _service_record(name, ip, port, id, tags):
+    """ Build the record used by the filter / template pipeline"""
+    return {'name': name,
+            'ip':   ip,
+            'port': port,
+            'id':   id,
+            'tags': tags}
+
+
+def _fetch_bulk(_consul):
+    """ Fetch every service instance with a single request (internal ui node dump)"""
+    params = [('dc', _consul.dc)] if _consul.dc else []
+    index, nodes = _consul.http.get(consul.base.CB.json(index=True), '/v1/internal/ui/nodes', params=params)
+    if nodes is None:
+        raise consul.ConsulException("bulk node dump is not available")
     services = []
+    for node in nodes:
+        for instance in node['Services'] or []:
+            services.append(_service_record(instance['Service'], instance['Address'], instance['Port'],
+                                            instance['ID'], instance['Tags']))
+    return index, services
+
+
+def _fetch_fanout(_consul, workers):
+    """ Fetch service instances with one request per service on a bounded pool"""
     index, catalog = _consul.catalog.services()
-    for service in catalog:
-        index, instances = _consul.catalog.service(service=service)
+    pool = ThreadPool(max(1, min(workers, len(catalog) or 1)))
+    try:
+        results = pool.map(lambda service: _consul.catalog.service(service=service)[1], list(catalog))
+    finally:
+        pool.close()
+    services = []
+    for instances in results:
         for instance in instances:
-            services.append({'name': instance['ServiceName'],
-                             'ip':   instance['ServiceAddress'],
-                             'port': instance['ServicePort'],
-                             'id':   instance['ServiceID'],
-                             'tags': instance['ServiceTags']})
-    return services
+            services.append(_service_record(instance['ServiceName'], instance['ServiceAddress'], instance['ServicePort'],
+                                            instance['ServiceID'], instance['ServiceTags']))
+    return index, services
 
 
-def services_listen(window, consul):
-    index = None
-    anti_flapping = AntiFlapping(window)
+def fetch_catalog(_consul, workers=8):
+    """ Return (index, services) from a catalog snapshot, using the bulk endpoint when possible"""
+    try:
+        index, services = _fetch_bulk(_consul)
+    except (consul.ConsulException, KeyError, TypeError) as ex:
+        print("> Bulk catalog snapshot unavailable (%s), falling back to per service queries..." % ex)
+        index, services = _fetch_fanout(_consul, workers)
+    # instances stay in node order within a service, like catalog.service() returns them
+    services.sort(key=lambda service: service['name'])
+    return index, services
+
+
+def get_services(_consul, workers=8):
+    return fetch_catalog(_consul, workers)[1]
+
+
+class CatalogWatcher(object):
+    """
+    CatalogWatcher keeps one blocking query per service on a bounded pool of threads
+    and maintains an in-memory map of service -> instances.
+
+    The catalog service list is followed with its own blocking query: the services that
+    appeared, disappeared or whose tags changed are diffed against the last list and only
+    those are fetched again, the instances that moved without a tag change are caught by
+    the watch of their service.
+    """
+    def __init__(self, consul, on_change, watchers=64, workers=8, wait='10s'):
+        self.consul = consul
+        self.on_change = on_change
+        self.watchers = watchers
+        self.workers = workers
+        self.wait = wait
+        self.lock = Lock()
+        self.index = None
+        self.instances = {}
+        self.indexes = {}
+        self.tags = {}
+        self._pending = Queue()
+
+    def start(self):
+        """
+        Seed the map from a catalog snapshot and start the per service watches.
+        """
+        self.index, services = fetch_catalog(self.consul, self.workers)
+        with self.lock:
+            for service in services:
+                self.instances.setdefault(service['name'], []).append(service)
+            for name, instances in self.instances.items():
+                self.tags[name] = set(tag for instance in instances for tag in instance['tags'] or [])
+                self._watch(name, self.index)
+        # one pooled connection per blocking query
+        session = getattr(self.consul.http, 'session', None)
+        if session:
+            session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=self.watchers + 1))
+            session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=self.watchers + 1))
+        for i in range(self.watchers):
+            thread = Thread(name="CatalogWatcher-%s" % i, target=self._run)
+            thread.setDaemon(True)
+            thread.start()
+        self.on_change()
+
+    def services(self):
+        """
+        Return a copy of every known instance, without querying consul.
+        """
+        with self.lock:
+            return [dict(instance) for name in sorted(self.instances) for instance in self.instances[name]]
+
+    def listen(self):
+        """
+        Blocking loop following the service list of the catalog.
+        """
+        while True:
+            try:
+                index, catalog = self.consul.catalog.services(index=self.index, wait=self.wait)
+                if index != self.index:
+                    self.index = index
+                    if self.sync(catalog):
+                        self.on_change()
+            except Exception as ex:
+                print("> Error while watching the catalog: %s" % ex)
+                sleep(1)
+
+    def sync(self, catalog):
+        """
+        Diff the service list against the last one: forget the deregistered services and fetch
+        the new ones and the ones whose tags changed. Return True if the map changed.
+        """
+        with self.lock:
+            removed = set(self.instances) - set(catalog)
+            for name in removed:
+                del self.instances[name]
+                del self.indexes[name]
+                del self.tags[name]
+            moved = [name for name, tags in catalog.items() if self.tags.get(name) != set(tags or [])]
+            for name in moved:
+                if name not in self.instances:
+                    self.instances[name] = []
+                    self._watch(name, None)
+                self.tags[name] = set(catalog[name] or [])
+        changed = bool(removed)
+        for name in moved:
+            changed = self.poll(name, block=False) or changed
+        return changed
+
+    def poll(self, name, block=True):
+        """
+        Query a service (blocking until it moves past the last seen index unless block is False)
+        and update its entry if it moved. Return True if it did.
+        """
+        with self.lock:
+            if name not in self.indexes:
+                return False
+            index = self.indexes[name]
+        if block:
+            index, instances = self.consul.catalog.service(service=name, index=index, wait=self.wait)
+        else:
+            index, instances = self.consul.catalog.service(service=name)
+        records = [_service_record(instance['ServiceName'], instance['ServiceAddress'], instance['ServicePort'],
+                                   instance['ServiceID'], instance['ServiceTags']) for instance in instances]
+        with self.lock:
+            # the service may have been dropped while we were waiting
+            if name not in self.indexes:
+                return False
+            self.indexes[name] = index
+            if self.instances[name] == records:
+                return False
+            self.instances[name] = records
+        return True
+
+    def _watch(self, name, index):
+        self.indexes[name] = index
+        self._pending.put(name)
+
+    def _run(self):
+        """
+        internal runloop serving the pending watches.
+        """
+        while True:
+            name = self._pending.get()
+            try:
+                changed = self.poll(name)
+            except Exception as ex:
+                print("> Error while watching service %s: %s" % (name, ex))
+                changed = False
+                sleep(1)
+            with self.lock:
+                if name in self.indexes:
+                    self._pending.put(name)
+            if changed:
+                self.on_change()
+
+
+def services_listen(window, max_wait, watcher):
+    debouncer = Debouncer(window, max_wait)
 
     def process():
-        filtered = filter_services(get_services(consul))
+        filtered = filter_services(watcher.services())
         render(filtered, _args)
 
-    while True:
-        old_index = index
-        index, data = consul.catalog.services(index=index)
-        if old_index != index:
-            anti_flapping.newEvent(process)
+    watcher.on_change = lambda: debouncer.newEvent(process)
+    watcher.start()
+    watcher.listen()
 
 
-def kv_listen(consul, key):
+def kv_listen(consul, key, watcher):
     index = None
     while True:
         old_index = index
         index, data = consul.kv.get(key, index=index)
         # if old_index is null don't continue as services_listen() will do the first pass
         if old_index and old_index != index:
-            filtered = filter_services(get_services(consul))
-            render(filtered, _args)
+            filtered = filter_services(watcher.services())
+            # the key usually means new certificates, haproxy must reload even if its config is the same
+            render(filtered, _args, force=True)
 
 
 def main():
@@ -250,26 +733,36 @@ def main():
       -r, --run-cmd cmd       Run the specified command afte rendering the template. Will be excecuted in a shell.
       -k, --listen-key path   KV Path in consul datastore to listen to. Will reload haproxy if value of key is updated.
       -o, --output file       The target file to render. If not specified it will print on stdout.
+      --check-cmd cmd         Validate the rendered file before installing it, {} is replaced by its path (e.g. "haproxy -c -f {}").
       --match match           Only render services that have tags which match the passed regular expressions.
       --no-match match        Only render services that have tags which dont match the passed regular expressions.
       --has tag               Only render services that have (all/the) specified tag(s).
       --has-not tag           Only render services that don't have any of (all/the) specified tag(s).
       -b, --bind-ip ip        Set the listening ip address [default: 0.0.0.0].
       --event-threshold s     Process events by batch with a threshold window (in second) [default: 10].
+      --event-max-wait s      Max delay (in second) before processing the pending events of a batch [default: 60].
+      -w, --workers n         Max concurrent consul requests when the bulk catalog snapshot is not available [default: 8].
+      --watchers n            Number of per service blocking queries running concurrently [default: 64].
+      -s, --admin-socket path HAProxy admin socket used to add / remove servers without reloading.
+      --runtime-slots n       Number of spare servers reserved in each backend for runtime updates [default: 10].
 
     """
-    global _args
+    global _args, _runtime
 
     _args = docopt.docopt(main.__doc__)
 
+    if _args['--admin-socket']:
+        _runtime = HAProxyRuntime(_args['--admin-socket'], int(_args['--runtime-slots']))
+
     _consul = consul.Consul(_args['--consul'])
+    watcher = CatalogWatcher(_consul, on_change=None, watchers=int(_args['--watchers']), workers=int(_args['--workers']))
 
-    ts = Thread(target=services_listen, kwargs={'window': int(_args['--event-threshold']), 'consul': _consul})
+    ts = Thread(target=services_listen, kwargs={'window': float(_args['--event-threshold']), 'max_wait': float(_args['--event-max-wait']), 'watcher': watcher})
     ts.setDaemon(True)
     ts.start()
 
     if _args['--listen-key']:
-        tk = Thread(target=kv_listen,  kwargs={'consul': _consul, 'key': _args['--listen-key']})
+        tk = Thread(target=kv_listen,  kwargs={'consul': _consul, 'key': _args['--listen-key'], 'watcher': watcher})
         tk.setDaemon(True)
         tk.start()
 
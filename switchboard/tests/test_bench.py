@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+from bench import STAGES, compare, measure, synthetic_catalog
+import switchboard
+
+
+class TestBench(TestCase):
+
+    def test_synthetic_catalog_is_reproducible(self):
+        catalog = synthetic_catalog(500, seed=1)
+        self.assertEquals(len(catalog), 500)
+        self.assertEquals(catalog, synthetic_catalog(500, seed=1))
+        tags = set(tag.split("=")[0] for service in catalog for tag in service['tags'])
+        self.assertTrue(set(['dns', 'vhost', 'url_prefix', 'https', 'ssl', 'tcp']) <= tags)
+
+    def test_measure_times_every_stage(self):
+        result = measure(100, 'tests/test.jinja2', repeat=1)
+        self.assertEquals(sorted(result['stages']), sorted(STAGES))
+        self.assertGreater(result['rendered_bytes'], 0)
+        switchboard._args = None
+        switchboard._filter = None
+
+    def test_compare_flags_regressions(self):
+        baseline = {'1000': {'stages': {'filter': {'seconds': 0.1, 'memory_mb': 10},
+                                        'parse_cold': {'seconds': 0.001, 'memory_mb': 0.1}}}}
+        results = [{'size': 1000, 'stages': {'filter': {'seconds': 0.2, 'memory_mb': 10},
+                                             'parse_cold': {'seconds': 0.002, 'memory_mb': 0.5}}}]
+        regressions = compare(results, baseline, 20)
+        self.assertEquals(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith("1000 filter"))
+        self.assertEquals(compare(results, baseline, 150), [])
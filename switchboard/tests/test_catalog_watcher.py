@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import json
+
+from consul.base import Response
+from unittest import TestCase
+from switchboard import CatalogWatcher
+
+
+def node(name, *services):
+    return {'Node': name, 'Address': '10.0.0.%s' % name[-1],
+            'Services': [{'ID': '%s:%s:%s' % (name, service, port), 'Service': service, 'Port': port,
+                          'Address': '10.0.0.%s' % name[-1], 'Tags': ['dns=domain.tld', 'vhost=%s' % service]}
+                         for service, port in services]}
+
+
+def catalog_service(nodes, name):
+    return [{'ServiceName': service['Service'], 'ServiceAddress': service['Address'], 'ServicePort': service['Port'],
+             'ServiceID': service['ID'], 'ServiceTags': service['Tags']}
+            for node in nodes for service in node['Services'] if service['Service'] == name]
+
+
+class FakeHTTP(object):
+
+    def __init__(self, consul):
+        self.consul = consul
+        self.calls = 0
+
+    def get(self, callback, path, params=None):
+        self.calls += 1
+        return callback(Response(200, {'X-Consul-Index': str(self.consul.index)}, json.dumps(self.consul.nodes)))
+
+
+class FakeCatalog(object):
+
+    def __init__(self, consul):
+        self.consul = consul
+        self.calls = []
+        self.fetched = []
+
+    def services(self, index=None, wait=None):
+        self.calls.append(index)
+        if not self.consul.answers:
+            raise KeyboardInterrupt()
+        self.consul.index, self.consul.nodes = self.consul.answers.pop(0)
+        catalog = {}
+        for node in self.consul.nodes:
+            for service in node['Services']:
+                catalog.setdefault(service['Service'], set()).update(service['Tags'])
+        return str(self.consul.index), dict((name, sorted(tags)) for name, tags in catalog.items())
+
+    def service(self, service, index=None, wait=None):
+        self.fetched.append((service, index))
+        return str(self.consul.index), catalog_service(self.consul.nodes, service)
+
+
+class FakeConsul(object):
+    """ Consul whose catalog moves to the next of `answers` (index, nodes) at each blocking query"""
+
+    def __init__(self, nodes, answers=()):
+        self.dc = None
+        self.index = 10
+        self.nodes = nodes
+        self.answers = list(answers)
+        self.http = FakeHTTP(self)
+        self.catalog = FakeCatalog(self)
+
+
+NODES = [node('node1', ('web', 80)), node('node2', ('api', 8080))]
+
+
+class TestCatalogWatcher(TestCase):
+
+    def watch(self, *answers):
+        self.consul = FakeConsul(NODES, answers)
+        self.changes = []
+        # no watcher threads, the per service watches are polled by the tests
+        self.watcher = CatalogWatcher(self.consul, on_change=lambda: self.changes.append(True), watchers=0)
+        self.watcher.start()
+        self.assertRaises(KeyboardInterrupt, self.watcher.listen)
+
+    def test_start_seeds_the_map_with_one_request(self):
+        self.watch()
+        self.assertEquals(self.consul.http.calls, 1)
+        self.assertEquals(self.consul.catalog.fetched, [])
+        self.assertEquals(self.changes, [True])
+        self.assertEquals([s['id'] for s in self.watcher.services()], ['node2:api:8080', 'node1:web:80'])
+        self.assertEquals(self.watcher.indexes, {'web': '10', 'api': '10'})
+
+    def test_only_the_changed_services_are_fetched(self):
+        self.watch((11, NODES + [node('node3', ('db', 3306))]))
+        self.assertEquals(self.changes, [True, True])
+        self.assertEquals(self.consul.catalog.calls, ['10', '11'])
+        self.assertEquals(self.consul.catalog.fetched, [('db', None)])
+        self.assertEquals([s['id'] for s in self.watcher.services()],
+                          ['node2:api:8080', 'node3:db:3306', 'node1:web:80'])
+
+    def test_retagged_services_are_fetched(self):
+        retagged = node('node1', ('web', 80))
+        retagged['Services'][0]['Tags'].append('https=443')
+        self.watch((11, [retagged] + NODES[1:]))
+        self.assertEquals(self.changes, [True, True])
+        self.assertEquals(self.consul.catalog.fetched, [('web', None)])
+        self.assertEquals(self.watcher.instances['web'][0]['tags'], ['dns=domain.tld', 'vhost=web', 'https=443'])
+
+    def test_deregistered_services_are_dropped(self):
+        self.watch((11, NODES[:1]), (12, NODES[:1]))
+        self.assertEquals(self.changes, [True, True])
+        self.assertEquals(self.consul.catalog.fetched, [])
+        self.assertEquals(sorted(self.watcher.instances), ['web'])
+        self.assertEquals(sorted(self.watcher.indexes), ['web'])
+
+    def test_moved_instances_are_caught_by_their_watch(self):
+        # web moved to another node with the same tags, the service list did not change
+        moved = [node('node3', ('web', 80))] + NODES[1:]
+        self.watch((11, moved))
+        self.assertEquals(self.changes, [True])
+        self.assertEquals(self.consul.catalog.fetched, [])
+        api = self.watcher.instances['api']
+        self.assertTrue(self.watcher.poll('web'))
+        self.assertFalse(self.watcher.poll('api'))
+        self.assertEquals(self.consul.catalog.fetched, [('web', '10'), ('api', '10')])
+        self.assertEquals(self.watcher.indexes, {'web': '11', 'api': '11'})
+        self.assertIs(self.watcher.instances['api'], api)
+        self.assertEquals([s['id'] for s in self.watcher.services()], ['node2:api:8080', 'node3:web:80'])
+
+    def test_services_does_not_query_consul(self):
+        self.watch()
+        services = self.watcher.services()
+        services[0]['tags'] = None
+        self.assertEquals(self.consul.http.calls, 1)
+        self.assertEquals(self.watcher.services()[0]['tags'], ['dns=domain.tld', 'vhost=api'])
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import random
+import re
+from switchboard import ServiceFilter
+
+
+def reference_filter(svcs, has, has_not, match, no_match):
+    """The original nested loops implementation"""
+    filtered = []
+    for sv in svcs:
+        for inc in has:
+            if inc in sv["tags"] and sv not in filtered:
+                filtered.append(sv)
+    for sv in svcs:
+        for regex in match:
+            for tag in sv["tags"]:
+                if re.match(regex, tag) and sv not in filtered:
+                    filtered.append(sv)
+    if not filtered and not has and not match:
+        filtered = svcs
+    for sv in list(filtered):
+        for exc in has_not:
+            if exc in sv["tags"] and sv in filtered:
+                filtered.remove(sv)
+    for sv in list(filtered):
+        for regex in no_match:
+            for tag in sv["tags"]:
+                if re.match(regex, tag) and sv in list(filtered):
+                    filtered.remove(sv)
+    return filtered
+
+
+TAGS = ["production", "staging", "dns=domain.tld", "dns=other.tld", "vhost=app", "vhost=api", "http=80", "tcp=5222"]
+REGEXES = ["dns=.*\\.tld", "vhost=a", "stag", "http=\\d+", "(?i)PRODUCTION", "nothing"]
+
+
+class TestServiceFilter(TestCase):
+
+    def test_same_results_as_nested_loops(self):
+        r = random.Random(42)
+        for i in range(300):
+            svcs = [{"name": "svc%s" % n, "id": "node%s" % n, "tags": r.sample(TAGS, r.randint(0, 4))} for n in range(20)]
+            has, has_not = r.sample(TAGS, r.randint(0, 2)), r.sample(TAGS, r.randint(0, 2))
+            match, no_match = r.sample(REGEXES, r.randint(0, 2)), r.sample(REGEXES, r.randint(0, 2))
+            expected = reference_filter(svcs, has, has_not, match, no_match)
+            self.assertEquals(ServiceFilter(has, has_not, match, no_match)(svcs), expected,
+                              msg="has=%s has_not=%s match=%s no_match=%s" % (has, has_not, match, no_match))
+
+    def test_filter_is_reusable(self):
+        svc_filter = ServiceFilter(match=["vhost="], no_match=["staging"])
+        svcs = [{"name": "a", "tags": ["vhost=a"]}, {"name": "b", "tags": ["vhost=b", "staging"]}, {"name": "c", "tags": []}]
+        self.assertEquals(svc_filter(svcs), [svcs[0]])
+        self.assertEquals(svc_filter(svcs[1:]), [])
+
+    def test_inline_flags_are_not_combined(self):
+        svc_filter = ServiceFilter(match=["(?i)PRODUCTION", "vhost=app"])
+        svcs = [{"name": "a", "tags": ["production"]}, {"name": "b", "tags": ["VHOST=APP"]}, {"name": "c", "tags": ["vhost=app"]}]
+        self.assertEquals(svc_filter(svcs), [svcs[0], svcs[2]])
+
+    def test_same_group_names_are_not_combined(self):
+        svc_filter = ServiceFilter(match=["^dns=(?P<domain>.+)$", "^vhost=(?P<domain>.+)$"])
+        svcs = [{"name": "a", "tags": ["dns=a.tld"]}, {"name": "b", "tags": ["vhost=b"]}, {"name": "c", "tags": ["http=80"]}]
+        self.assertEquals(svc_filter(svcs), svcs[:2])
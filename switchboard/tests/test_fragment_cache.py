@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import copy
+import switchboard
+from switchboard import _generate_conf
+
+
+def service(name, node, tags):
+    return {"name": name, "ip": "10.0.0.%s" % node, "port": "1200", "id": "node%s:80" % node, "tags": tags}
+
+
+class TestFragmentCache(TestCase):
+
+    def setUp(self):
+        self.services = [
+            service("app-%s" % i, i, ["dns=domain.tld", "http=80", "vhost=app%s" % i]) for i in range(5)
+        ] + [service("xmpp", 9, ["dns=domain.tld", "tcp=5222", "vhost=chat"])]
+
+    def _render(self, services):
+        output = _generate_conf(copy.deepcopy(services), "tests/test.jinja2")
+        return output, set(key for key in switchboard._env.fragment_cache if key[0] == "tests/test.jinja2")
+
+    def test_only_changed_fragments_are_rendered(self):
+        output, before = self._render(self.services)
+        self.services.append(service("app-2", 7, ["dns=domain.tld", "http=80", "vhost=app2"]))
+        changed_output, after = self._render(self.services)
+
+        self.assertIn('server "node7:80" 10.0.0.7:1200 check', changed_output)
+        # only the app-2 backend fragment has new inputs
+        self.assertEquals(len(after - before), 1)
+        self.assertEquals(len(before - after), 1)
+
+    def test_cached_render_is_identical(self):
+        output, before = self._render(self.services)
+        cached_output, after = self._render(self.services)
+        self.assertEquals(output, cached_output)
+        self.assertEquals(before, after)
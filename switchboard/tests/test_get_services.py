@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import json
+import consul
+from consul.base import Response
+from switchboard import get_services, fetch_catalog
+
+
+NODES = [
+    {
+        "Node": "node1",
+        "Address": "10.0.0.1",
+        "Services": [
+            {"ID": "consul", "Service": "consul", "Tags": [], "Address": "", "Port": 8300},
+            {"ID": "node1:web:80", "Service": "web", "Tags": ["dns=domain.tld", "vhost=web"], "Address": "10.0.0.1", "Port": 32768},
+        ]
+    },
+    {
+        "Node": "node2",
+        "Address": "10.0.0.2",
+        "Services": [
+            {"ID": "node2:web:80", "Service": "web", "Tags": ["dns=domain.tld", "vhost=web"], "Address": "10.0.0.2", "Port": 32769},
+            {"ID": "node2:db:3306", "Service": "db", "Tags": None, "Address": "10.0.0.2", "Port": 32770},
+        ]
+    },
+]
+
+
+class FakeHTTP(object):
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.calls = []
+
+    def get(self, callback, path, params=None):
+        self.calls.append(path)
+        if self.nodes is None:
+            return callback(Response(404, {'X-Consul-Index': '42'}, ''))
+        return callback(Response(200, {'X-Consul-Index': '42'}, json.dumps(self.nodes)))
+
+
+class FakeCatalog(object):
+
+    def __init__(self, nodes):
+        self.calls = []
+        self.instances = {}
+        for node in nodes:
+            for service in node['Services']:
+                self.instances.setdefault(service['Service'], []).append({
+                    'Node': node['Node'],
+                    'ServiceName': service['Service'],
+                    'ServiceAddress': service['Address'],
+                    'ServicePort': service['Port'],
+                    'ServiceID': service['ID'],
+                    'ServiceTags': service['Tags']})
+
+    def services(self, index=None):
+        self.calls.append('services')
+        return '41', dict((name, []) for name in self.instances)
+
+    def service(self, service, index=None, wait=None):
+        self.calls.append(service)
+        return '41', self.instances[service]
+
+
+class FakeConsul(object):
+
+    def __init__(self, nodes, bulk=True):
+        self.dc = None
+        self.http = FakeHTTP(nodes if bulk else None)
+        self.catalog = FakeCatalog(nodes)
+
+
+class TestGetServices(TestCase):
+
+    def test_bulk_single_request(self):
+        _consul = FakeConsul(NODES)
+        index, services = fetch_catalog(_consul)
+        self.assertEquals(index, '42')
+        self.assertEquals(_consul.http.calls, ['/v1/internal/ui/nodes'])
+        self.assertEquals(_consul.catalog.calls, [])
+        self.assertEquals([s['id'] for s in services], ['consul', 'node2:db:3306', 'node1:web:80', 'node2:web:80'])
+        self.assertEquals(services[2], {'name': 'web', 'ip': '10.0.0.1', 'port': 32768,
+                                        'id': 'node1:web:80', 'tags': ['dns=domain.tld', 'vhost=web']})
+
+    def test_fallback_fanout(self):
+        _consul = FakeConsul(NODES, bulk=False)
+        index, services = fetch_catalog(_consul, workers=2)
+        self.assertEquals(index, '41')
+        self.assertEquals(sorted(_consul.catalog.calls), ['consul', 'db', 'services', 'web'])
+        self.assertEquals(services, get_services(FakeConsul(NODES)))
+
+    def test_fallback_on_consul_error(self):
+        _consul = FakeConsul(NODES)
+
+        def broken(callback, path, params=None):
+            raise consul.ConsulException("500 internal error")
+        _consul.http.get = broken
+        self.assertEquals(get_services(_consul), get_services(FakeConsul(NODES)))
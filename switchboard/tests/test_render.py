@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import switchboard
+from switchboard import render
+
+
+def services(port="1200"):
+    return [{"name": "service-1", "ip": "10.0.0.1", "port": port, "id": "node1:80",
+             "tags": ["dns=domain.tld", "http=80", "vhost=test"]}]
+
+
+class TestRender(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.output = os.path.join(self.tmp, "haproxy.cfg")
+        self.reloads = os.path.join(self.tmp, "reloads")
+        self.args = {'--output': self.output,
+                     '--run-cmd': "echo reload >> %s" % self.reloads,
+                     '<jinja2_template>': "tests/test.jinja2"}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def _reloads(self):
+        if not os.path.isfile(self.reloads):
+            return 0
+        return len(open(self.reloads).readlines())
+
+    def test_unchanged_config_is_not_reloaded(self):
+        avoided = switchboard.counters['reloads_avoided']
+        self.assertTrue(render(services(), self.args))
+        mtime = os.stat(self.output).st_mtime
+        self.assertFalse(render(services(), self.args))
+        self.assertEquals(self._reloads(), 1)
+        self.assertEquals(os.stat(self.output).st_mtime, mtime)
+        self.assertEquals(switchboard.counters['reloads_avoided'], avoided + 1)
+
+    def test_first_render_of_the_process_reloads(self):
+        self.assertTrue(render(services(), self.args))
+        switchboard._applied = False
+        self.assertTrue(render(services(), self.args))
+        self.assertEquals(self._reloads(), 2)
+        # until it succeeds
+        self.args['--run-cmd'] = "exit 1"
+        switchboard._applied = False
+        self.assertTrue(render(services(), self.args))
+        self.assertTrue(render(services(), self.args))
+        self.assertFalse(switchboard._applied)
+
+    def test_changed_config_is_reloaded(self):
+        self.assertTrue(render(services(), self.args))
+        self.assertTrue(render(services(port="1300"), self.args))
+        self.assertEquals(self._reloads(), 2)
+        self.assertIn("10.0.0.1:1300", open(self.output).read())
+
+    def test_forced_render_reloads(self):
+        self.assertTrue(render(services(), self.args))
+        self.assertTrue(render(services(), self.args, force=True))
+        self.assertEquals(self._reloads(), 2)
+
+    def test_invalid_config_is_not_installed(self):
+        self.assertTrue(render(services(), self.args))
+        self.args['--check-cmd'] = "grep -q 1300 {} && exit 1 || exit 0"
+        self.assertFalse(render(services(port="1300"), self.args))
+        self.assertEquals(self._reloads(), 1)
+        self.assertNotIn("10.0.0.1:1300", open(self.output).read())
+        self.assertEquals(sorted(os.listdir(self.tmp)), ["haproxy.cfg", "haproxy.cfg.last-good", "reloads"])
+
+    def test_failed_reload_rolls_back(self):
+        self.assertTrue(render(services(), self.args))
+        self.args['--run-cmd'] = "grep -q 1300 %s && exit 1; echo reload >> %s" % (self.output, self.reloads)
+        self.assertTrue(render(services(port="1300"), self.args))
+        self.assertEquals(self._reloads(), 2)
+        self.assertIn("10.0.0.1:1200", open(self.output).read())
+        self.assertEquals(open(self.output).read(), open(self.output + ".last-good").read())
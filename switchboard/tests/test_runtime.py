@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+
+from unittest import TestCase
+import os
+import shutil
+import SocketServer
+import tempfile
+import threading
+import time
+import switchboard
+from switchboard import HAProxyRuntime, render
+
+
+class FakeAdminSocket(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Record the commands haproxy would receive on its admin socket"""
+
+    def __init__(self, path):
+        self.commands = []
+        self.reply = None
+        SocketServer.UnixStreamServer.__init__(self, path, FakeAdminHandler)
+
+
+class FakeAdminHandler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        command = self.rfile.readline().strip()
+        self.server.commands.append(command)
+        if self.server.reply:
+            self.wfile.write(self.server.reply + "\n")
+        elif " addr " in command:
+            self.wfile.write("IP changed from '127.0.0.1' to '10.0.0.2', port changed from '1' to '1200' by 'stats socket command'\n")
+
+
+def service(name, node, port="1200"):
+    return {"name": name, "ip": "10.0.0.%s" % node, "port": port, "id": "node%s:80" % node,
+            "tags": ["dns=domain.tld", "http=80", "vhost=%s" % name]}
+
+
+class TestRuntime(TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.server = FakeAdminSocket(os.path.join(self.tmp, "haproxy-admin.sock"))
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.output = os.path.join(self.tmp, "haproxy.cfg")
+        self.reloads = os.path.join(self.tmp, "reloads")
+        self.args = {'--output': self.output,
+                     '--run-cmd': "echo reload >> %s" % self.reloads,
+                     '<jinja2_template>': "tests/test.jinja2"}
+        switchboard._runtime = HAProxyRuntime(self.server.server_address, slots=2)
+        self.assertTrue(render([service("web", 1)], self.args))
+
+    def tearDown(self):
+        switchboard._runtime = None
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def _reloads(self):
+        return len(open(self.reloads).readlines())
+
+    def test_slots_are_reserved(self):
+        self.assertIn("    server-template slot 1-2 127.0.0.1:1 disabled check\n", open(self.output).read())
+        self.assertEquals(self._reloads(), 1)
+
+    def test_new_server_uses_a_slot(self):
+        self.assertTrue(render([service("web", 1), service("web", 2)], self.args))
+        self.assertEquals(self._reloads(), 1)
+        self.assertEquals(self.server.commands, ["set server bk_web/slot1 addr 10.0.0.2 port 1200",
+                                                 "set server bk_web/slot1 state ready"])
+        self.assertIn('server "node2:80" 10.0.0.2:1200 check', open(self.output).read())
+
+    def test_removed_server_is_disabled_and_not_reused(self):
+        self.assertTrue(render([service("web", 2)], self.args))
+        self.assertTrue(render([service("web", 2), service("web", 3)], self.args))
+        self.assertEquals(self._reloads(), 1)
+        # node1:80 would be named after another instance, it stays disabled until the next reload
+        self.assertEquals(self.server.commands, ["set server bk_web/node1:80 state maint",
+                                                 "set server bk_web/slot1 addr 10.0.0.2 port 1200",
+                                                 "set server bk_web/slot1 state ready",
+                                                 "set server bk_web/slot2 addr 10.0.0.3 port 1200",
+                                                 "set server bk_web/slot2 state ready"])
+
+    def test_removed_slot_is_reused(self):
+        self.assertTrue(render([service("web", 1), service("web", 2)], self.args))
+        self.assertTrue(render([service("web", 1)], self.args))
+        self.assertTrue(render([service("web", 1), service("web", 3)], self.args))
+        self.assertEquals(self._reloads(), 1)
+        self.assertEquals(self.server.commands[1:], ["set server bk_web/slot1 state ready",
+                                                     "set server bk_web/slot1 state maint",
+                                                     "set server bk_web/slot1 addr 10.0.0.3 port 1200",
+                                                     "set server bk_web/slot1 state ready"])
+
+    def test_renders_apply_one_at_a_time(self):
+        applying, overlaps = [], []
+        update = switchboard._runtime.update
+
+        def slow_update(conf):
+            applying.append(conf)
+            time.sleep(0.1)
+            overlaps.append(len(applying))
+            result = update(conf)
+            applying.pop()
+            return result
+        switchboard._runtime.update = slow_update
+        threads = [threading.Thread(target=render, args=([service("web", 1), service("web", i)], self.args)) for i in (2, 3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(overlaps, [1, 1])
+        self.assertEquals(self._reloads(), 1)
+        self.assertEquals(len(self.server.commands), 5)
+
+    def test_moved_server_changes_address(self):
+        self.assertTrue(render([service("web", 1, port="1300")], self.args))
+        self.assertEquals(self._reloads(), 1)
+        self.assertEquals(self.server.commands, ["set server bk_web/node1:80 addr 10.0.0.1 port 1300"])
+
+    def test_structural_change_reloads(self):
+        self.assertTrue(render([service("web", 1), service("api", 2)], self.args))
+        self.assertEquals(self._reloads(), 2)
+        self.assertEquals(self.server.commands, [])
+
+    def test_no_free_slot_reloads(self):
+        self.assertTrue(render([service("web", i) for i in range(1, 5)], self.args))
+        self.assertEquals(self._reloads(), 2)
+        self.assertEquals(self.server.commands, [])
+
+    def test_no_op_command_does_not_reload(self):
+        self.server.reply = "no need to change the addr, no need to change the port"
+        self.assertTrue(render([service("web", 1, port="1300")], self.args))
+        self.assertEquals(self._reloads(), 1)
+
+    def test_refused_command_reloads(self):
+        self.server.reply = "No such server."
+        self.assertTrue(render([service("web", 1), service("web", 2)], self.args))
+        self.assertEquals(self._reloads(), 2)
+        # once reloaded the new servers are tracked from the file
+        self.server.reply = None
+        self.assertTrue(render([service("web", 2)], self.args))
+        self.assertEquals(self.server.commands[-1], "set server bk_web/node1:80 state maint")
@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+
+import imp
+import os
+
+whisper = imp.load_source('whisper', os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'whisper.py'))
+
+
+class NullLogger(object):
+
+    def info(self, event, **data):
+        pass
+
+    warn = debug = error = info
+
+
+def instance(name, tags, address='10.0.0.1', port=80):
+    return {'ServiceName': name, 'ServiceAddress': address, 'ServicePort': port,
+            'ServiceID': "node:%s:%d" % (name, port), 'ServiceTags': tags}
+
+
+class FakeCatalog(object):
+
+    def __init__(self, services):
+        self.services_by_name = services
+        self.fetched = []
+
+    def services(self, index=None):
+        return 1, dict((name, sorted(set(tag for instance in instances for tag in instance['ServiceTags'])))
+                       for name, instances in self.services_by_name.items())
+
+    def service(self, service):
+        self.fetched.append(service)
+        return 1, self.services_by_name[service]
+
+
+class FakeKV(object):
+
+    def __init__(self):
+        self.data = {}
+        self.gets = 0
+
+    def get(self, key, index=None, keys=False, recurse=False):
+        self.gets += 1
+        if keys:
+            return 1, sorted(_key for _key in self.data if _key.startswith(key)) or None
+        if recurse:
+            return 1, [{'Key': _key, 'Value': value} for _key, value in sorted(self.data.items()) if _key.startswith(key)] or None
+        if key not in self.data:
+            return 1, None
+        return 1, {'Key': key, 'Value': self.data[key]}
+
+    def put(self, key, value):
+        self.data[key] = value
+        return True
+
+
+class FakeConsul(object):
+
+    def __init__(self, services=None):
+        self.catalog = FakeCatalog(services if services is not None else {})
+        self.kv = FakeKV()
+
+
+class RecordingPool(object):
+    """ Pool recording the jobs instead of running them"""
+
+    def __init__(self):
+        self.jobs = []
+
+    def apply_async(self, func, args):
+        self.jobs.append(args)
+
+
+def make_manager(services=None, **options):
+    """ Return a WhisperManager without listeners on a fake consul, options are given without the leading --"""
+    defaults = {'consul': 'consul', 'debug': False, 'dryrun': False, 'domain': [], 'path_to_cert_folder': '/nonexistent',
+                'acme-key': '/nonexistent/.acme', 'staging': True, 'notify': None, 'listen-path': [], 'inventory': None,
+                'workers': '4', 'event-threshold': '0', 'event-max-wait': '0'}
+    defaults.update(options)
+    options = dict(("<%s>" % key if key == 'path_to_cert_folder' else "--%s" % key, value) for key, value in defaults.items())
+    spawn_listeners, consul = whisper.WhisperManager._spawn_listeners, whisper.consul.Consul
+    whisper.WhisperManager._spawn_listeners = lambda self: None
+    whisper.consul.Consul = lambda host: FakeConsul(services)
+    try:
+        manager = whisper.WhisperManager(options)
+    finally:
+        whisper.WhisperManager._spawn_listeners, whisper.consul.Consul = spawn_listeners, consul
+    manager.log = NullLogger()
+    return manager
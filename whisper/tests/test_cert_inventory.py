@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+import os
+import shutil
+import tempfile
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from unittest import TestCase
+from tests import NullLogger, whisper
+
+_KEY = rsa.generate_private_key(public_exponent=65537, key_size=1024, backend=default_backend())
+
+
+def write_certificate(path, hosts, days=90):
+    """ Write a self signed certificate for hosts (the first one being the CN) valid for days"""
+    name = x509.Name([x509.NameAttribute(x509.NameOID.COMMON_NAME, unicode(hosts[0]))])
+    now = datetime.datetime.utcnow().replace(microsecond=0)
+    certificate = x509.CertificateBuilder() \
+        .subject_name(name).issuer_name(name).public_key(_KEY.public_key()).serial_number(1) \
+        .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=days)) \
+        .add_extension(x509.SubjectAlternativeName([x509.DNSName(unicode(host)) for host in hosts]), critical=False) \
+        .sign(_KEY, hashes.SHA256(), default_backend())
+    with open(path, 'w') as f:
+        f.write(certificate.public_bytes(serialization.Encoding.PEM))
+
+
+class CountingInventory(whisper.CertInventory):
+
+    def __init__(self, *args, **kwargs):
+        self.parsed = []
+        super(CountingInventory, self).__init__(*args, **kwargs)
+
+    def _parse(self, path, key):
+        self.parsed.append(os.path.basename(path))
+        return super(CountingInventory, self)._parse(path, key)
+
+
+class TestGuessDomain(TestCase):
+
+    def test_longest_domain_wins(self):
+        domains = {'domain.tld': {}, 'sub.domain.tld': {}}
+        self.assertEquals(whisper.guess_domain('www.sub.domain.tld', domains), ('sub.domain.tld', 'www'))
+        self.assertEquals(whisper.guess_domain('www.domain.tld', domains), ('domain.tld', 'www'))
+
+    def test_unknown_domain(self):
+        self.assertEquals(whisper.guess_domain('www.other.tld', {'domain.tld': {}}), (None, 'www.other.tld'))
+
+
+class TestCertInventory(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.inventory = CountingInventory(self.folder, NullLogger())
+
+    def pem(self, name):
+        return os.path.join(self.folder, name)
+
+    def test_only_new_and_changed_files_are_parsed(self):
+        write_certificate(self.pem('www.domain.tld.pem'), ['www.domain.tld'])
+        write_certificate(self.pem('multi-hosts.domain.tld.pem'), ['a.domain.tld', 'b.domain.tld'])
+        with open(self.pem('notes.txt'), 'w') as f:
+            f.write("not a certificate")
+        self.assertTrue(self.inventory.refresh())
+        self.assertEquals(sorted(self.inventory.parsed), ['multi-hosts.domain.tld.pem', 'www.domain.tld.pem'])
+
+        self.assertFalse(self.inventory.refresh())
+        self.assertEquals(len(self.inventory.parsed), 2)
+
+        write_certificate(self.pem('www.domain.tld.pem'), ['www.domain.tld', 'api.domain.tld'])
+        self.assertTrue(self.inventory.refresh())
+        self.assertEquals(self.inventory.parsed[2:], ['www.domain.tld.pem'])
+        self.assertEquals(self.inventory.entries[self.pem('www.domain.tld.pem')]['fqdns'],
+                          ['api.domain.tld', 'www.domain.tld'])
+
+    def test_deleted_files_are_evicted(self):
+        write_certificate(self.pem('www.domain.tld.pem'), ['www.domain.tld'])
+        self.inventory.refresh()
+        os.remove(self.pem('www.domain.tld.pem'))
+        self.assertTrue(self.inventory.refresh())
+        self.assertEquals(self.inventory.entries, {})
+
+    def test_broken_files_are_parsed_once(self):
+        with open(self.pem('broken.pem'), 'w') as f:
+            f.write("-----BEGIN CERTIFICATE-----\nnope\n")
+        self.inventory.refresh()
+        self.inventory.refresh()
+        self.assertEquals(self.inventory.parsed, ['broken.pem'])
+        self.assertEquals(self.inventory.resolve({'domain.tld': {}}), {})
+
+    def test_names_are_resolved_again_when_domains_change(self):
+        write_certificate(self.pem('www.sub.domain.tld.pem'), ['www.sub.domain.tld'])
+        self.inventory.refresh()
+        certificates = self.inventory.resolve({'domain.tld': {}})
+        self.assertEquals(certificates['www.sub.domain.tld.pem']['names'], {'www.sub.domain.tld': ('domain.tld', 'www.sub')})
+        certificates = self.inventory.resolve({'domain.tld': {}, 'sub.domain.tld': {}})
+        self.assertEquals(certificates['www.sub.domain.tld.pem']['names'], {'www.sub.domain.tld': ('sub.domain.tld', 'www')})
+
+    def test_index_is_kept_between_runs(self):
+        path = os.path.join(tempfile.mkdtemp(), 'inventory.json')
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        write_certificate(self.pem('www.domain.tld.pem'), ['www.domain.tld'], days=30)
+        inventory = CountingInventory(self.folder, NullLogger(), path)
+        inventory.refresh()
+        before = inventory.resolve({'domain.tld': {}})
+
+        inventory = CountingInventory(self.folder, NullLogger(), path)
+        self.assertFalse(inventory.refresh())
+        self.assertEquals(inventory.parsed, [])
+        self.assertEquals(inventory.resolve({'domain.tld': {}}), before)
+        self.assertEquals((before['www.domain.tld.pem']['not_after'] - before['www.domain.tld.pem']['not_before']).days, 30)
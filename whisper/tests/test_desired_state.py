@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+
+from unittest import TestCase
+from tests import RecordingPool, instance, make_manager
+
+
+class TestDesiredState(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.services = {'web': [instance('web', ['dns=a.tld', 'vhost=www', 'https=443'])],
+                         'api': [instance('api', ['dns=a.tld', 'vhost=api', 'https=443'])],
+                         'db': [instance('db', ['dns=b.tld', 'ssl=true'])],
+                         'worker': [instance('worker', ['production'])]}
+        self.manager = make_manager(self.services, path_to_cert_folder=self.folder, **{'listen-path': ['whisper/static']})
+        self.manager._pool = self.pool = RecordingPool()
+        self.catalog = self.manager._consul.catalog
+        self.manager._consul.kv.put('whisper/static/c.tld/legacy', 'SAN')
+
+    def test_first_refresh_converges_everything(self):
+        self.manager.refresh_changes()
+        self.assertEquals(sorted(self.catalog.fetched), ['api', 'db', 'web'])
+        self.assertEquals(self.manager.desired, {('a.tld', 'www'): True, ('a.tld', 'api'): True, ('b.tld', 'db'): False,
+                                                 ('c.tld', 'legacy'): True})
+        self.assertEquals(sorted(self.pool.jobs), [('a.tld', [(False, ['api', 'www'])]), ('b.tld', [(False, ['db'])]),
+                                                   ('c.tld', [(False, ['legacy'])])])
+
+    def test_scale_up_converges_nothing(self):
+        self.manager.refresh_changes()
+        self.manager._orders.clear()
+        del self.catalog.fetched[:], self.pool.jobs[:]
+        self.services['worker'].append(instance('worker', ['production'], address='10.0.0.2'))
+        self.services['web'].append(instance('web', ['dns=a.tld', 'vhost=www', 'https=443'], address='10.0.0.2'))
+        self.manager.refresh_changes()
+        # services without domain are not fetched
+        self.assertEquals(sorted(self.catalog.fetched), ['api', 'db', 'web'])
+        self.assertEquals(self.pool.jobs, [])
+
+    def test_tags_moved_between_instances(self):
+        self.services['web'] = [instance('web', ['dns=a.tld', 'vhost=www', 'https=443']),
+                                instance('web', ['dns=a.tld', 'vhost=shop'], address='10.0.0.2')]
+        self.manager.refresh_changes()
+        self.manager._orders.clear()
+        del self.pool.jobs[:]
+        # same tags for the service, but https moved to the shop instance
+        self.services['web'] = [instance('web', ['dns=a.tld', 'vhost=shop', 'https=443']),
+                                instance('web', ['dns=a.tld', 'vhost=www'], address='10.0.0.2')]
+        self.manager.refresh_changes()
+        self.assertIn(('a.tld', 'shop'), self.manager.desired)
+        self.assertNotIn(('a.tld', 'www'), self.manager.desired)
+        self.assertEquals(self.pool.jobs, [('a.tld', [(False, ['api', 'shop'])])])
+
+    def test_only_changed_vhosts_are_converged(self):
+        self.manager.refresh_changes()
+        self.manager._orders.clear()
+        del self.catalog.fetched[:], self.pool.jobs[:]
+        self.services['db'] = [instance('db', ['dns=b.tld', 'ssl=true'])]
+        self.services['admin'] = [instance('admin', ['dns=b.tld', 'ssl=true'])]
+        self.manager.refresh_changes()
+        self.assertEquals(self.pool.jobs, [('b.tld', [(False, ['admin'])])])
+
+    def test_changes_of_a_busy_domain_wait_for_its_job(self):
+        self.manager.refresh_changes()
+        del self.pool.jobs[:]
+        self.services['admin'] = [instance('admin', ['dns=b.tld', 'ssl=true'])]
+        self.manager.refresh_changes()
+        self.assertEquals(self.pool.jobs, [])
+        self.assertTrue(self.manager._orders['b.tld'])
+
+        # the job of b.tld is done and converges again
+        self.manager._orders.clear()
+        self.manager.refresh_changes()
+        self.assertEquals(self.pool.jobs, [('b.tld', [(False, ['admin'])])])
+
+    def test_full_refresh_fetches_and_converges_everything(self):
+        self.manager.refresh_changes()
+        self.manager._orders.clear()
+        del self.catalog.fetched[:], self.pool.jobs[:]
+        self.manager.refresh_all()
+        self.assertEquals(sorted(self.catalog.fetched), ['api', 'db', 'web'])
+        self.assertEquals(len(self.pool.jobs), 3)
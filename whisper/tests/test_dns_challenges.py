@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+
+import acme.challenges
+import acme.jose
+import acme.messages
+import OpenSSL.crypto
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import rsa
+from unittest import TestCase
+from tests import NullLogger, whisper
+
+
+class StubRoute53(object):
+    """ Route53 client whose changes get in sync after `pending_polls` get_change calls"""
+
+    def __init__(self, zones, pending_polls=0, failing_polls=0, gone=()):
+        self.zones = zones
+        self.gone = set(gone)
+        self.pending_polls = pending_polls
+        self.failing_polls = failing_polls
+        self.batches = []
+        self.polls = []
+        self.txt = {}
+        self._pending = {}
+
+    def list_hosted_zones(self):
+        return {'HostedZones': [{'Name': "%s." % zone, 'Id': zone_id} for zone, zone_id in self.zones.items()]}
+
+    def change_resource_record_sets(self, HostedZoneId, ChangeBatch):
+        for change in ChangeBatch['Changes']:
+            # a change batch is rejected as a whole when one of its records can't be deleted
+            if change['Action'] == 'DELETE' and change['ResourceRecordSet']['Name'] in self.gone:
+                raise ValueError("InvalidChangeBatch: %s not found" % change['ResourceRecordSet']['Name'])
+        change_id = "/change/C%d" % len(self.batches)
+        self.batches.append((HostedZoneId, ChangeBatch['Changes']))
+        self._pending[change_id] = ChangeBatch['Changes']
+        return {'ChangeInfo': {'Id': change_id, 'Status': 'PENDING'}}
+
+    def get_change(self, Id):
+        self.polls.append(Id)
+        if self.failing_polls:
+            self.failing_polls -= 1
+            raise ValueError("Rate exceeded")
+        if len(self.polls) <= self.pending_polls:
+            return {'ChangeInfo': {'Id': Id, 'Status': 'PENDING'}}
+        for change in self._pending.pop(Id, []):
+            record = change['ResourceRecordSet']
+            if change['Action'] == 'DELETE':
+                self.txt.pop(record['Name'], None)
+            else:
+                self.txt[record['Name']] = record['ResourceRecords'][0]['Value'].strip('"')
+        return {'ChangeInfo': {'Id': Id, 'Status': 'INSYNC'}}
+
+
+class FakeDirectory(object):
+    new_authz = "https://acme.test/new-authz"
+
+
+class FakeAcme(object):
+    """
+    In process stand-in of an ACME test server (like pebble) issuing DNS01 challenges.
+
+    A challenge is only valid when its TXT record is in sync in the dns stub when answered.
+    Like the nonces of the acme client, answers fail when they are posted concurrently.
+    """
+
+    def __init__(self, dns):
+        self.key = acme.jose.JWKRSA(key=rsa.generate_private_key(public_exponent=65537, key_size=1024,
+                                                                 backend=default_backend()))
+        self.directory = FakeDirectory()
+        self.dns = dns
+        self.valid = set()
+        self.answers = []
+        self._answering = 0
+        self._lock = threading.Lock()
+
+    def request_domain_challenges(self, fqdn, new_authz_uri=None):
+        challenges = tuple(acme.messages.ChallengeBody(chall=chall, uri="https://acme.test/chall/%s" % fqdn,
+                                                       status=acme.messages.STATUS_PENDING)
+                           for chall in [acme.challenges.HTTP01(token=os.urandom(16)),
+                                         acme.challenges.DNS01(token=os.urandom(16))])
+        return acme.messages.AuthorizationResource(
+            body=acme.messages.Authorization(identifier=acme.messages.Identifier(typ=acme.messages.IDENTIFIER_FQDN,
+                                                                                value=fqdn),
+                                             challenges=challenges),
+            uri="https://acme.test/authz/%s" % fqdn)
+
+    def answer_challenge(self, challenge, response):
+        with self._lock:
+            self._answering += 1
+            answering = self._answering
+        try:
+            if answering > 1:
+                raise KeyError("pop from an empty set")
+            time.sleep(0.05)
+        finally:
+            with self._lock:
+                self._answering -= 1
+        self.answers.append(challenge.uri)
+        fqdn = challenge.uri.rsplit('/', 1)[1]
+        if self.dns.txt.get(challenge.validation_domain_name(fqdn)) != challenge.validation(self.key):
+            raise ValueError("No valid TXT record for %s" % fqdn)
+        self.valid.add(fqdn)
+
+    def poll_and_request_issuance(self, csr, authzrs):
+        names = set(authzr.body.identifier.value for authzr in authzrs)
+        if not names <= self.valid:
+            raise ValueError("Unauthorized names %s" % ", ".join(sorted(names - self.valid)))
+        key = OpenSSL.crypto.PKey()
+        key.generate_key(OpenSSL.crypto.TYPE_RSA, 1024)
+        cert = OpenSSL.crypto.X509()
+        cert.get_subject().CN = csr.get_subject().CN
+        cert.set_serial_number(1)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(90 * 24 * 3600)
+        cert.set_issuer(cert.get_subject())
+        cert.set_pubkey(csr.get_pubkey())
+        cert.sign(key, 'sha256')
+        return acme.messages.CertificateResource(body=acme.jose.ComparableX509(cert)), authzrs
+
+    def fetch_chain(self, cert):
+        return [cert.body.wrapped]
+
+
+def make_letswhisper(acme_client, route53_client):
+    letswhisper = whisper.Letswhisper('/nonexistent/.acme', '/nonexistent', NullLogger(), staging=True)
+    letswhisper.connect = lambda: acme_client
+    letswhisper._route53_client = lambda domain: route53_client
+    letswhisper.sleeps = []
+    letswhisper._sleep = letswhisper.sleeps.append
+    return letswhisper
+
+
+class TestUpdateCertificates(TestCase):
+
+    def test_all_challenges_go_in_one_change(self):
+        route53 = StubRoute53({'domain.tld': 'Z1'}, pending_polls=3)
+        acme_client = FakeAcme(route53)
+        letswhisper = make_letswhisper(acme_client, route53)
+        output = letswhisper.update_certificates('domain.tld', ['www', 'api', 'admin'])
+
+        self.assertIn('BEGIN RSA PRIVATE KEY', output['pk'])
+        self.assertIn('BEGIN CERTIFICATE', output['certs'][0])
+        self.assertEquals(acme_client.valid, set(['www.domain.tld', 'api.domain.tld', 'admin.domain.tld']))
+        # one change to publish the records, one to clean them
+        self.assertEquals([(zone, [change['Action'] for change in changes]) for zone, changes in route53.batches],
+                          [('Z1', ['UPSERT'] * 3), ('Z1', ['DELETE'] * 3)])
+        self.assertEquals(set(route53.polls), set(['/change/C0']))
+        self.assertEquals(letswhisper.sleeps, [2, 4, 8])
+
+    def test_records_are_cleaned_when_a_challenge_fails(self):
+        route53 = StubRoute53({'domain.tld': 'Z1'})
+        acme_client = FakeAcme(route53)
+        letswhisper = make_letswhisper(acme_client, route53)
+        # route53 claims the change is in sync without applying it, the TXT records can't be found
+        route53.get_change = lambda Id: {'ChangeInfo': {'Id': Id, 'Status': 'INSYNC'}}
+
+        output = letswhisper.update_certificates('domain.tld', ['www', 'api'])
+
+        self.assertEquals(output, {'pk': None, 'certs': None})
+        self.assertEquals([[change['Action'] for change in changes] for _, changes in route53.batches],
+                          [['UPSERT'] * 2, ['DELETE'] * 2])
+
+    def test_records_are_cleaned_one_by_one_when_the_change_is_rejected(self):
+        route53 = StubRoute53({'domain.tld': 'Z1'})
+        acme_client = FakeAcme(route53)
+        letswhisper = make_letswhisper(acme_client, route53)
+        route53.gone.add('_acme-challenge.api.domain.tld')
+
+        output = letswhisper.update_certificates('domain.tld', ['www', 'api', 'admin'])
+
+        self.assertIn('BEGIN CERTIFICATE', output['certs'][0])
+        self.assertEquals([[(change['Action'], change['ResourceRecordSet']['Name']) for change in changes]
+                           for _, changes in route53.batches[1:]],
+                          [[('DELETE', '_acme-challenge.www.domain.tld')],
+                           [('DELETE', '_acme-challenge.admin.domain.tld')]])
+
+    def test_nothing_is_published_without_zone(self):
+        route53 = StubRoute53({'other.tld': 'Z1'})
+        letswhisper = make_letswhisper(FakeAcme(route53), route53)
+        self.assertEquals(letswhisper.update_certificates('domain.tld', ['www']), {'pk': None, 'certs': None})
+        self.assertEquals(route53.batches, [])
+
+
+class TestWaitForChange(TestCase):
+
+    def test_backoff_is_capped(self):
+        route53 = StubRoute53({}, pending_polls=6)
+        letswhisper = make_letswhisper(None, route53)
+        letswhisper._wait_for_change(route53, '/change/C0')
+        self.assertEquals(letswhisper.sleeps, [2, 4, 8, 15, 15, 15])
+        self.assertEquals(len(route53.polls), 7)
+
+    def test_errors_are_retried(self):
+        route53 = StubRoute53({}, failing_polls=2)
+        letswhisper = make_letswhisper(None, route53)
+        letswhisper._wait_for_change(route53, '/change/C0')
+        self.assertEquals(letswhisper.sleeps, [2, 4])
+
+    def test_gives_up_after_the_timeout(self):
+        route53 = StubRoute53({}, pending_polls=1000)
+        letswhisper = make_letswhisper(None, route53)
+        letswhisper._wait_for_change(route53, '/change/C0')
+        self.assertLessEqual(sum(letswhisper.sleeps), whisper.Letswhisper.CHANGE_TIMEOUT)
+        self.assertGreater(sum(letswhisper.sleeps), whisper.Letswhisper.CHANGE_TIMEOUT - 15)
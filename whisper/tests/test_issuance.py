@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+import threading
+import time
+
+from unittest import TestCase
+from tests import NullLogger, make_manager, whisper
+
+DAY = 24 * 3600
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class TestIssuanceScheduler(TestCase):
+
+    def setUp(self):
+        self.scheduler = whisper.IssuanceScheduler(max_certs=5, per_days=7)
+
+    def test_issued_certificates_use_the_budget(self):
+        now = 100 * DAY
+        self.scheduler.sync([now - 8 * DAY, now - 6 * DAY, now - 5 * DAY, now - DAY], now)
+        self.assertEquals(self.scheduler.available(now), 2)
+        wait, order = self.scheduler.reserve(False, now)
+        self.assertEquals(wait, 0)
+        self.assertEquals(self.scheduler.available(now), 1)
+        self.scheduler.reserve(False, now)
+        # the certificate of 6 days ago leaves the period first
+        self.assertEquals(self.scheduler.reserve(False, now), (DAY, None))
+
+    def test_failed_orders_give_their_slot_back(self):
+        _, order = self.scheduler.reserve(False, 0)
+        self.scheduler.finish(order, False, 10)
+        self.assertEquals(self.scheduler.available(10), 5)
+
+    def test_finished_orders_are_counted_until_synced(self):
+        _, order = self.scheduler.reserve(False, 0)
+        _, running = self.scheduler.reserve(False, 0)
+        self.scheduler.finish(order, True, 10)
+        self.assertEquals(self.scheduler.available(10), 3)
+        # the inventory has the finished one, the running one is still counted
+        self.scheduler.sync([5], 20)
+        self.assertEquals(self.scheduler.available(20), 3)
+
+    def test_orders_finished_during_the_walk_are_still_counted(self):
+        _, order = self.scheduler.reserve(False, 0)
+        # the walk of the folder started at 10, the certificate was written at 15
+        self.scheduler.finish(order, True, 15)
+        self.scheduler.sync([], 10)
+        self.assertEquals(self.scheduler.available(20), 4)
+
+    def test_renewals_are_spread(self):
+        self.assertEquals(self.scheduler.reserve(True, 0)[0], 0)
+        wait, order = self.scheduler.reserve(True, 3600)
+        self.assertIsNone(order)
+        self.assertAlmostEquals(wait, 7 * DAY / 5.0 - 3600)
+        # new certificates don't wait
+        self.assertEquals(self.scheduler.reserve(False, 3600)[0], 0)
+        self.assertEquals(self.scheduler.reserve(True, 7 * DAY / 5.0)[0], 0)
+
+
+class FakeLetswhisper(object):
+    """ Issue fake certificates, each order lasting until `release` is set"""
+
+    def __init__(self, fail=()):
+        self.release = threading.Event()
+        self.running = set()
+        self.orders = []
+        self.overlaps = []
+        self.fail = fail
+        self.lock = threading.Lock()
+
+    def update_certificates(self, domain, vhosts):
+        with self.lock:
+            if domain in self.running:
+                self.overlaps.append(domain)
+            self.running.add(domain)
+            self.orders.append((domain, vhosts))
+        self.release.wait(5)
+        with self.lock:
+            self.running.discard(domain)
+        if domain in self.fail:
+            return {'pk': None, 'certs': None}
+        return {'pk': "PK\n", 'certs': ("CERT\n", "CHAIN\n")}
+
+
+class TestConverge(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.manager = make_manager(path_to_cert_folder=self.folder, workers='4')
+        self.manager.letswhisper = FakeLetswhisper(fail=['c.tld'])
+        self.manager.debouncer.newEvent = lambda callback: self.converged_again.append(callback)
+        self.converged_again = []
+
+    def domains(self):
+        return {'a.tld': {'www': {'SAN': True, 'update_cert': True}, 'api': {'SAN': True, 'update_cert': False},
+                          'db': {'SAN': False, 'update_cert': True}},
+                'b.tld': {'www': {'SAN': True, 'update_cert': True}},
+                'c.tld': {'www': {'SAN': False, 'update_cert': True, 'renewal': True}}}
+
+    def wait(self):
+        self.manager._pool.close()
+        self.manager._pool.join()
+
+    def test_orders_of_a_domain(self):
+        self.assertEquals(self.manager._certificate_orders(self.domains()['a.tld']),
+                          [(False, ['api', 'www']), (False, ['db'])])
+        self.assertEquals(self.manager._certificate_orders(self.domains()['c.tld']), [(True, ['www'])])
+        self.assertEquals(self.manager._certificate_orders({'www': {'SAN': True, 'update_cert': False}}), [])
+
+    def test_domains_are_ordered_in_parallel(self):
+        letswhisper = self.manager.letswhisper
+        self.manager.domains = self.domains()
+        self.manager._converge()
+        # every domain runs its first order at the same time
+        self.assertTrue(wait_for(lambda: len(letswhisper.running) == 3))
+
+        # while they run new events don't start other jobs for the same domains
+        self.manager._converge()
+        letswhisper.release.set()
+        self.wait()
+        self.assertEquals(letswhisper.overlaps, [])
+        self.assertEquals(sorted(letswhisper.orders), [('a.tld', ['api', 'www']), ('a.tld', ['db']),
+                                                       ('b.tld', ['www']), ('c.tld', ['www'])])
+        self.assertEquals(len(self.converged_again), 3)
+        self.assertEquals(self.manager._orders, {})
+        # the failed order of c.tld didn't use the budget
+        self.assertEquals(self.manager.scheduler.available(time.time()), 2)
+        self.assertEquals(open("%s/multi-hosts.a.tld.pem" % self.folder).read(), "PK\nCERT\nCHAIN\n")
+        self.assertEquals(open("%s/db.a.tld.pem" % self.folder).read(), "PK\nCERT\nCHAIN\n")
+
+    def test_orders_over_budget_are_postponed(self):
+        now = time.time()
+        self.manager.scheduler.sync([now - 10] * 4, now)
+        self.manager._refresh_later = lambda wait: self.postponed.append(wait)
+        self.postponed = []
+        self.manager.letswhisper.release.set()
+        self.manager.domains = {'a.tld': self.domains()['a.tld']}
+        self.manager._converge()
+        self.wait()
+        self.assertEquals(self.manager.letswhisper.orders, [('a.tld', ['api', 'www'])])
+        self.assertEquals(len(self.postponed), 1)
+        self.assertAlmostEquals(self.postponed[0], 7 * DAY - 10, delta=5)
+
+    def test_postponing_after_a_planned_refresh_plans_another_one(self):
+        refreshes = []
+        self.manager.refresh_all = lambda: refreshes.append(True)
+        self.manager._refresh_later(0.05)
+        # an earlier refresh is already planned
+        self.manager._refresh_later(1)
+        self.assertTrue(wait_for(lambda: len(refreshes) == 1))
+        self.manager._refresh_later(0.05)
+        self.assertTrue(wait_for(lambda: len(refreshes) == 2))
+        self.assertIsNone(self.manager._retry)
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+
+from unittest import TestCase
+from tests import RecordingPool, make_manager
+
+
+class Stop(Exception):
+    pass
+
+
+class ScriptedKV(object):
+    """ KV answering the blocking queries with the given (index, items), then stopping the listener"""
+
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.queries = []
+
+    def get(self, key, index=None, recurse=False):
+        self.queries.append((key, index, recurse))
+        if not self.answers:
+            raise Stop()
+        return self.answers.pop(0)
+
+
+def items(**entries):
+    return [{'Key': "whisper/static/%s" % key.replace('__', '/'), 'Value': value} for key, value in sorted(entries.items())]
+
+
+class TestStaticEntries(TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.manager = make_manager(path_to_cert_folder=self.folder, **{'listen-path': ['whisper/static', 'whisper/other']})
+        self.manager._pool = RecordingPool()
+        self.kv = self.manager._consul.kv
+        self.events = []
+        self.manager.debouncer.newEvent = self.events.append
+
+    def test_one_read_per_path(self):
+        self.kv.put('whisper/static/', None)
+        self.kv.put('whisper/static/a.tld/', None)
+        self.kv.put('whisper/static/a.tld/www', 'SAN')
+        self.kv.put('whisper/static/a.tld/legacy', None)
+        self.kv.put('whisper/other/b.tld/www', 'nope')
+        self.manager.refresh_changes()
+        self.assertEquals(self.kv.gets, 2)
+        self.assertEquals(self.manager.desired, {('a.tld', 'www'): True, ('a.tld', 'legacy'): False,
+                                                 ('b.tld', 'www'): False})
+        # the next refreshes use the entries cached by the listeners
+        self.manager.refresh_changes()
+        self.assertEquals(self.kv.gets, 2)
+        self.manager.refresh_all()
+        self.assertEquals(self.kv.gets, 4)
+
+    def test_listener_caches_the_changed_entries(self):
+        self.manager._consul.kv = kv = ScriptedKV([(10, items(a__www='SAN')),
+                                                   (11, items(a__www='SAN')),
+                                                   (12, items(a__www='SAN', a__api=None))])
+        self.assertRaises(Stop, self.manager._kv_listen, 'whisper/static')
+        self.assertEquals(kv.queries, [('whisper/static', None, True), ('whisper/static', 10, True),
+                                       ('whisper/static', 11, True), ('whisper/static', 12, True)])
+        # the first answer is the state known by the first refresh and the second one changed nothing
+        self.assertEquals(self.events, [self.manager.refresh_changes])
+        self.assertEquals(self.manager._static['whisper/static'], {('a', 'www'): True, ('a', 'api'): False})
@@ -1,12 +1,15 @@
 import boto3
 import botocore
+import calendar
 import consul
 import datetime
 import docopt
 import inspect
+import json
 import OpenSSL.crypto
 import os
 import sys
+import tempfile
 import time
 
 import acme.challenges
@@ -18,12 +21,25 @@ from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 
+from multiprocessing.pool import ThreadPool
 from threading import Thread, Timer, Lock
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "common"))
+from debounce import Debouncer
+from service_tags import parse_service
+
 class Letswhisper(object):
     """This class will implement cert request / renew using acme protocol and DNS01 challenge"""
+    # route53 changes are polled every 2, 4, 8, 15, 15... seconds
+    CHANGE_POLL_DELAY = 2
+    CHANGE_POLL_MAX_DELAY = 15
+    CHANGE_TIMEOUT = 300
+    CHALLENGE_WORKERS = 10
+
     def __init__(self, acme_path, path, logger, staging):
         super(Letswhisper, self).__init__()
+        self._sleep = time.sleep
+        self._connect_lock = Lock()
         if staging:
             self.acme_url = "https://acme-staging.api.letsencrypt.org/directory"
         else:
@@ -34,24 +50,34 @@ class Letswhisper(object):
 
     def update_certificates(self, domain, vhosts):
         output = {'pk':None, 'certs':None}
-        if not domain in botocore.session.get_session().available_profiles:
-            self.log.warn("No AWS profiles found!", domain=domain)
+        route53_client = self._route53_client(domain)
+        if not route53_client:
             return output
         acme_client = self.connect()
-        aws_client = boto3.Session(profile_name=domain)
-        route53_client = aws_client.client('route53')
         self.log.info("Requesting a certificate", domain=domain, vhosts=vhosts)
         private_key = self._generate_rsa_private_key()
         csr = self._generate_csr(private_key, domain, vhosts)
         records = []
+        published = []
+        zone_id = None
         try:
+            zone_id = self._get_zone_id(route53_client, domain)
+            if not zone_id:
+                raise ValueError("Failed to retrieve zone Id for %s" % domain)
+
             for vhost in vhosts:
-                record = self._start_dns_challenge(acme_client, route53_client, vhost, domain)
+                record = self._start_dns_challenge(acme_client, vhost, domain)
                 if record:
                     records.append(record)
+            if not records:
+                raise ValueError("No dns challenge to fulfill")
 
-            for record in records:
-                self._verify_dns_challenge(acme_client, route53_client, record)
+            # all the TXT records of the certificate are published by a single change
+            self.log.debug("Creating TXT records with challenges", hosts=[record.get('vhost') for record in records])
+            change_id = self._change_txt_records(route53_client, "UPSERT", zone_id, self._txt_records(acme_client, records))
+            published = records
+            self._wait_for_change(route53_client, change_id)
+            self._verify_dns_challenges(acme_client, records)
 
             output['certs'] = self._request_certificate(acme_client, records, csr)
             output['pk'] = private_key.private_bytes(
@@ -62,14 +88,23 @@ class Letswhisper(object):
             self.log.error("Certificate request failled", ex=ex)
 
         finally:
-            for record in records:
-                self.log.debug("Cleaning TXT record", host=record.get('vhost'), domain=record.get('domain'))
-                self._change_txt_record(route53_client, "DELETE", record.get('zone_id'),
-                                        record.get('challenge').validation_domain_name(record.get('vhost')),
-                                        record.get('challenge').validation(acme_client.key))
+            if published:
+                self.log.debug("Cleaning TXT records", hosts=[record.get('vhost') for record in published], domain=domain)
+                self._clean_txt_records(route53_client, zone_id, self._txt_records(acme_client, published), domain)
         return output
 
-    def _start_dns_challenge(self, acme_client, route53_client, vhost, domain):
+    def _route53_client(self, domain):
+        if not domain in botocore.session.get_session().available_profiles:
+            self.log.warn("No AWS profiles found!", domain=domain)
+            return
+        return boto3.Session(profile_name=domain).client('route53')
+
+    def _get_zone_id(self, route53_client, domain):
+        for zone in route53_client.list_hosted_zones().get('HostedZones'):
+            if zone.get('Name') == "%s." % domain:
+                return zone.get('Id')
+
+    def _start_dns_challenge(self, acme_client, vhost, domain):
         fqdn = "%s.%s" % (vhost, domain)
         self.log.debug("Starting dns challenge for %s" % fqdn)
 
@@ -78,11 +113,6 @@ class Letswhisper(object):
                 if isinstance(challenge.chall, acme.challenges.DNS01):
                     return challenge
 
-        def get_zone_id_for_domain(route53_client, domain):
-            for zone in route53_client.list_hosted_zones().get('HostedZones'):
-                if zone.get('Name') == "%s." % domain:
-                    return zone.get('Id')
-
         authz = acme_client.request_domain_challenges(fqdn, new_authz_uri=acme_client.directory.new_authz)
         challenge = get_dns_challenge(authz)
 
@@ -90,36 +120,40 @@ class Letswhisper(object):
             self.log.error("Failed to retrieve dns challenge for %s" % fqdn)
             return
 
-        zone_id = get_zone_id_for_domain(route53_client, domain)
+        return {'vhost': fqdn, 'domain': domain, 'authz':authz ,'challenge':challenge}
 
-        if not zone_id:
-            self.log.error("Failed to retrive zone Id for Zone", zone=domain)
-            return
+    def _txt_records(self, acme_client, records):
+        return [(record.get('challenge').validation_domain_name(record.get('vhost')),
+                 record.get('challenge').validation(acme_client.key)) for record in records]
 
-        self.log.debug("Creating TXT record with challenge", host=vhost, domain=domain)
-
-        change_id = self._change_txt_record(route53_client, "UPSERT", zone_id,
-                                            challenge.validation_domain_name(fqdn),
-                                            challenge.validation(acme_client.key))
-
-        return {'vhost': fqdn, 'domain': domain, 'authz':authz ,'challenge':challenge, 'zone_id': zone_id, 'change_id':change_id}
-
-    def _verify_dns_challenge(self, acme_client, route53_client, record):
-        def wait_for_route53_change(route53_client, change_id):
-            self.log.debug("Waiting for DNS changes to be synced")
-            while True:
-                try:
-                    response = route53_client.get_change(Id=change_id)
-                    if response["ChangeInfo"]["Status"] == "INSYNC":
-                        return
-                    time.sleep(5)
-                except Exception as ex:
-                    self.log.warn("Error while fetching the changes, using dumb 30s sleep", ex=ex)
-                    time.sleep(30)
+    def _wait_for_change(self, route53_client, change_id):
+        """Poll route53 until the change is in sync, doubling the delay between polls"""
+        self.log.debug("Waiting for DNS changes to be synced", change_id=change_id)
+        delay, waited = self.CHANGE_POLL_DELAY, 0
+        while True:
+            try:
+                if route53_client.get_change(Id=change_id)["ChangeInfo"]["Status"] == "INSYNC":
                     return
+            except Exception as ex:
+                self.log.warn("Error while fetching the changes", change_id=change_id, ex=ex)
+            if waited + delay > self.CHANGE_TIMEOUT:
+                self.log.warn("DNS changes still not synced, trying the challenges anyway", change_id=change_id, waited=waited)
+                return
+            self._sleep(delay)
+            waited += delay
+            delay = min(delay * 2, self.CHANGE_POLL_MAX_DELAY)
+
+    def _verify_dns_challenges(self, acme_client, records):
+        """Verify the challenges concurrently and answer them, the first failure is raised once all are done"""
+        # the acme client (and its nonces) is not thread safe, only one answer is posted at a time
+        answer_lock = Lock()
+        pool = ThreadPool(min(len(records), self.CHALLENGE_WORKERS))
+        try:
+            pool.map(lambda record: self._verify_dns_challenge(acme_client, record, answer_lock), records)
+        finally:
+            pool.terminate()
 
-        wait_for_route53_change(route53_client, record.get('change_id'))
-
+    def _verify_dns_challenge(self, acme_client, record, answer_lock):
         challenge_response = record.get('challenge').response(acme_client.key)
 
         if not challenge_response.simple_verify(record.get('challenge').chall, record.get('vhost'), acme_client.key.public_key()):
@@ -128,7 +162,8 @@ class Letswhisper(object):
 
         self.log.debug("Verified Challenge!", host=record.get('vhost'), domain=record.get('domain'))
 
-        acme_client.answer_challenge(record.get('challenge'), challenge_response)
+        with answer_lock:
+            acme_client.answer_challenge(record.get('challenge'), challenge_response)
 
     def _request_certificate(self, acme_client, records, csr):
         self.log.info("Retreiving certificate for %s" % ",".join([record.get('vhost') for record in records]))
@@ -140,7 +175,8 @@ class Letswhisper(object):
 
         return pem_certificate, pem_certificate_chain
 
-    def _change_txt_record(self, route53_client, action, zone_id, domain, value):
+    def _change_txt_records(self, route53_client, action, zone_id, txt_records):
+        """Apply the action to all the [(name, value)] TXT records in a single change batch"""
         response = route53_client.change_resource_record_sets(
             HostedZoneId=zone_id,
             ChangeBatch={
@@ -148,17 +184,33 @@ class Letswhisper(object):
                     {
                         "Action": action,
                         "ResourceRecordSet": {
-                            "Name": domain,
+                            "Name": name,
                             "Type": "TXT",
                             "TTL": 30,
                             "ResourceRecords": [ {"Value": '"{}"'.format(value)}],
                         }
                     }
+                    for name, value in txt_records
                 ]
             }
         )
         return response["ChangeInfo"]["Id"]
 
+    def _clean_txt_records(self, route53_client, zone_id, txt_records, domain):
+        """Delete the TXT records in a single change, one by one when the change is rejected"""
+        try:
+            self._change_txt_records(route53_client, "DELETE", zone_id, txt_records)
+            return
+        except Exception as ex:
+            self.log.warn("Failed to clean TXT records", domain=domain, ex=ex)
+        if len(txt_records) < 2:
+            return
+        for name, value in txt_records:
+            try:
+                self._change_txt_records(route53_client, "DELETE", zone_id, [(name, value)])
+            except Exception as ex:
+                self.log.warn("Failed to clean TXT record", name=name, domain=domain, ex=ex)
+
     def register(self):
         self.log.info("Registering to acme servers")
         email = os.environ.get("ACME_REGISTER_EMAIL", None)
@@ -184,9 +236,10 @@ class Letswhisper(object):
 
     def connect(self):
         # Try to load existing configuration
-        if not os.path.isfile(self.acme_key):
-            self.log.warn("ACME not yet registered, trying to register...")
-            self.register()
+        with self._connect_lock:
+            if not os.path.isfile(self.acme_key):
+                self.log.warn("ACME not yet registered, trying to register...")
+                self.register()
         self.log.debug("Connecting using key loaded from %s" % self.acme_key, api=self.acme_url)
         key = serialization.load_pem_private_key(file.read(open(self.acme_key)), password=None, backend=default_backend())
         return acme.client.Client(self.acme_url, key=acme.jose.JWKRSA(key=key))
@@ -202,6 +255,195 @@ class Letswhisper(object):
            .add_extension(x509.SubjectAlternativeName([x509.DNSName(unicode(host))for host in hosts]), critical=False)
         return csr.sign(private_key, hashes.SHA256(), default_backend())
 
+def guess_domain(fqdn, domains):
+    """Return the (domain, vhost) of fqdn, the domain being the longest of domains fqdn belongs to"""
+    domain = None
+    if len(fqdn.split(".")) > 1:
+        for i in range(1, fqdn.count(".")):
+            if fqdn in domains:
+                domain = fqdn
+                break
+            elif ".".join(fqdn.split(".")[i:]) in domains:
+                domain = ".".join(fqdn.split(".")[i:])
+                break
+    return domain, fqdn.replace(".%s" % domain, '')
+
+class CertInventory(object):
+    """
+    Index of the certificates found in the output folder.
+
+    A .pem is only parsed when it's new or when its (mtime, size, inode) changed, the names,
+    validity dates and the (domain, vhost) they resolve to are kept in the index. Deleted
+    files are evicted. If path is set the index is kept between runs.
+    """
+    DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+    def __init__(self, folder, logger, path=None):
+        self.folder = folder
+        self.log = logger
+        self.path = path
+        self.entries = {}
+        # domains the names of the entries were resolved with
+        self.domains = []
+        self.load()
+
+    def load(self):
+        if not self.path or not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+            self.entries = dict((path, self._decode(entry)) for path, entry in state['entries'].iteritems())
+            self.domains = state['domains']
+        except (ValueError, KeyError, TypeError, IOError):
+            self.entries, self.domains = {}, []
+
+    def save(self):
+        if not self.path:
+            return
+        state = {'domains': self.domains,
+                 'entries': dict((path, self._encode(entry)) for path, entry in self.entries.iteritems())}
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.path)), prefix=".%s." % os.path.basename(self.path))
+        with os.fdopen(fd, 'w') as f:
+            json.dump(state, f)
+        os.rename(tmp, self.path)
+
+    def _encode(self, entry):
+        entry = dict(entry)
+        for date in 'not_before', 'not_after':
+            if entry.get(date):
+                entry[date] = entry[date].strftime(self.DATE_FORMAT)
+        return entry
+
+    def _decode(self, entry):
+        entry['key'] = tuple(entry['key'])
+        entry['names'] = dict((fqdn, tuple(name)) for fqdn, name in entry['names'].iteritems())
+        for date in 'not_before', 'not_after':
+            if entry.get(date):
+                entry[date] = datetime.datetime.strptime(entry[date], self.DATE_FORMAT)
+        return entry
+
+    def refresh(self):
+        """Parse the new and changed certificates and evict the deleted ones, return True if the index changed"""
+        found = {}
+        for root, dir, files in os.walk(self.folder):
+            for f in files:
+                if f.endswith(".pem"):
+                    path = os.path.join(root, f)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    found[path] = (stat.st_mtime, stat.st_size, stat.st_ino)
+
+        changed = False
+        for path in set(self.entries) - set(found):
+            self.log.debug("Certificate removed", path=path)
+            del self.entries[path]
+            changed = True
+        for path, key in found.iteritems():
+            if path not in self.entries or self.entries[path]['key'] != key:
+                self.entries[path] = self._parse(path, key)
+                changed = True
+        if changed:
+            self.save()
+        return changed
+
+    def _parse(self, path, key):
+        entry = {'key': key, 'fqdns': [], 'names': {}, 'not_before': None, 'not_after': None}
+        try:
+            with open(path) as f:
+                certificate = x509.load_pem_x509_certificate(f.read(), default_backend())
+            fqdns = set()
+            for cn in certificate.subject.get_attributes_for_oid(x509.OID_COMMON_NAME):
+                fqdns.add(cn.value)
+            try:
+                extentions = certificate.extensions.get_extension_for_oid(x509.OID_SUBJECT_ALTERNATIVE_NAME)
+                if extentions:
+                    for alternative in extentions.value.get_values_for_type(x509.DNSName):
+                        fqdns.add(alternative)
+            except x509.ExtensionNotFound:
+                pass
+            entry.update(fqdns=sorted(fqdns), not_before=certificate.not_valid_before, not_after=certificate.not_valid_after)
+        except Exception as ex:
+            # kept in the index so it's not parsed again until the file changes
+            self.log.warn("Certificate import failed for %s" % os.path.basename(path), Exception=ex)
+        return entry
+
+    def resolve(self, domains):
+        """Return the valid certificates by file name, with the (domain, vhost) of their names resolved against domains"""
+        if sorted(domains) != self.domains:
+            self.domains = sorted(domains)
+            for entry in self.entries.itervalues():
+                entry['names'] = {}
+        changed = False
+        certificates = {}
+        for path, entry in self.entries.iteritems():
+            if not entry['not_after']:
+                continue
+            if len(entry['names']) != len(entry['fqdns']):
+                entry['names'] = dict((fqdn, guess_domain(fqdn, domains)) for fqdn in entry['fqdns'])
+                changed = True
+            certificates[os.path.relpath(path, self.folder)] = entry
+        if changed:
+            self.save()
+        return certificates
+
+class IssuanceScheduler(object):
+    """
+    Budget of max_certs certificates issued per per_days days.
+
+    The certificates already issued are synced from the inventory, the orders started since
+    the last sync are counted on top of them until the next one (failed orders are not).
+    Renewals are spread over the period, two of them start at least per_days / max_certs
+    apart, while new certificates only wait for a free slot.
+    """
+    def __init__(self, max_certs, per_days):
+        self.max_certs = max_certs
+        self.period = per_days * 24 * 3600
+        self.issued = []
+        # [started, finished] of the orders since the last sync
+        self.orders = []
+        self.last_renewal = None
+        self.lock = Lock()
+
+    def sync(self, issued, now):
+        """Replace the issued certificates, read from a walk of the folder started at now"""
+        with self.lock:
+            self.issued = sorted(issued)
+            # the orders finished during the walk may not be part of it
+            self.orders = [order for order in self.orders if order[1] is None or order[1] > now]
+
+    def _recent(self, now):
+        return sorted([issued for issued in self.issued if issued > now - self.period] +
+                      [order[0] for order in self.orders])
+
+    def available(self, now):
+        with self.lock:
+            return max(self.max_certs - len(self._recent(now)), 0)
+
+    def reserve(self, renewal, now):
+        """Return (0, order) if an order can start now, else (seconds to wait, None)"""
+        with self.lock:
+            recent = self._recent(now)
+            if len(recent) >= self.max_certs:
+                # wait for enough certificates to leave the period
+                return max(recent[len(recent) - self.max_certs] + self.period - now, 1), None
+            if renewal and self.last_renewal is not None and self.last_renewal + self.period / self.max_certs > now:
+                return self.last_renewal + self.period / self.max_certs - now, None
+            order = [now, None]
+            self.orders.append(order)
+            if renewal:
+                self.last_renewal = now
+            return 0, order
+
+    def finish(self, order, issued, now):
+        with self.lock:
+            if issued:
+                order[1] = now
+            else:
+                self.orders.remove(order)
+
 class Logger(object):
     def __init__(self):
         self._out = sys.stdout
@@ -242,47 +484,109 @@ class WhisperManager(object):
         self._periodic_refresh_interval = 60 * 60 * 24
         self.max_certs = 5
         self.per_days = 7
-        self._certs_issued_for_period= {'nb':0, 'latest':[]}
+        self.scheduler = IssuanceScheduler(self.max_certs, self.per_days)
         self.log = Logger()
         self.log.level = "debug" if options['--debug'] else "info"
         self.dryrun = options['--dryrun']
         self.domains = {}
+        # {(domain, vhost): SAN} certificates wanted, the ones of the services are kept by service with their tags
+        self.desired = {}
+        self._services = {}
+        # {path: {(domain, host): SAN}} static entries
+        self._static = {}
+        self._not_converged = set()
         self.restrict_to_domains = options['--domain']
         self.output_certs = options['<path_to_cert_folder>']
         self.letswhisper = Letswhisper(os.path.expanduser(options['--acme-key']), self.output_certs, self.log, options['--staging'])
+        self.inventory = CertInventory(self.output_certs, self.log, options['--inventory'])
         self.lock = Lock()
+        # domain -> True if it must be converged again once its running orders are done
+        self._orders = {}
+        self._orders_lock = Lock()
+        self._pool = ThreadPool(int(options['--workers']))
+        self._retry = None
         self.kv_notification_path = options['--notify']
         self.static_paths = options['--listen-path']
+        self.debouncer = Debouncer(options['--event-threshold'], options['--event-max-wait'])
 
         self._spawn_listeners()
 
-    def _update_certificates(self, domain, vhosts):
+    def _certificate_orders(self, vhosts, changed=None):
+        """Return the [(renewal, hosts)] certificates to order for the vhosts of a domain (only the changed ones if given)"""
+        if changed is not None:
+            vhosts = dict((vhost, prop if vhost in changed else dict(prop, update_cert=False)) for vhost, prop in vhosts.iteritems())
         multi_hosts = []
         for vhost, prop in vhosts.iteritems():
             if prop.get('SAN') and prop.get('update_cert'):
-                multi_hosts = [vhost for vhost, prop in vhosts.iteritems() if prop.get('SAN')]
+                multi_hosts = sorted(vhost for vhost, prop in vhosts.iteritems() if prop.get('SAN'))
                 break
-        single_hosts = [vhost for vhost, prop in vhosts.iteritems() if not prop.get('SAN') and prop.get('update_cert')]
+        single_hosts = sorted(vhost for vhost, prop in vhosts.iteritems() if not prop.get('SAN') and prop.get('update_cert'))
+        # a renewal when every host already has a certificate
+        return [(all(not vhosts[host].get('update_cert') or vhosts[host].get('renewal') for host in hosts), hosts)
+                for hosts in (multi_hosts, single_hosts) if hosts]
+
+    def _order_certificates(self, domain, orders):
+        """Worker job running the orders of a domain one after the other"""
         need_to_notify = False
-        for hosts in multi_hosts, single_hosts:
-            if hosts:
-                self.log.debug("Update certificates for %s" % ",".join(hosts), domain=domain)
-                if self.dryrun:
+        try:
+            for renewal, hosts in orders:
+                wait, order = self.scheduler.reserve(renewal, time.time())
+                if not order:
+                    self.log.warn("Certificate order postponed to stay within the rate limit", domain=domain, hosts=hosts,
+                                  renewal=renewal, wait=int(wait), max_certs=self.max_certs, per_days=self.per_days)
+                    self._refresh_later(wait)
                     continue
-                certs = self.letswhisper.update_certificates(domain, hosts)
-                if certs.get('pk') and certs.get('certs'):
-                    need_to_notify = True
-                    if len(hosts) == 1:
-                        outcert = "%s/%s.%s.pem" % (self.output_certs, hosts[0], domain)
-                    else:
-                        outcert = "%s/multi-hosts.%s.pem" % (self.output_certs, domain)
-                    self.log.info("Writing certificate %s" % outcert, domain=domain, hosts=hosts)
-                    with open(outcert, 'w') as f:
-                        f.write(certs['pk'])
-                        f.write(certs['certs'][0])
-                        f.write(certs['certs'][1])
-        if need_to_notify and not self.dryrun:
-            self._send_notification()
+                issued = False
+                try:
+                    issued = self._update_certificate(domain, hosts)
+                finally:
+                    self.scheduler.finish(order, issued, time.time())
+                need_to_notify = need_to_notify or issued
+        except Exception as ex:
+            self.log.error("Certificate orders failed", domain=domain, ex=ex)
+        finally:
+            with self._orders_lock:
+                converge_again = self._orders.pop(domain)
+            if need_to_notify:
+                self._send_notification()
+            if converge_again:
+                self.debouncer.newEvent(self.refresh_changes)
+
+    def _update_certificate(self, domain, hosts):
+        self.log.debug("Update certificates for %s" % ",".join(hosts), domain=domain)
+        certs = self.letswhisper.update_certificates(domain, hosts)
+        if not certs.get('pk') or not certs.get('certs'):
+            return False
+        if len(hosts) == 1:
+            outcert = "%s/%s.%s.pem" % (self.output_certs, hosts[0], domain)
+        else:
+            outcert = "%s/multi-hosts.%s.pem" % (self.output_certs, domain)
+        self.log.info("Writing certificate %s" % outcert, domain=domain, hosts=hosts)
+        with open(outcert, 'w') as f:
+            f.write(certs['pk'])
+            f.write(certs['certs'][0])
+            f.write(certs['certs'][1])
+        return True
+
+    def _refresh_later(self, wait):
+        """Refresh in wait seconds, unless a refresh is already planned before"""
+        with self._orders_lock:
+            at = time.time() + wait
+            if self._retry and self._retry[0] <= at:
+                return
+            if self._retry:
+                self._retry[1].cancel()
+            timer = Timer(float(wait), self._planned_refresh, [at])
+            timer.setDaemon(True)
+            timer.start()
+            self._retry = (at, timer)
+
+    def _planned_refresh(self, at):
+        with self._orders_lock:
+            # the next postponed orders have to plan a new refresh
+            if self._retry and self._retry[0] == at:
+                self._retry = None
+        self.refresh_all()
 
     def _send_notification(self):
         """Update a key on consul datastore if needed"""
@@ -290,15 +594,32 @@ class WhisperManager(object):
             self.log.info("Sending Notificaiton Event", path=self.kv_notification_path)
             self._consul.kv.put(self.kv_notification_path, "ping")
 
-    def _converge(self):
-        """Do what's need to be done"""
+    def _converge(self, changed=None):
+        """
+        Queue the certificate orders of the domains, a domain has one job running at a time.
+
+        Only the (domain, vhost) in changed are considered if given, the ones of a domain with
+        a running job are considered again once it's done.
+        """
         self.log.debug("========= Update certificates %s=========" % datetime.date.today())
-        for domain, vhosts in self.domains.iteritems():
+        for domain, vhosts in sorted(self.domains.iteritems()):
             if self.restrict_to_domains and domain not in self.restrict_to_domains:
                 continue
-            if self._rate_limit_helper():
-                self._update_certificates(domain, vhosts)
-                self._certs_issued_for_period['nb'] +=1
+            changed_vhosts = set(vhosts) if changed is None else set(vhost for dns, vhost in changed if dns == domain)
+            orders = self._certificate_orders(vhosts, changed_vhosts)
+            if not orders:
+                continue
+            if self.dryrun:
+                for _, hosts in orders:
+                    self.log.debug("Update certificates for %s" % ",".join(hosts), domain=domain)
+                continue
+            with self._orders_lock:
+                if domain in self._orders:
+                    self._orders[domain] = True
+                    self._not_converged.update((domain, vhost) for vhost in changed_vhosts)
+                    continue
+                self._orders[domain] = False
+            self._pool.apply_async(self._order_certificates, (domain, orders))
         self.log.debug("================ Done %s=================" % datetime.date.today())
 
     def _spawn_listeners(self):
@@ -315,7 +636,7 @@ class WhisperManager(object):
     def _timed_refresh(self):
         self.log.info("Timed refresh every %ss" % self._periodic_refresh_interval)
         self.refresh_all()
-        self.log.info("Today is a new day! you can request up to %s certificates." % self._certs_issued_for_period['nb'])
+        self.log.info("Today is a new day! you can request up to %s certificates." % self.scheduler.available(time.time()))
         t = Timer(float(self._periodic_refresh_interval), self._timed_refresh)
         t.setDaemon(True)
         t.start()
@@ -328,145 +649,143 @@ class WhisperManager(object):
             index, data = self._consul.catalog.services(index=index)
             if old_index != index:
                 self.log.debug("Triggered by services")
-                self.refresh_all()
+                self.debouncer.newEvent(self.refresh_changes)
 
     def _kv_listen(self, path):
+        """Watch the whole path with a single blocking query, its entries are cached for the refreshes"""
         index = None
         while True:
             old_index = index
-            index, data = self._consul.kv.get(path, index=index)
-            if old_index and old_index != index:
+            index, items = self._consul.kv.get(path, index=index, recurse=True)
+            static = self._parse_static(items)
+            changed = static != self._static.get(path)
+            self._static[path] = static
+            if old_index and old_index != index and changed:
                 self.log.debug("Triggered by %s update" % path)
-                self.refresh_all()
+                self.debouncer.newEvent(self.refresh_changes)
 
     def refresh_all(self):
+        """Rebuild the desired certificates from scratch and converge all of them (timed refresh)"""
         with self.lock:
-            self.log.debug("Grab current services, static entries and certs")
-            self.domains = {}
-            self._refresh_services()
-            self._refresh_static()
-            self._refresh_certs()
-            self._converge()
+            self._services = {}
+            self._static = {}
+            self._refresh(full=True)
 
-    def _refresh_certs(self):
-        self._certs_issued_for_period['nb'] = 0
-        for root, dir, files in os.walk(self.output_certs):
-            for f in files:
-                if f.endswith(".pem"):
-                    try:
-                        certificate = x509.load_pem_x509_certificate(file.read(open("%s/%s" % (root, f))), default_backend())
-                        fqdns = set()
-                        for cn in certificate.subject.get_attributes_for_oid(x509.OID_COMMON_NAME):
-                            fqdns.add(cn.value)
-                        try:
-                            extentions = certificate.extensions.get_extension_for_oid(x509.OID_SUBJECT_ALTERNATIVE_NAME)
-                            if extentions:
-                                for alternative in extentions.value.get_values_for_type(x509.DNSName):
-                                    fqdns.add(alternative)
-                        except x509.ExtensionNotFound:
-                            pass
-                        for fqdn in fqdns:
-                            # try to guess the domain from fqdns
-                            domain = None
-                            if len(fqdn.split(".")) > 1:
-                                for i in range(1, fqdn.count(".")):
-                                    if self.domains.get(fqdn):
-                                        domain = fqdn
-                                        break
-                                    elif self.domains.get(".".join(fqdn.split(".")[i:])):
-                                        domain = ".".join(fqdn.split(".")[i:])
-                                        break
-
-                            vhost = fqdn.replace(".%s" % domain,'')
-                            # Save info
-                            if vhost in self.domains.get(domain, {}):
-                                self._rate_limit_helper(certificate.not_valid_before)
-                                if (datetime.date.today() - certificate.not_valid_after.date()).days > self.expiration_threshold:
-                                    self.log.info("Current certificate %s need to be renewed" % f, domain=domain, host=vhost)
-                                else:
-                                    self.log.debug("Current certificate %s is still valid" % f, domain=domain, host=vhost, expiration_date=certificate.not_valid_after.date().isoformat())
-                                    self.domains[domain][vhost]['update_cert'] = False
-                            else:
-                                self.log.warn("No Service found for %s " % f, domain=domain, vhost=vhost)
-
-                    except Exception as ex:
-                        self.log.warn("Certificate import failed for %s" % f, Exception=ex)
-
-    def _rate_limit_helper(self, issued=None):
-        """This function will maintain an internal state of the current rate limit"""
-        if issued and issued not in self._certs_issued_for_period['latest']:
-            if (datetime.date.today() - issued.date()).days < self.per_days:
-                self._certs_issued_for_period['nb'] +=1
-                self._certs_issued_for_period['latest'].append(issued)
-                self._certs_issued_for_period['latest'].sort()
-        else:
-            if self._certs_issued_for_period['nb'] >= self.max_certs:
-                self.log.warn("You may reached the limit of certs!", max_certs=self.max_certs, per_days=self.per_days, next_slot=self._certs_issued_for_period['latest'][0].isoformat())
-            else:
-                self.log.info("You have issued %s/%s certs during the past %s days" % (self._certs_issued_for_period['nb'], self.max_certs, self.per_days))
-        return True
+    def refresh_changes(self):
+        """Converge the vhosts whose desired certificate changed since the last refresh"""
+        with self.lock:
+            self._refresh(full=False)
+
+    def _refresh(self, full):
+        self.log.debug("Grab current services, static entries and certs")
+        desired = self._refresh_services()
+        for key, use_SAN in self._refresh_static().iteritems():
+            desired.setdefault(key, use_SAN)
+        changed = set(key for key, use_SAN in desired.iteritems() if self.desired.get(key) != use_SAN) | self._not_converged
+        self.desired = desired
+        self._not_converged = set()
+        if not full and not changed:
+            self.log.debug("No desired certificate changed")
+            return
 
-    def _refresh_services(self):
-        """ Get services from consul """
+        self.domains = {}
+        for (dns, name), use_SAN in desired.iteritems():
+            self.domains.setdefault(dns, {})[name] = {'SAN':use_SAN, 'update_cert':True}
+        self._refresh_certs()
+        self._converge(None if full else changed)
 
-        def convert_tags(tags):
-            """ Return a dict of tags from array"""
-            _tags = {}
-            for tag in tags:
-                if len(tag.split("=", 1)) != 2:
-                    continue
-                k,v = tag.split("=", 1)
-                if not k in _tags.keys():
-                    _tags[k] = v
+    def _refresh_certs(self):
+        walked = time.time()
+        self.inventory.refresh()
+        certificates = self.inventory.resolve(self.domains)
+        for f, certificate in sorted(certificates.iteritems()):
+            for fqdn, (domain, vhost) in sorted(certificate['names'].iteritems()):
+                # Save info
+                if vhost in self.domains.get(domain, {}):
+                    if (datetime.date.today() - certificate['not_after'].date()).days > self.expiration_threshold:
+                        self.log.info("Current certificate %s need to be renewed" % f, domain=domain, host=vhost)
+                        self.domains[domain][vhost]['renewal'] = True
+                    else:
+                        self.log.debug("Current certificate %s is still valid" % f, domain=domain, host=vhost, expiration_date=certificate['not_after'].date().isoformat())
+                        self.domains[domain][vhost]['update_cert'] = False
                 else:
-                    if not isinstance(_tags[k], list):
-                        _tags[k] = [_tags[k]]
-                    _tags[k].append(v)
-            return _tags
+                    self.log.warn("No Service found for %s " % f, domain=domain, vhost=vhost)
+        self.scheduler.sync([calendar.timegm(certificate['not_before'].utctimetuple()) for certificate in certificates.itervalues()], walked)
+        self._rate_limit_helper()
+
+    def _rate_limit_helper(self):
+        """Log where we are in the rate limit budget"""
+        available = self.scheduler.available(time.time())
+        if not available:
+            self.log.warn("You may reached the limit of certs!", max_certs=self.max_certs, per_days=self.per_days)
+        else:
+            self.log.info("You have issued %s/%s certs during the past %s days" % (self.max_certs - available, self.max_certs, self.per_days))
 
-        def parse_services(service):
-            for service in list(services):
-                tags = convert_tags(service['tags'])
-                if tags.get('dns') and not isinstance(tags.get('dns'), list):
-                    tags['dns'] = [tags.get('dns')]
+    def _refresh_services(self):
+        """ Get the {(domain, vhost): SAN} certificates of the consul services"""
 
+        def parse_services(services):
+            desired = {}
+            for service in services:
                 # for now only deal with vhost certs on the same domain with SAN
                 name = None
                 use_SAN = False
-                if tags.get('dns') and tags.get('vhost') and (tags.get('https') or tags.get('ssl')):
-                    name = tags.get('vhost')
+                if service.domains and service.vhost and (service.tags.get('https') or service.tags.get('ssl')):
+                    name = service.vhost
                     use_SAN = True
-                elif tags.get('dns') and not tags.get('vhost') and tags.get('ssl'):
-                    name = service['name']
+                elif service.domains and not service.vhost and service.tags.get('ssl'):
+                    name = service.name
 
                 if name:
-                    for dns in tags.get('dns'):
-                        if dns not in self.domains:
-                            self.domains[dns] = {}
-                        if name not in self.domains[dns]:
-                            self.domains[dns].update({name:{'SAN':use_SAN, 'update_cert':True}})
+                    for dns in service.domains:
+                        desired.setdefault((dns, name), use_SAN)
+            return desired
 
-        services = []
+        services = {}
         index, catalog = self._consul.catalog.services()
-        for service in catalog :
+        for service, tags in catalog.iteritems():
+            # no certificate without domain
+            if not any(tag.startswith("dns=") for tag in tags or []):
+                continue
+            # tags can move between instances without changing the tags of the service,
+            # the instances are parsed again only when the tags of one of them changed
             index, instances = self._consul.catalog.service(service=service)
-            for instance in instances:
-                services.append({'name': instance['ServiceName'], 'tags': instance['ServiceTags']})
+            instance_tags = sorted(sorted(instance['ServiceTags'] or []) for instance in instances)
+            if service in self._services and self._services[service][0] == instance_tags:
+                services[service] = self._services[service]
+                continue
+            services[service] = (instance_tags, parse_services([parse_service(instance['ServiceName'], instance['ServiceAddress'],
+                                                                              instance['ServicePort'], instance['ServiceID'],
+                                                                              instance['ServiceTags']) for instance in instances]))
+        self._services = services
 
-        parse_services(services)
+        desired = {}
+        for service, (tags, certificates) in sorted(services.iteritems()):
+            for key, use_SAN in certificates.iteritems():
+                desired.setdefault(key, use_SAN)
+        return desired
 
     def _refresh_static(self):
-        """Get static entries from consul"""
+        """Get the {(domain, host): SAN} certificates of the static entries, reading each path once"""
+        desired = {}
         for static in self.static_paths:
-            _, keys = self._consul.kv.get(static, keys=True)
-            for key in keys:
-                _, content = self._consul.kv.get(key)
-                use_SAN = True if content.get('Value', "") == "SAN" else False
-                dns, host = key.split("/")[-2:]
-                if dns not in self.domains:
-                    self.domains[dns] = {}
-                if host not in self.domains[dns]:
-                    self.domains[dns].update({host:{'SAN':use_SAN, 'update_cert':True}})
+            if static not in self._static:
+                _, items = self._consul.kv.get(static, recurse=True)
+                self._static[static] = self._parse_static(items)
+            for key, use_SAN in self._static[static].iteritems():
+                desired.setdefault(key, use_SAN)
+        return desired
+
+    @staticmethod
+    def _parse_static(items):
+        """Return the {(domain, host): SAN} of the <path>/<domain>/<host> keys"""
+        static = {}
+        for item in items or []:
+            if item['Key'].endswith("/"):
+                continue
+            dns, host = item['Key'].split("/")[-2:]
+            static.setdefault((dns, host), item.get('Value') == "SAN")
+        return static
 
 def main():
     """Whisper, a tool to retrieve letsencryp certificates for your docker containers.
@@ -481,6 +800,10 @@ def main():
       -d, --domain domain       The domain(s) you want to deal with.
       -n, --notify path         KV Path in consul datastore of the key to update [default: whisper/updated].
       -s, --staging             Use staging instead of real servers (to avoid hitting the rate limit while testing).
+      -i, --inventory path      File where the index of the certificates is kept between runs (not in the certificates folder).
+      -w, --workers n           Number of certificate orders running in parallel, one per domain at a time [default: 4].
+      --event-threshold s       Process events by batch with a threshold window (in second) [default: 10].
+      --event-max-wait s        Max delay (in second) before processing the pending events of a batch [default: 60].
       --debug                   Set log level to debug.
       --dryrun                  Don't initiate challenge, just saying what it will do.
     """